@@ -25,4 +25,8 @@ urlpatterns = [
         name='weight_plot-simple',),    
     url(r'^rewards$', login_required(runner.views.rewards_plot),
         name='reward_plot'),
+    url(r'^weights\.(?P<fmt>json|csv)$', login_required(
+        runner.views.weight_data), name='weight_data'),
+    url(r'^rewards\.(?P<fmt>json|csv)$', login_required(
+        runner.views.rewards_data), name='rewards_data'),
 ]
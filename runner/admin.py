@@ -1,19 +1,25 @@
 from django.contrib import admin
+from django.core.cache import cache
 from .models import Mouse, Box, Board, ArduinoProtocol, \
     PythonProtocol, Session, BehaviorCage, OptoSession, GrandSession
 from suit.admin import SortableModelAdmin
 from whisk_video.admin import VideoSessionInline
 from neural_sessions.admin import NeuralSessionInline
+from . import caches
 
 ## Filtering by tagging
 # https://djangosnippets.org/snippets/2807/
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.admin import SimpleListFilter
-from taggit.models import TaggedItem 
+from django.core.exceptions import ObjectDoesNotExist
 
 class TaggitListFilter(SimpleListFilter):
   """
   A custom filter class that can be used to filter by taggit tags in the admin.
+  
+  Edited to list the tags from the cached GrandSession tag index, so this
+  only works for GrandSession. The filtering itself is done by the database,
+  because the index may be out of date.
   """
 
   # Human-readable title which will be displayed in the
@@ -30,9 +36,9 @@ class TaggitListFilter(SimpleListFilter):
     human-readable name for the option that will appear in the right sidebar.
     """
     list = []
-    tags = TaggedItem.tags_for(model_admin.model)
-    for tag in tags:
-      list.append( (tag.name, _(tag.name)) )
+    tag2ids = caches.get_grand_session_tag_index()['tag2ids']
+    for tag_name in sorted(tag2ids.keys()):
+      list.append( (tag_name, _(tag_name)) )
     return list    
 
   def queryset(self, request, queryset):
@@ -43,6 +49,34 @@ class TaggitListFilter(SimpleListFilter):
     if self.value():
       return queryset.filter(tags__name__in=[self.value()])
 
+class CachedRelatedFieldListFilter(admin.RelatedFieldListFilter):
+    """Filter on a foreign key, with the choices cached
+    
+    The choices are every object of the related model, which would
+    otherwise be queried on every changelist render. They expire after
+    caches.FILTER_CHOICES_CACHE_TIMEOUT seconds, or sooner when that
+    model is written in this process.
+    """
+    def field_choices(self, field, request, model_admin):
+        key = caches.get_filter_choices_key(field.related_model)
+        choices = cache.get(key)
+        if choices is None:
+            choices = super(CachedRelatedFieldListFilter, self).field_choices(
+                field, request, model_admin)
+            cache.set(key, choices, caches.FILTER_CHOICES_CACHE_TIMEOUT)
+        return choices
+
+def get_linked_attr(obj, link_name, attr_name):
+    """Return obj.link_name.attr_name, or None if there is no such link
+    
+    For reverse OneToOne links, which raise instead of returning None.
+    """
+    try:
+        linked_obj = getattr(obj, link_name)
+    except ObjectDoesNotExist:
+        return None
+    return getattr(linked_obj, attr_name)
+
 class BoxAdmin(admin.ModelAdmin):
     list_display = ['name', 'l_reward_duration', 'r_reward_duration', 
         'serial_port', ]#'mean_water_consumed']
@@ -135,34 +169,36 @@ class GrandSessionAdmin(admin.ModelAdmin):
     ]
     
     list_filter = [
-        'session__mouse',
+        ('session__mouse', CachedRelatedFieldListFilter),
         TaggitListFilter,
     ]
     
     
     ## Callables for the list display (usual __ syntax doesn't work here)
+    # These are all loaded by get_queryset, so they don't hit the database.
+    # Missing links are displayed as empty.
     def neuralsession__name(self, obj):
-        return obj.neuralsession.name
+        return get_linked_attr(obj, 'neuralsession', 'name')
     neuralsession__name.short_description = 'neural'
 
     def behavioralsession__name(self, obj):
-        return obj.session.name
+        return get_linked_attr(obj, 'session', 'name')
     behavioralsession__name.short_description = 'behavior'
 
     def videosession__notes(self, obj):
-        return obj.videosession.notes
+        return get_linked_attr(obj, 'videosession', 'notes')
     videosession__notes.short_description = 'video notes'
     
     def neuralsession__notes(self, obj):
-        return obj.neuralsession.notes
+        return get_linked_attr(obj, 'neuralsession', 'notes')
     neuralsession__notes.short_description = 'neural notes'
     
     def optosession__info(self, obj):
-        return obj.optosession.info
+        return get_linked_attr(obj, 'optosession', 'info')
     optosession__info.short_description = 'opto'
     
     def optosession__notes(self, obj):
-        return obj.optosession.notes
+        return get_linked_attr(obj, 'optosession', 'notes')
     optosession__notes.short_description = 'opto notes'
     
     #~ list_filter = ['mouse', 'board', 'box']
@@ -171,14 +207,17 @@ class GrandSessionAdmin(admin.ModelAdmin):
     inlines = [OptoSessionInline, VideoSessionInline, NeuralSessionInline,
         BehavioralSessionInline]
     
-    # Tagging
-    # https://django-taggit.readthedocs.io/en/latest/admin.html
+    # Join in every linked session, so the list display callables don't
+    # query each one per row
     def get_queryset(self, request):
         return super(GrandSessionAdmin, self).get_queryset(
-            request).prefetch_related('tags')
+            request).select_related(
+            'session', 'optosession', 'videosession', 'neuralsession')
     
+    # Tagging
+    # https://django-taggit.readthedocs.io/en/latest/admin.html
     def tag_list(self, obj):
-        return ", ".join([o.name for o in obj.tags.all()])
+        return ", ".join(caches.get_grand_session_tags(obj.pk))
 
 class SessionAdmin(admin.ModelAdmin):
     fieldsets = [
@@ -227,7 +266,12 @@ class SessionAdmin(admin.ModelAdmin):
         'user_data_bias_summary',
         ]
     
-    list_filter = ['mouse', 'board', 'box']
+    list_filter = [
+        ('mouse', CachedRelatedFieldListFilter),
+        ('board', CachedRelatedFieldListFilter),
+        ('box', CachedRelatedFieldListFilter),
+    ]
+    list_select_related = ['mouse', 'board', 'box']
     ordering = ['-date_time_start']
 
 class MouseAdmin(admin.ModelAdmin):
@@ -5,3 +5,7 @@ from django.apps import AppConfig
 
 class RunnerConfig(AppConfig):
     name = 'runner'
+
+    def ready(self):
+        # Connect the cache invalidation receivers
+        import runner.signals
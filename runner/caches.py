@@ -0,0 +1,104 @@
+"""Keys and helpers for data cached by the runner app
+
+Everything here goes through django's default cache. On heroku each
+gunicorn worker has its own local-memory cache, and writes made by
+another worker, by a management command, or by update() never reach
+the signal receivers in signals.py of this one. So:
+
+The weight plot is validated against the database before use, because
+it is stored with the ETag of the data it was drawn from.
+
+The filter choices and the tag index are NOT validated. They only save
+the repeated queries within one changelist render and across renders
+in quick succession, so they expire after a few seconds. The signal
+receivers just evict them early when the change happens in-process.
+"""
+import uuid
+from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from taggit.models import TaggedItem
+
+from .models import GrandSession
+
+# Rendered weight plot, stored as (etag, png_bytes)
+WEIGHT_PLOT_CACHE_KEY = 'runner.weight_plot'
+
+# Cached renderings are dropped after this many seconds regardless
+WEIGHT_PLOT_CACHE_TIMEOUT = 60 * 60 * 24
+
+def invalidate_weight_plot():
+    """Evict the cached weight plot"""
+    cache.delete(WEIGHT_PLOT_CACHE_KEY)
+
+# Choices for the related-field filters in the admin sidebar, which
+# may be this many seconds out of date
+FILTER_CHOICES_CACHE_TIMEOUT = 30
+
+def get_filter_choices_key(model):
+    """Key for the cached filter choices of every object in model"""
+    return 'runner.filter_choices.%s' % model._meta.label_lower
+
+def invalidate_filter_choices(model):
+    """Evict the cached filter choices for model"""
+    cache.delete(get_filter_choices_key(model))
+
+## Index of GrandSession tags
+# The index itself is kept in process, because it is read once per row
+# of a changelist. Only its version is kept in the cache, and evicting
+# the version forces every process to rebuild its index.
+TAG_INDEX_VERSION_KEY = 'runner.grand_session_tag_index_version'
+
+# The index is rebuilt after this many seconds regardless, so it may be
+# this far out of date. It is only used to list the tags and to show
+# them on each row, never to filter.
+TAG_INDEX_TIMEOUT = 30
+
+_tag_index_memo = {'version': None, 'index': None}
+
+def build_grand_session_tag_index():
+    """Query every GrandSession tag and index it both ways
+    
+    Returns: dict
+        'tag2ids' : dict from tag name to sorted list of GrandSession ids
+        'id2tags' : dict from GrandSession id to sorted list of tag names
+    """
+    content_type = ContentType.objects.get_for_model(GrandSession)
+    tagged_items = TaggedItem.objects.filter(
+        content_type=content_type).values_list('tag__name', 'object_id')
+    
+    tag2ids = {}
+    id2tags = {}
+    for tag_name, grand_session_id in tagged_items:
+        tag2ids.setdefault(tag_name, []).append(grand_session_id)
+        id2tags.setdefault(grand_session_id, []).append(tag_name)
+    
+    for ids in tag2ids.values():
+        ids.sort()
+    for tag_names in id2tags.values():
+        tag_names.sort()
+    
+    return {'tag2ids': tag2ids, 'id2tags': id2tags}
+
+def get_grand_session_tag_index():
+    """Return the GrandSession tag index, rebuilding it if it is stale
+    
+    See build_grand_session_tag_index for the format.
+    """
+    version = cache.get(TAG_INDEX_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(TAG_INDEX_VERSION_KEY, version, TAG_INDEX_TIMEOUT)
+    
+    if _tag_index_memo['version'] != version:
+        _tag_index_memo['index'] = build_grand_session_tag_index()
+        _tag_index_memo['version'] = version
+    
+    return _tag_index_memo['index']
+
+def get_grand_session_tags(grand_session_id):
+    """Return the sorted tag names of a GrandSession, using the index"""
+    return get_grand_session_tag_index()['id2tags'].get(grand_session_id, [])
+
+def invalidate_grand_session_tag_index():
+    """Force every process to rebuild the GrandSession tag index"""
+    cache.delete(TAG_INDEX_VERSION_KEY)
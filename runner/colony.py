@@ -0,0 +1,268 @@
+"""Reading mice from the master colony database
+
+Mice are bred and genotyped in the colony database (HeroMouseColony),
+and copied into mouse-cloud when they start training. Only the rows
+needed for the mice of interest are read, rather than whole tables.
+
+The colony database rarely changes, so by default it is read from a
+local snapshot, which is refreshed once it is older than a TTL. If the
+colony database cannot be reached, a stale snapshot is used instead.
+"""
+import os
+import json
+import time
+import sqlite3
+import pandas
+
+# Only needed to connect to the colony database itself
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+# The credentials of the colony database are stored here
+COLONY_CREDENTIALS_PATH = os.path.expanduser(
+    '~/dev/HeroMouseColony/HeroMouseColony/local_cache')
+
+# These columns are dates, which not every database returns as such
+COLONY_DATE_COLUMNS = {
+    'colony_mouse': ['manual_dob'],
+    'colony_litter': ['dob'],
+}
+
+# Local snapshot of the colony tables
+COLONY_SNAPSHOT_PATH = os.path.expanduser(
+    '~/.mouse-cloud/colony_snapshot.sqlite')
+
+# Refresh the snapshot when it is older than this many seconds
+COLONY_SNAPSHOT_TTL = 60 * 60 * 24
+
+# Every table that is read
+COLONY_TABLES = ['colony_mouse', 'colony_mousegene', 'colony_gene',
+    'colony_litter', 'colony_cage']
+
+_engine_memo = {}
+
+def get_colony_engine(credentials_path=COLONY_CREDENTIALS_PATH):
+    """Return an engine connected to the colony database
+
+    The engine is created once per process, and keeps a pool of
+    connections that is reused by every query.
+    """
+    if credentials_path not in _engine_memo:
+        with file(credentials_path) as fi:
+            credentials_json = json.load(fi)
+        database_url = credentials_json['heroku']['database_url']
+        _engine_memo[credentials_path] = sqlalchemy.create_engine(database_url)
+    return _engine_memo[credentials_path]
+
+# Values per query in read_rows, below the limit of sqlite
+READ_ROWS_CHUNK_SIZE = 500
+
+def read_rows(conn, table_name, column, values):
+    """Read the rows of table_name where column is one of values
+
+    conn : sqlalchemy engine, or DB-API connection (eg sqlite3)
+
+    Returns: DataFrame, with the columns of table_name
+    """
+    values = sorted(set(values))
+
+    # Always query at least once, to get the columns
+    chunks = []
+    for start in range(0, max(len(values), 1), READ_ROWS_CHUNK_SIZE):
+        chunk_values = values[start:start + READ_ROWS_CHUNK_SIZE]
+        chunks.append(read_rows_chunk(conn, table_name, column, chunk_values))
+    if len(chunks) == 1:
+        return chunks[0]
+    return pandas.concat(chunks, ignore_index=True)
+
+def read_rows_chunk(conn, table_name, column, values):
+    """Read the rows of table_name where column is one of values, at once"""
+    if len(values) > 0:
+        placeholders = ', '.join(
+            ':value%d' % n for n in range(len(values)))
+        sql = 'SELECT * FROM %s WHERE %s IN (%s)' % (
+            table_name, column, placeholders)
+    else:
+        sql = 'SELECT * FROM %s WHERE 1 = 0' % table_name
+    params = dict(('value%d' % n, value) for n, value in enumerate(values))
+
+    # Named parameters are only portable through sqlalchemy
+    if sqlalchemy is not None and isinstance(conn, sqlalchemy.engine.Engine):
+        sql = sqlalchemy.text(sql)
+
+    return pandas.read_sql_query(sql, conn, params=params,
+        parse_dates=COLONY_DATE_COLUMNS.get(table_name))
+
+## Local snapshot
+def refresh_colony_snapshot(conn, snapshot_path=COLONY_SNAPSHOT_PATH):
+    """Copy every colony table from conn to a sqlite file at snapshot_path
+
+    The file is replaced at once, so readers never see half a snapshot.
+    """
+    snapshot_dir = os.path.dirname(snapshot_path)
+    if snapshot_dir and not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    temp_path = snapshot_path + '.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    snapshot_conn = sqlite3.connect(temp_path)
+    try:
+        for table_name in COLONY_TABLES:
+            table = pandas.read_sql_query(
+                'SELECT * FROM %s' % table_name, conn)
+            table.to_sql(table_name, snapshot_conn, index=False)
+        snapshot_conn.commit()
+    finally:
+        snapshot_conn.close()
+    os.rename(temp_path, snapshot_path)
+
+def get_colony_snapshot_age(snapshot_path=COLONY_SNAPSHOT_PATH):
+    """Return the age of the snapshot in seconds, or None if there is none"""
+    try:
+        return time.time() - os.path.getmtime(snapshot_path)
+    except OSError:
+        return None
+
+def open_colony_snapshot(snapshot_path=COLONY_SNAPSHOT_PATH,
+    max_age=COLONY_SNAPSHOT_TTL, refresh=False, connect=get_colony_engine):
+    """Return a connection to the local snapshot of the colony database
+
+    The snapshot is first refreshed if it is missing, older than max_age
+    seconds, or if refresh is True. If that fails, for instance because
+    the network is down, an existing snapshot is used however old.
+
+    connect : function returning a connection to the colony database
+
+    Returns: sqlite3 connection to the snapshot
+    """
+    age = get_colony_snapshot_age(snapshot_path)
+    if refresh or age is None or age > max_age:
+        try:
+            refresh_colony_snapshot(connect(), snapshot_path)
+        except Exception as e:
+            if age is None:
+                raise
+            print "warning: cannot refresh colony snapshot, using one " \
+                "from %0.1f hours ago: %s" % (age / 3600., e)
+
+    return sqlite3.connect(snapshot_path)
+
+def fetch_colony_tables(conn, husbandry_names):
+    """Read everything about the named mice from the colony database
+
+    Each table is read with one query, filtered on the rows needed.
+
+    Returns: dict of DataFrames
+        'mouse' : colony_mouse rows of the named mice, with the columns
+            dob, cage_name and genotype added, see get_colony_mouse_info
+        'mousegene' : colony_mousegene rows of those mice, indexed by id,
+            with the gene_type of each gene joined on
+        'gene' : colony_gene rows of those genes, indexed by id
+        'litter' : colony_litter rows of their litters, indexed by
+            breeding_cage_id
+        'cage' : colony_cage rows of their cages, indexed by id
+    """
+    mouse_table = read_rows(conn, 'colony_mouse', 'name', husbandry_names)
+    mousegene_table = read_rows(conn, 'colony_mousegene', 'mouse_name_id',
+        mouse_table['id']).set_index('id')
+    gene_table = read_rows(conn, 'colony_gene', 'id',
+        mousegene_table['gene_name_id']).set_index('id')
+    litter_table = read_rows(conn, 'colony_litter', 'breeding_cage_id',
+        mouse_table['litter_id'].dropna().astype(int))
+    cage_table = read_rows(conn, 'colony_cage', 'id',
+        mouse_table['cage_id'].dropna().astype(int)).set_index('id')
+
+    # Join the mousegene_table on gene_type for sorting
+    mousegene_table = mousegene_table.join(gene_table[['gene_type']],
+        on='gene_name_id')
+
+    # breeding_cage is a primary key for litter
+    litter_table = litter_table.set_index('breeding_cage_id')
+
+    # Get the DOB from the litter or directly from the mouse
+    litter_dob = mouse_table['litter_id'].map(litter_table['dob'])
+    mouse_table['dob'] = pandas.to_datetime(litter_dob.where(
+        mouse_table['litter_id'].notnull(), mouse_table['manual_dob']))
+
+    mouse_table['cage_name'] = mouse_table['cage_id'].map(cage_table['name'])
+    mouse_table['genotype'] = get_genotypes(
+        mouse_table, mousegene_table, gene_table)
+
+    return {
+        'mouse': mouse_table,
+        'mousegene': mousegene_table,
+        'gene': gene_table,
+        'litter': litter_table,
+        'cage': cage_table,
+    }
+
+def get_genotypes(mouse_table, mousegene_table, gene_table):
+    """Return the genotype string of every mouse in mouse_table at once
+
+    This recapitulates the logic from colony.Mouse: genes are listed by
+    gene_type as name(zygosity), skipping -/-. A mouse with no genes at
+    all is 'pure WT' if it is wild type, and otherwise, like a mouse with
+    only -/- genes, 'negative'.
+
+    mousegene_table : colony_mousegene rows, with gene_type joined on
+    gene_table : colony_gene rows, indexed by id
+
+    Returns: Series of genotype strings, indexed like mouse_table
+    """
+    n_genes = mousegene_table.groupby('mouse_name_id').size()
+
+    # Skip -/-
+    mousegenes = mousegene_table[mousegene_table['zygosity'] != '-/-']
+    mousegenes = mousegenes.join(
+        gene_table[['name']].rename(columns={'name': 'gene_name'}),
+        on='gene_name_id')
+
+    # A stable sort keeps genes of the same type in their original order
+    mousegenes = mousegenes.sort_values('gene_type', kind='mergesort')
+    labels = mousegenes['gene_name'] + '(' + mousegenes['zygosity'] + ')'
+    id2genotype = labels.groupby(mousegenes['mouse_name_id']).agg(
+        lambda mouse_labels: '; '.join(mouse_labels))
+
+    genotypes = mouse_table['id'].map(id2genotype)
+    pure_wt = (mouse_table['id'].map(n_genes).isnull() &
+        mouse_table['wild_type'].astype(bool))
+    genotypes[pure_wt] = 'pure WT'
+    return genotypes.fillna('negative')
+
+def get_colony_mouse_info(tables, husbandry_name):
+    """Return the information about a mouse that is copied to mouse-cloud
+
+    tables : as returned by fetch_colony_tables
+
+    Returns: dict with keys husbandry_name, sex, dob, cage_name, genotype
+        dob and cage_name are None if unknown
+
+    Raises KeyError if the mouse is not in tables.
+    """
+    mouse_table = tables['mouse']
+    matching = mouse_table[mouse_table.name == husbandry_name]
+    if len(matching) == 0:
+        raise KeyError(husbandry_name)
+    mouse = matching.iloc[0]
+
+    if pandas.isnull(mouse['dob']):
+        print "warning: cannot get dob of %s" % husbandry_name
+
+    return get_mouse_info_from_row(mouse)
+
+def get_mouse_info_from_row(mouse):
+    """Convert a row of the mouse table from fetch_colony_tables to a dict
+
+    See get_colony_mouse_info for the keys.
+    """
+    return {
+        'husbandry_name': mouse['name'],
+        'sex': int(mouse['sex']),
+        'dob': None if pandas.isnull(mouse['dob']) else mouse['dob'].date(),
+        'cage_name': None if pandas.isnull(mouse['cage_name'])
+            else mouse['cage_name'],
+        'genotype': mouse['genotype'],
+    }
@@ -0,0 +1,78 @@
+# Benchmark make_labels on a sheet for many synthetic cages
+#
+# Compares the plain labels.Sheet with the LabelSheet used by make_labels.
+# Run like this:
+#   python manage.py benchmark_labels --cages 500
+
+import io
+import time
+
+import labels
+
+from django.core.management.base import BaseCommand
+
+from runner.management.commands.make_labels import (
+    LABEL_SPECIFICATION, draw_label, make_label_sheet)
+
+def make_synthetic_colony_specs(n_cages, mice_per_cage=4):
+    """Return colony specs like get_colony_specs, for made-up cages"""
+    colony_specs = {}
+    for ncage in range(n_cages):
+        cage_name = 'CR%d' % ncage
+        colony_specs[cage_name] = {
+            'cage_name': cage_name,
+            'fillColor': ['black', 'magenta', 'blue'][ncage % 3],
+            'mice': ['KF%d_%d' % (ncage, nmouse)
+                for nmouse in range(mice_per_cage)],
+            'headplates': ['RB'] * mice_per_cage,
+            'genotypes': ['Emx1-Cre(+/-)'] * mice_per_cage,
+            'full_names': ['%d-%d' % (ncage, nmouse)
+                for nmouse in range(mice_per_cage)],
+        }
+    return colony_specs
+
+def make_plain_label_sheet(colony_specs, water_restriction_cage_name_l,
+    cage_card_cage_name_l):
+    """Lay out the same labels as make_label_sheet with labels.Sheet"""
+    sheet = labels.Sheet(LABEL_SPECIFICATION, draw_label, border=False)
+    for cage_name in sorted(colony_specs.keys()):
+        for typ, cage_name_l in [
+            ('water restriction', water_restriction_cage_name_l),
+            ('cage', cage_card_cage_name_l)]:
+            if cage_name in cage_name_l:
+                cage_specs = colony_specs[cage_name].copy()
+                cage_specs['typ'] = typ
+                sheet.add_label(cage_specs)
+    return sheet
+
+def time_sheet(make_sheet):
+    """Return (layout seconds, save seconds, pages, PDF bytes)"""
+    start = time.time()
+    sheet = make_sheet()
+    laid_out = time.time()
+    pdf = io.BytesIO()
+    sheet.save(pdf)
+    saved = time.time()
+    return laid_out - start, saved - laid_out, sheet.page_count, len(
+        pdf.getvalue())
+
+class Command(BaseCommand):
+    help = 'Time the rendering of a label sheet for many cages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cages', type=int, default=500,
+            help='number of synthetic cages, each with both labels')
+
+    def handle(self, **options):
+        colony_specs = make_synthetic_colony_specs(options['cages'])
+        cage_name_l = sorted(colony_specs.keys())
+
+        for method, make_sheet in [
+            ('labels.Sheet', lambda: make_plain_label_sheet(
+                colony_specs, cage_name_l, cage_name_l)),
+            ('LabelSheet', lambda: make_label_sheet(
+                colony_specs, cage_name_l, cage_name_l)),
+            ]:
+            layout_time, save_time, n_pages, n_bytes = time_sheet(make_sheet)
+            print "%s: layout %0.2f s, save %0.2f s, %d pages, %0.1f kB" % (
+                method, layout_time, save_time, n_pages, n_bytes / 1e3)
@@ -0,0 +1,89 @@
+# Benchmark the reward counting used by put_new on a large synthetic logfile
+#
+# The synthetic logfile is made by repeating a real logfile many times,
+# so it has the same format as the real ones. Each counting method runs
+# in its own process, so that its peak memory can be measured separately.
+# Run like this:
+#   python manage.py benchmark_reward_counting path/to/logfile --repeat 500
+
+import os
+import time
+import resource
+import tempfile
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+
+from runner.management.commands.put_new import (
+    count_rewards_in_memory, count_rewards_streaming)
+
+def make_synthetic_logfile(logfile, repeat):
+    """Write the contents of logfile `repeat` times to a temporary file
+
+    Returns: path to the temporary file, which the caller should delete
+    """
+    with file(logfile) as fi:
+        contents = fi.read()
+
+    fd, synthetic_logfile = tempfile.mkstemp(suffix='.log')
+    with os.fdopen(fd, 'w') as fi:
+        for n in range(repeat):
+            fi.write(contents)
+
+    return synthetic_logfile
+
+def run_method(method, logfile, queue):
+    """Count rewards in logfile with method and put the stats on queue
+
+    This runs in a child process. ru_maxrss is the peak resident memory
+    of the process in kilobytes.
+    """
+    start = time.time()
+    rewcounts = method(logfile)
+    duration = time.time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((duration, peak_kb,
+        dict((k, int(v)) for k, v in rewcounts.items())))
+
+def benchmark_method(method, logfile):
+    """Run method in a fresh process and return (duration, peak_kb, counts)"""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=run_method, args=(method, logfile, queue))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+class Command(BaseCommand):
+    help = 'Compare reward counting methods on a large synthetic logfile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('logfile',
+            help='real logfile to use as the template')
+        parser.add_argument('--repeat', type=int, default=100,
+            help='number of copies of logfile in the synthetic logfile')
+
+    def handle(self, **options):
+        synthetic_logfile = make_synthetic_logfile(
+            options['logfile'], options['repeat'])
+
+        try:
+            print "synthetic logfile: %0.1f MB" % (
+                os.path.getsize(synthetic_logfile) / 1e6)
+
+            method_results = []
+            for method in [count_rewards_in_memory, count_rewards_streaming]:
+                duration, peak_kb, rewcounts = benchmark_method(
+                    method, synthetic_logfile)
+                print "%s: %0.2f s, peak memory %0.1f MB" % (
+                    method.__name__, duration, peak_kb / 1e3)
+                method_results.append(rewcounts)
+
+            if method_results[0] == method_results[1]:
+                print "counts match: %r" % method_results[1]
+            else:
+                print "counts DO NOT match: %r vs %r" % tuple(method_results)
+
+        finally:
+            os.remove(synthetic_logfile)
@@ -0,0 +1,129 @@
+# Compare every mouse in mouse-cloud with the colony database
+#
+# Mice with a husbandry_name are looked up in the colony database all at
+# once, and the fields copied from it that now differ are listed.
+# Run like this:
+#   python manage.py check_colony_drift
+#   python manage.py check_colony_drift --apply
+#
+# With --apply, mouse-cloud is updated to match the colony database.
+
+import pandas
+import runner.models
+from runner.colony import fetch_colony_tables, get_mouse_info_from_row
+from runner.management.commands.copy_to_mouse_cloud import \
+    add_colony_arguments, get_colony_conn, get_or_create_cages
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+# Columns of the drift table
+DRIFT_COLUMNS = ['mouse_id', 'mouse', 'husbandry_name', 'field',
+    'mouse_cloud', 'colony']
+
+def find_colony_drift(colony_conn):
+    """Compare every mouse that has a husbandry_name with the colony
+
+    Fields that are unknown in the colony, like the dob of some mice,
+    are not compared.
+
+    Returns: drift, missing
+        drift : DataFrame with columns DRIFT_COLUMNS, one row per mouse
+            and field that differs. field is named as in
+            runner.models.Mouse, and cages are given by name.
+        missing : list of husbandry names that are not in the colony
+    """
+    mice = list(runner.models.Mouse.objects.exclude(
+        husbandry_name__isnull=True).exclude(husbandry_name='').values(
+        'id', 'name', 'husbandry_name', 'sex', 'dob', 'genotype',
+        'cage__name').order_by('name'))
+
+    # Hash the colony mice by name
+    tables = fetch_colony_tables(colony_conn,
+        [mouse['husbandry_name'] for mouse in mice])
+    husbandry_name2info = dict(
+        (record['name'], get_mouse_info_from_row(record))
+        for record in tables['mouse'].to_dict('records'))
+
+    drift_rows = []
+    missing = []
+    for mouse in mice:
+        info = husbandry_name2info.get(mouse['husbandry_name'])
+        if info is None:
+            missing.append(mouse['husbandry_name'])
+            continue
+
+        for field, mouse_cloud_value, colony_value in [
+            ('sex', mouse['sex'], info['sex']),
+            ('dob', mouse['dob'], info['dob']),
+            ('genotype', mouse['genotype'], info['genotype']),
+            ('cage', mouse['cage__name'], info['cage_name']),
+            ]:
+            if colony_value is None or mouse_cloud_value == colony_value:
+                continue
+            drift_rows.append({
+                'mouse_id': mouse['id'],
+                'mouse': mouse['name'],
+                'husbandry_name': mouse['husbandry_name'],
+                'field': field,
+                'mouse_cloud': mouse_cloud_value,
+                'colony': colony_value,
+            })
+
+    drift = pandas.DataFrame(drift_rows, columns=DRIFT_COLUMNS)
+    return drift, missing
+
+def apply_colony_drift(drift):
+    """Update mouse-cloud to the colony values in drift, in one transaction
+
+    Mice that need the same value of the same field are updated together,
+    so this takes one query per distinct change rather than per mouse.
+
+    Returns: the number of mice updated
+    """
+    change2mouse_ids = {}
+    for field, colony_value, mouse_id in zip(
+        drift['field'], drift['colony'], drift['mouse_id']):
+        change2mouse_ids.setdefault(
+            (field, colony_value), []).append(mouse_id)
+
+    with transaction.atomic():
+        name2cage = get_or_create_cages(
+            drift['colony'][drift['field'] == 'cage'])
+
+        for (field, colony_value), mouse_ids in sorted(
+            change2mouse_ids.items()):
+            if field == 'cage':
+                colony_value = name2cage[colony_value]
+            runner.models.Mouse.objects.filter(pk__in=mouse_ids).update(
+                **{field: colony_value})
+
+    return len(set(drift['mouse_id']))
+
+class Command(BaseCommand):
+    help = 'Compare mice in mouse-cloud with the colony database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true',
+            help='update mouse-cloud to match the colony database')
+        add_colony_arguments(parser)
+
+    def handle(self, **options):
+        drift, missing = find_colony_drift(get_colony_conn(options))
+
+        for husbandry_name in missing:
+            print "warning: no mouse named %s in the colony database" % (
+                husbandry_name)
+
+        if len(drift) == 0:
+            print "mouse-cloud matches the colony database"
+            return
+
+        print drift.drop('mouse_id', axis=1).to_string(index=False)
+
+        if options['apply']:
+            n_updated = apply_colony_drift(drift)
+            print "updated %d mice" % n_updated
+        else:
+            print "%d mice differ, use --apply to update them" % (
+                len(set(drift['mouse_id'])))
@@ -1,103 +1,251 @@
-# Copy a mouse from the master database to mouse-cloud
+# Copy mice from the master database to mouse-cloud
+#
+# With no arguments, asks for one mouse interactively. Otherwise copies
+# every mouse named on the command line or in a CSV file, like this:
+#   python manage.py copy_to_mouse_cloud 3126-3 3126-4
+#   python manage.py copy_to_mouse_cloud --csv new_mice.csv
+#
+# The CSV has a header and the columns husbandry_name, headplate_color,
+# training_name and training_number. Mice that are already in mouse-cloud
+# only need husbandry_name, and have their colony information updated.
+#
+# The colony database is read from a local snapshot, see runner.colony.
+# Use --refresh-colony after changing something in the colony database.
 
-import pandas
-import sqlalchemy
+import csv
 import runner.models
-import os
-import json
+from runner.colony import get_colony_engine, open_colony_snapshot, \
+    fetch_colony_tables, get_colony_mouse_info, COLONY_SNAPSHOT_TTL
 
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
-class Command(NoArgsCommand):
-    def handle_noargs(self, **options):
+# Fields copied from the colony database, apart from the cage
+COLONY_FIELDS = ['husbandry_name', 'sex', 'dob', 'genotype']
+
+def add_colony_arguments(parser):
+    """Add the options that choose how the colony database is read"""
+    parser.add_argument('--refresh-colony', action='store_true',
+        help='refresh the local snapshot of the colony database first')
+    parser.add_argument('--colony-max-age', type=float,
+        default=COLONY_SNAPSHOT_TTL / 3600.,
+        help='refresh the local snapshot if older than this many hours')
+    parser.add_argument('--no-colony-snapshot', action='store_true',
+        help='read the colony database directly, not the snapshot')
+
+def get_colony_conn(options):
+    """Return a connection to the snapshot or the colony database"""
+    if options['no_colony_snapshot']:
+        return get_colony_engine()
+    return open_colony_snapshot(
+        max_age=options['colony_max_age'] * 3600,
+        refresh=options['refresh_colony'])
+
+def set_training_parameters(new_mouse):
+    """Set the training parameters of a mouse that starts training"""
+    new_mouse.stimulus_set = 'trial_types_CCL_closest'
+    new_mouse.max_rewards_per_trial = 999
+    new_mouse.scheduler = 'ForcedAlternationLickTrain'
+    new_mouse.protocol_name = 'LickTrain'
+    new_mouse.script_name = 'LickTrain.py'
+    new_mouse.use_ir_detector = False
+
+def read_mouse_specs(csv_path):
+    """Read the mice to copy from a CSV file
+
+    Returns: list of dicts, one per row, with the columns as keys.
+        Empty values are dropped.
+    """
+    with file(csv_path) as fi:
+        rows = list(csv.DictReader(fi))
+
+    specs = []
+    for row in rows:
+        spec = dict((key.strip(), value.strip())
+            for key, value in row.items() if value and value.strip())
+        if 'training_number' in spec:
+            spec['training_number'] = int(spec['training_number'])
+        specs.append(spec)
+    return specs
+
+def get_or_create_cages(cage_names):
+    """Return a dict from name to BehaviorCage, creating missing ones"""
+    cage_names = set(cage_names)
+    name2cage = dict((cage.name, cage) for cage in
+        runner.models.BehaviorCage.objects.filter(name__in=cage_names))
+
+    missing_names = sorted(cage_names - set(name2cage.keys()))
+    if len(missing_names) > 0:
+        for cage_name in missing_names:
+            print "creating cage %s" % cage_name
+        runner.models.BehaviorCage.objects.bulk_create([
+            runner.models.BehaviorCage(name=cage_name, label_color='black')
+            for cage_name in missing_names])
+
+        # Read them back, because bulk_create does not always set the pk
+        name2cage.update((cage.name, cage) for cage in
+            runner.models.BehaviorCage.objects.filter(name__in=missing_names))
+
+    return name2cage
+
+def import_mice(tables, specs):
+    """Create or update the mice in specs from the colony tables
+
+    Everything is written in one transaction.
+
+    tables : as returned by fetch_colony_tables
+    specs : list of dicts with key husbandry_name, and optionally
+        headplate_color, training_name and training_number, which are
+        required for mice that are not in mouse-cloud yet
+
+    Returns: n_created, n_updated, n_skipped
+    """
+    # Colony information about each mouse
+    infos = []
+    n_skipped = 0
+    for spec in specs:
+        try:
+            info = get_colony_mouse_info(tables, spec['husbandry_name'])
+        except KeyError:
+            print "no mouse named %s in the colony database, skipping" % (
+                spec['husbandry_name'])
+            n_skipped += 1
+            continue
+        infos.append((spec, info))
+
+    # Mice already in mouse-cloud
+    name2mouse = dict((mouse.husbandry_name, mouse) for mouse in
+        runner.models.Mouse.objects.select_related('cage').filter(
+        husbandry_name__in=[info['husbandry_name'] for spec, info in infos]))
+
+    # New mice need a training name and number
+    to_write = []
+    for spec, info in infos:
+        if info['husbandry_name'] not in name2mouse and (
+            'training_name' not in spec or 'training_number' not in spec):
+            print "no training name or number for new mouse %s, " \
+                "skipping" % info['husbandry_name']
+            n_skipped += 1
+            continue
+        to_write.append((spec, info))
+    infos = to_write
+
+    with transaction.atomic():
+        name2cage = get_or_create_cages([info['cage_name']
+            for spec, info in infos if info['cage_name'] is not None])
+
+        new_mice = []
+        n_updated = 0
+        for spec, info in infos:
+            cage = name2cage.get(info['cage_name'])
+            existing_mouse = name2mouse.get(info['husbandry_name'])
+
+            if existing_mouse is None:
+                # Create a new mouse with values copied from the old one
+                new_mouse = runner.models.Mouse(
+                    name=spec['training_name'],
+                    number=spec['training_number'],
+                    headplate_color=spec.get('headplate_color'),
+                    experimenter=0,
+                    cage=cage,
+                    **dict((field, info[field]) for field in COLONY_FIELDS))
+                set_training_parameters(new_mouse)
+                print "creating mouse %s" % info['husbandry_name']
+                new_mice.append(new_mouse)
+                continue
+
+            # Update what changed in the colony, and whatever was given
+            params = dict((field, info[field]) for field in COLONY_FIELDS)
+            params['cage'] = cage
+            for spec_key, django_field_name in [
+                ('training_name', 'name'), ('training_number', 'number'),
+                ('headplate_color', 'headplate_color')]:
+                if spec_key in spec:
+                    params[django_field_name] = spec[spec_key]
+
+            changes = []
+            for django_field_name, value in sorted(params.items()):
+                existing_value = getattr(existing_mouse, django_field_name)
+                if existing_value != value:
+                    changes.append('%s %s -> %s' % (
+                        django_field_name, existing_value, value))
+                    setattr(existing_mouse, django_field_name, value)
+
+            if len(changes) > 0:
+                print "updating mouse %s: %s" % (
+                    info['husbandry_name'], ', '.join(changes))
+                existing_mouse.save()
+                n_updated += 1
+
+        runner.models.Mouse.objects.bulk_create(new_mice)
+
+    return len(new_mice), n_updated, n_skipped
+
+class Command(BaseCommand):
+    help = 'Copy mice from the master colony database to mouse-cloud'
+
+    def add_arguments(self, parser):
+        parser.add_argument('husbandry_names', nargs='*',
+            help='mice to copy, by husbandry name (e.g., 3126-3)')
+        parser.add_argument('--csv',
+            help='CSV file of mice to copy, see the top of this file')
+        add_colony_arguments(parser)
+
+    def handle(self, **options):
+        specs = [{'husbandry_name': husbandry_name}
+            for husbandry_name in options['husbandry_names']]
+        if options['csv']:
+            specs += read_mouse_specs(options['csv'])
+
+        if len(specs) == 0:
+            self.handle_interactive(get_colony_conn(options))
+            return
+
+        # Read only the rows needed for these mice
+        tables = fetch_colony_tables(get_colony_conn(options),
+            [spec['husbandry_name'] for spec in specs])
+
+        n_created, n_updated, n_skipped = import_mice(tables, specs)
+        print "created %d mice, updated %d, skipped %d" % (
+            n_created, n_updated, n_skipped)
+
+    def handle_interactive(self, colony_conn):
         # Which mouse to get and what info to assign
         husbandry_name = raw_input('Enter husbandry name (e.g., 3126-3): ')
         headplate_color = raw_input('Enter headplate color (e.g., RB): ')
         training_name = raw_input('Enter training name (e.g., KF145): ')
         training_number = int(raw_input('Enter training number (e.g., 145): '))
 
-        # Connect to the master database
-        master_credentials_path = os.path.expanduser(
-            '~/dev/HeroMouseColony/HeroMouseColony/local_cache')
-        with file(master_credentials_path) as fi:
-            master_credentials_json = json.load(fi)
-        master_credentials = master_credentials_json['heroku']['database_url']
-        conn = sqlalchemy.create_engine(master_credentials)
-
-        # Read the tables using pandas
-        mouse_table = pandas.read_sql_table('colony_mouse', conn)
-        mousegene_table = pandas.read_sql_table('colony_mousegene', conn).set_index('id')
-        gene_table = pandas.read_sql_table('colony_gene', conn).set_index('id')
-        litter_table = pandas.read_sql_table('colony_litter', conn)
-        cage_table = pandas.read_sql_table('colony_cage', conn)
-
-        # Join the mousegene_table on gene_type for sorting
-        mousegene_table = mousegene_table.join(gene_table[['gene_type']], 
-            on='gene_name_id')
-
-        # breeding_cage is a primary key for litter
-        litter_table = litter_table.set_index('breeding_cage_id')
-
-        # Identify the row that corresponds to the target mouse
-        mouse = mouse_table[mouse_table.name == husbandry_name].iloc[0]
-
-        # Get the DOB from the litter or directly from the mouse
-        if not pandas.isnull(mouse.litter_id):
-            new_mouse_dob = litter_table.loc[int(mouse.litter_id), 'dob'].date()
-        elif not pandas.isnull(mouse.manual_dob):
-            # Not sure if the '.date()' method is necessary here
-            new_mouse_dob = mouse.manual_dob.date()
-        else:
-            print "warning: cannot get dob"
-
-        # Get the cage name
-        cage_name = cage_table.set_index('id').loc[mouse['cage_id'], 'name']
-
-        # Get the genotype
-        # This recapitulates the logic from colony.Mouse
-        mousegenes = mousegene_table[mousegene_table.mouse_name_id == mouse.id]
-        mousegenes = mousegenes.sort_values('gene_type')
-        if len(mousegenes) == 0 and mouse.wild_type:
-            new_mouse_genotype = 'pure WT'
-        else:
-            # Iterate over mousegenes
-            res_l = []
-            for idx, row in mousegenes.iterrows():
-                # Skip -/-
-                if row['zygosity'] == '-/-':
-                    continue
-                
-                # Form gene name and zygosity
-                res = '%s(%s)' % (
-                    gene_table.loc[row['gene_name_id'], 'name'], 
-                    row['zygosity'])
-                res_l.append(res)
-            
-            if len(res_l) == 0:
-                new_mouse_genotype = 'negative'
-            else:
-                new_mouse_genotype = '; '.join(res_l)
+        # Read only the rows needed for this mouse
+        tables = fetch_colony_tables(colony_conn, [husbandry_name])
+        try:
+            info = get_colony_mouse_info(tables, husbandry_name)
+        except KeyError:
+            raise CommandError(
+                "no mouse named %s in the colony database" % husbandry_name)
+        cage_name = info['cage_name']
 
         # Collate all things to set
         # dict from django field name to correct value
         params = {
             'name': training_name,
             'number': training_number,
-            'sex': mouse.sex,
+            'sex': info['sex'],
             'headplate_color': headplate_color,
-            'husbandry_name': mouse['name'],
-            'dob': new_mouse_dob,
-            'genotype': new_mouse_genotype,
+            'husbandry_name': info['husbandry_name'],
+            'dob': info['dob'],
+            'genotype': info['genotype'],
             'stimulus_set': 'trial_types_CCL_1srvpos',
             'max_rewards_per_trial': 999,
             'scheduler': 'ForcedAlternationLickTrain',
             'protocol_name': 'LickTrain',
             'script_name': 'LickTrain.py',
         }
-            
+
 
         # Check whether this mouse is already in the database
-        qs = runner.models.Mouse.objects.filter(husbandry_name=mouse['name'])
+        qs = runner.models.Mouse.objects.filter(
+            husbandry_name=info['husbandry_name'])
         if len(qs) > 0:
             print "mouse already exists; error checking"
             existing_mouse = qs.first()
@@ -107,15 +255,15 @@ class Command(NoArgsCommand):
                 # Check whether value set correctly
                 existing_value = existing_mouse.__getattribute__(
                     django_field_name)
-                
+
                 if existing_value != value:
                     resp = raw_input("warning: %s is %s not %s; set? [y/N]" % (django_field_name,
                         str(existing_value), str(value)))
-                    
+
                     if resp.upper() == 'Y':
                         existing_mouse.__setattr__(django_field_name, value)
                         changes_made = True
-            
+
             if changes_made:
                 existing_mouse.save()
                 # Could set here using __setattr__
@@ -134,28 +282,23 @@ class Command(NoArgsCommand):
             else:
                 print "found existing cage %s" % cage_name
                 new_cage = cage_qs.first()
-            
+
             # Create a new mouse with values copied from the old one
             new_mouse = runner.models.Mouse(
                 name=training_name,
                 number=training_number,
-                husbandry_name=mouse['name'],
-                sex=mouse.sex,
+                husbandry_name=info['husbandry_name'],
+                sex=info['sex'],
                 headplate_color=headplate_color,
                 experimenter=0,
                 cage=new_cage,
             )
 
             # Set in new object
-            new_mouse.dob = new_mouse_dob
-            new_mouse.genotype = new_mouse_genotype
+            new_mouse.dob = info['dob']
+            new_mouse.genotype = info['genotype']
 
             # Training parameters
-            new_mouse.stimulus_set = 'trial_types_CCL_closest'
-            new_mouse.max_rewards_per_trial = 999
-            new_mouse.scheduler = 'ForcedAlternationLickTrain'
-            new_mouse.protocol_name = 'LickTrain'
-            new_mouse.script_name = 'LickTrain.py'
-            new_mouse.use_ir_detector = False
-
-            new_mouse.save()
\ No newline at end of file
+            set_training_parameters(new_mouse)
+
+            new_mouse.save()
@@ -1,160 +1,315 @@
-import numpy as np
+# Make water restriction labels and cage labels for behavior cages
+#
+# With no arguments, asks for the cages interactively. Otherwise the
+# cages are given on the command line, like this:
+#   python manage.py make_labels --water-restriction CR22 CR12 \
+#       --cage-card CR13 --row-start 2 --output labels.pdf
+#
+# Use "--output -" to write the PDF to stdout.
+
 import labels
 from reportlab.graphics import shapes
+from reportlab.lib import colors
 import runner.models
-import os
+import sys
+import subprocess
 
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import BaseCommand
 
-class Command(NoArgsCommand):
-    def handle_noargs(self, **options):
-        # Get the cages
-        prompt = ('Enter a list of cage names, separated by spaces, for'
-            'which you need water restriction labels.\n'
-            'Example: CR22 CR12 CR13\n'
-        )
-        data = raw_input(prompt)
-        water_restriction_cage_name_l = data.split()
-        
-        prompt = ('Enter a list of cage names, separated by spaces, for'
-            'which you need cage labels.\n'
-            'Example: CR22 CR12 CR13\n'
-        )
-        data = raw_input(prompt)
-        cage_card_cage_name_l = data.split()
-        
-        prompt = ('Enter the row to start printing on. Example: for the '
-            'second from top row, enter 2: '
-        )      
-        data = raw_input(prompt)
-        row_start = int(data)
-        
-        specs = labels.Specification(215.9, 279.4, 2, 15, 87.3, 16.9, corner_radius=2,
-            row_gap=0, column_gap=13.3)
-
-        def draw_label(label, width, height, obj):
-            print obj
-            try:
-                fillColor = obj['fillColor']
-            except KeyError:
-                fillColor = 'black'
-            
-            kwargs = {'fontName': 'Helvetica', 'fontSize': 10, 'textAnchor': 'middle',
-                'fillColor': fillColor}
-
-            if obj['typ'] == 'water restriction':
-                kwargs = {'fontName': 'Helvetica', 'fontSize': 10, 'textAnchor': 'middle',
-                    'fillColor': fillColor}        
-                
-                ## Header
-                label.add(shapes.String(
-                    width * .5,
-                    height - 10,
-                    "WATER RESTRICTED -- Cage %s" % obj['cage_name'],
-                    **kwargs))
-
-                label.add(shapes.String(
-                    width * .5,
-                    height - 20,
-                    "BRUNO LAB   AAAY8462   UNI: CCR2137",
-                    **kwargs))
-                
-                label.add(shapes.Line(
-                    width * .02, height-22, width * .98, height-22,
-                    strokeColor=fillColor))
-                
-                
-                ## Each mouse
-                xy_l = [(.2, -32), (.5, -32), (.8, -32), (.2, -42), (.5, -42), (.8, -42)]
-                
-                for mouse, headplate, xy in zip(obj['mice'], obj['headplates'], xy_l):
-                    label.add(shapes.String(
-                        width * xy[0],
-                        height + xy[1],
-                        '%s - %s' % (mouse, headplate),
-                        **kwargs))
-            
-            elif obj['typ'] == 'cage':
-                kwargs = {'fontName': 'Helvetica', 'fontSize': 10, 'textAnchor': 'start',
-                    'fillColor': fillColor}        
-
-                ## Header
-                label.add(shapes.String(
-                    width * .5, height - 10, "Cage: %s" % obj['cage_name'],
-                    fontName='Helvetica', fontSize=10, fillColor=fillColor,
-                    textAnchor='middle'))
-                
-                ## Each mouse
-                xy_l = [(.1, -20), (.6, -20), (.1, -30), (.6, -30), (.1, -40)]
-                
-                for mouse, full_name, genotype, headplate, xy in zip(
-                    obj['mice'], obj['full_names'], obj['genotypes'], 
-                    obj['headplates'], xy_l):
-            
-                    label.add(shapes.String(
-                        width * xy[0],
-                        height + xy[1],
-                        '%s - %s - %s' % (mouse, headplate, full_name),
-                        **kwargs))
+LABEL_SPECIFICATION = labels.Specification(
+    215.9, 279.4, 2, 15, 87.3, 16.9, corner_radius=2,
+    row_gap=0, column_gap=13.3)
+
+# Where the labels are written by default
+DEFAULT_OUTPUT_PATH = 'auto_created_labels.pdf'
+
+def draw_label(label, width, height, obj):
+    try:
+        fillColor = obj['fillColor']
+    except KeyError:
+        fillColor = 'black'
+
+    kwargs = {'fontName': 'Helvetica', 'fontSize': 10, 'textAnchor': 'middle',
+        'fillColor': fillColor}
+
+    if obj['typ'] == 'water restriction':
+        kwargs = {'fontName': 'Helvetica', 'fontSize': 10, 'textAnchor': 'middle',
+            'fillColor': fillColor}
+
+        ## Header
+        label.add(shapes.String(
+            width * .5,
+            height - 10,
+            "WATER RESTRICTED -- Cage %s" % obj['cage_name'],
+            **kwargs))
+
+        label.add(shapes.String(
+            width * .5,
+            height - 20,
+            "BRUNO LAB   AAAY8462   UNI: CCR2137",
+            **kwargs))
+
+        label.add(shapes.Line(
+            width * .02, height-22, width * .98, height-22,
+            strokeColor=fillColor))
+
+
+        ## Each mouse
+        xy_l = [(.2, -32), (.5, -32), (.8, -32), (.2, -42), (.5, -42), (.8, -42)]
+
+        for mouse, headplate, xy in zip(obj['mice'], obj['headplates'], xy_l):
+            label.add(shapes.String(
+                width * xy[0],
+                height + xy[1],
+                '%s - %s' % (mouse, headplate),
+                **kwargs))
+
+    elif obj['typ'] == 'cage':
+        kwargs = {'fontName': 'Helvetica', 'fontSize': 10, 'textAnchor': 'start',
+            'fillColor': fillColor}
+
+        ## Header
+        label.add(shapes.String(
+            width * .5, height - 10, "Cage: %s" % obj['cage_name'],
+            fontName='Helvetica', fontSize=10, fillColor=fillColor,
+            textAnchor='middle'))
+
+        ## Each mouse
+        xy_l = [(.1, -20), (.6, -20), (.1, -30), (.6, -30), (.1, -40)]
+
+        for mouse, full_name, genotype, headplate, xy in zip(
+            obj['mice'], obj['full_names'], obj['genotypes'],
+            obj['headplates'], xy_l):
+
+            label.add(shapes.String(
+                width * xy[0],
+                height + xy[1],
+                '%s - %s - %s' % (mouse, headplate, full_name),
+                **kwargs))
+
+def make_rounded_rect_path(width, height, radius):
+    """Return a rectangular Path with rounded corners
+
+    The corners are Bezier curves, which take a few operators each in the
+    PDF, whereas the corners drawn by pylabels are made of many short lines.
+    """
+    w, h, r = float(width), float(height), float(radius)
+    path = shapes.Path()
+    if not r:
+        path.moveTo(0, 0)
+        path.lineTo(w, 0)
+        path.lineTo(w, h)
+        path.lineTo(0, h)
+        path.closePath()
+        return path
+
+    # Distance of the control points from the ends of a quarter circle
+    k = 0.5523 * r
+    path.moveTo(r, 0)
+    path.lineTo(w - r, 0)
+    path.curveTo(w - r + k, 0, w, r - k, w, r)
+    path.lineTo(w, h - r)
+    path.curveTo(w, h - r + k, w - r + k, h, w - r, h)
+    path.lineTo(r, h)
+    path.curveTo(r - k, h, 0, h - r + k, 0, h - r)
+    path.lineTo(0, r)
+    path.curveTo(0, r - k, r - k, 0, r, 0)
+    path.closePath()
+    return path
+
+class LabelSheet(labels.Sheet):
+    """labels.Sheet that renders hundreds of labels quickly
+
+    Most of the time of labels.Sheet goes into rendering the clipping path
+    of every label, whose rounded corners are made of hundreds of lines,
+    and into computing label positions with Decimal arithmetic. Here the
+    clipping paths use curves instead, and positions are memoized.
+
+    This replaces private attributes of labels.Sheet, so pylabels is pinned
+    in requirements.txt to the version it was written against.
+    """
+    def __init__(self, *args, **kwargs):
+        super(LabelSheet, self).__init__(*args, **kwargs)
+        self._edges = {}
+
+        # Same paths as labels.Sheet, with curved corners
+        border = make_rounded_rect_path(self._lw, self._lh, self._cr)
+        border.isClipPath = 0
+        border.strokeWidth = 1
+        border.strokeColor = colors.black
+        border.fillColor = None
+        self._border = border
+
+        self._clip_label = make_rounded_rect_path(self._lw, self._lh, self._cr)
+        self._clip_label.isClipPath = 1
+        self._clip_label.strokeColor = None
+        self._clip_label.fillColor = None
+
+        if (self._dw == self._lw) and (self._dh == self._lh):
+            self._clip_drawing = self._clip_label
+        else:
+            self._clip_drawing = make_rounded_rect_path(
+                self._dw, self._dh, self._pr)
+            self._clip_drawing.isClipPath = 1
+            self._clip_drawing.strokeColor = None
+            self._clip_drawing.fillColor = None
+
+    def _calculate_edges(self):
+        position = tuple(self._position)
+        if position not in self._edges:
+            self._edges[position] = super(LabelSheet, self)._calculate_edges()
+        return self._edges[position]
+
+def make_label_sheet(colony_specs, water_restriction_cage_name_l,
+    cage_card_cage_name_l, row_start=1):
+    """Lay out the labels of each cage on a sheet
+
+    colony_specs : as returned by get_colony_specs
+    row_start : 1-based row of the first page to start printing on
 
+    Returns: LabelSheet, which can be saved to a path or file-like object
+    """
+    # Make a sheet
+    sheet = LabelSheet(LABEL_SPECIFICATION, draw_label, border=False)
+
+    # Define the used labels
+    used_labels = []
+    for row in range(1, row_start): # second number is the 1-based row to start on
+        for col in range(1, 3):
+            used_labels.append((row, col))
+    sheet.partial_page(1, used_labels)
+
+    # Add label for each cage
+    for cage_name in sorted(colony_specs.keys()):
+        cage_specs = colony_specs[cage_name]
+
+        if cage_name in water_restriction_cage_name_l:
+            # Copy specs over
+            cage_specs2 = cage_specs.copy()
+            cage_specs2['typ'] = 'water restriction'
+
+            # Add the label
+            sheet.add_label(cage_specs2)
+
+        if cage_name in cage_card_cage_name_l:
+            # Copy specs over
+            cage_specs2 = cage_specs.copy()
+            cage_specs2['typ'] = 'cage'
+
+            # Add the label
+            sheet.add_label(cage_specs2)
+
+    return sheet
+
+def get_colony_specs(cage_name_l):
+    """Get what goes on the label of each cage
+
+    The cages and their mice are read with one query each, however
+    many cages there are.
+
+    Returns: dict from cage name to dict of label contents
+        Cages that are not in the database are left out.
+    """
+    cages = runner.models.BehaviorCage.objects.filter(
+        name__in=cage_name_l).prefetch_related('mouse_set')
+
+    colony_specs = {}
+    for cage in cages:
+        cage_specs = {
+            'cage_name': cage.name,
+            'mice': [],
+            'headplates': [],
+            'genotypes': [],
+            'full_names': [],
+        }
+
+        # Set the color
+        cage_specs['fillColor'] = (cage.label_color or 'black').lower()
+        if cage_specs['fillColor'] == 'pink':
+            cage_specs['fillColor'] = 'magenta'
+
+        # Iterate over mice
+        for mouse in cage.mouse_set.all():
+            cage_specs['mice'].append(mouse.name)
+            cage_specs['headplates'].append(mouse.headplate_color)
+            cage_specs['genotypes'].append(mouse.genotype)
+            cage_specs['full_names'].append(mouse.husbandry_name)
+
+        colony_specs[cage.name] = cage_specs
+
+    return colony_specs
+
+def ask_for_cages():
+    """Ask for the cages and the row to start on at the keyboard
+
+    Returns: water_restriction_cage_name_l, cage_card_cage_name_l, row_start
+    """
+    prompt = ('Enter a list of cage names, separated by spaces, for'
+        'which you need water restriction labels.\n'
+        'Example: CR22 CR12 CR13\n'
+    )
+    data = raw_input(prompt)
+    water_restriction_cage_name_l = data.split()
+
+    prompt = ('Enter a list of cage names, separated by spaces, for'
+        'which you need cage labels.\n'
+        'Example: CR22 CR12 CR13\n'
+    )
+    data = raw_input(prompt)
+    cage_card_cage_name_l = data.split()
+
+    prompt = ('Enter the row to start printing on. Example: for the '
+        'second from top row, enter 2: '
+    )
+    data = raw_input(prompt)
+    row_start = int(data)
+
+    return water_restriction_cage_name_l, cage_card_cage_name_l, row_start
+
+class Command(BaseCommand):
+    help = 'Make water restriction labels and cage labels'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--water-restriction', nargs='+', default=[],
+            metavar='CAGE', help='cages that need water restriction labels')
+        parser.add_argument('--cage-card', nargs='+', default=[],
+            metavar='CAGE', help='cages that need cage labels')
+        parser.add_argument('--row-start', type=int, default=1,
+            help='1-based row of the first page to start printing on')
+        parser.add_argument('--output', '-o', default=DEFAULT_OUTPUT_PATH,
+            help='where to write the PDF, or - for stdout')
+        parser.add_argument('--open', action='store_true',
+            help='open the PDF when done, as when asking interactively')
+
+    def handle(self, **options):
+        # Get the cages
+        if options['water_restriction'] or options['cage_card']:
+            water_restriction_cage_name_l = options['water_restriction']
+            cage_card_cage_name_l = options['cage_card']
+            row_start = options['row_start']
+            open_output = options['open']
+        else:
+            water_restriction_cage_name_l, cage_card_cage_name_l, row_start = \
+                ask_for_cages()
+            open_output = True
 
         # Directly specify the cages we need
-        cage_name_l = water_restriction_cage_name_l + cage_card_cage_name_l
-        cage_name_l = list(np.unique(cage_name_l))
-            
+        cage_name_l = sorted(
+            set(water_restriction_cage_name_l + cage_card_cage_name_l))
+
         # Get the colony specs
-        colony_specs = {}
+        colony_specs = get_colony_specs(cage_name_l)
         for cage_name in cage_name_l:
-            # Init the specs for this cage
-            colony_specs[cage_name] = {}
-            colony_specs[cage_name]['mice'] = []
-            colony_specs[cage_name]['headplates'] = []
-            colony_specs[cage_name]['genotypes'] = []
-            colony_specs[cage_name]['full_names'] = []
-            colony_specs[cage_name]['cage_name'] = cage_name
-
-            # Find the cage
-            cage = runner.models.BehaviorCage.objects.filter(name=cage_name).first()
-            
-            # Set the color
-            colony_specs[cage_name]['fillColor'] = cage.label_color.lower()
-            if colony_specs[cage_name]['fillColor'] == 'pink':
-                colony_specs[cage_name]['fillColor'] = 'magenta'
-            
-            # Iterate over mice
-            for mouse in cage.mouse_set.all():
-                colony_specs[cage_name]['mice'].append(mouse.name)
-                colony_specs[cage_name]['headplates'].append(mouse.headplate_color)
-                colony_specs[cage_name]['genotypes'].append(mouse.genotype)
-                colony_specs[cage_name]['full_names'].append(mouse.husbandry_name)
-
-        # Make a sheet
-        sheet = labels.Sheet(specs, draw_label, border=False)
-
-        # Define the used labels
-        used_labels = []
-        for row in range(1, row_start): # second number is the 1-based row to start on
-            for col in range(1, 3):
-                used_labels.append((row, col))
-        sheet.partial_page(1, used_labels)
-
-        # Add label for each cage
-        for cage_name, cage_specs in colony_specs.items():
-            if cage_name in water_restriction_cage_name_l:
-                # Copy specs over
-                cage_specs2 = cage_specs.copy()
-                cage_specs2['typ'] = 'water restriction'
-                
-                # Add the label
-                sheet.add_label(cage_specs2)
-            
-            if cage_name in cage_card_cage_name_l:
-                # Copy specs over
-                cage_specs2 = cage_specs.copy()
-                cage_specs2['typ'] = 'cage'
-                
-                # Add the label
-                sheet.add_label(cage_specs2)        
-
-        sheet.save("auto_created_labels.pdf")
-        os.system('xdg-open auto_created_labels.pdf')
+            if cage_name not in colony_specs:
+                self.stderr.write("warning: no cage named %s" % cage_name)
+
+        sheet = make_label_sheet(colony_specs, water_restriction_cage_name_l,
+            cage_card_cage_name_l, row_start)
+
+        if options['output'] == '-':
+            sheet.save(sys.stdout)
+            return
+
+        sheet.save(options['output'])
+        if open_output:
+            subprocess.call(['xdg-open', options['output']])
@@ -2,18 +2,38 @@
 
 import django
 import runner.models
+import runner.reward_counts
 import MCwatch.behavior
 import os
+import glob
 import json
+import time
 import datetime
+import itertools
+import traceback
+import multiprocessing
+import pandas
+from django.db import close_old_connections, connections, transaction
 from django.utils import timezone
 from ArduFSM.plot import count_hits_by_type_from_trials_info
 import ArduFSM
 
 from django.core.management.base import NoArgsCommand
 
+# Optional, lets --watch wake up as soon as a sandbox is saved
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
+# Derived results are cached here between runs, keyed by logfile
+RESULTS_CACHE_PATH = os.path.expanduser(
+    '~/.mouse-cloud/put_new_results_cache.json')
+
+# The watermark of this machine is stored here, see load_watermark
+WATERMARK_PATH = os.path.expanduser('~/.mouse-cloud/put_new_watermark.json')
+
 
 def string2float(s):
     try:
@@ -24,154 +44,657 @@ def string2float(s):
 def split_once(path):
     return os.path.split(path)[0]
 
+def get_sandbox_paths(logfile):
+    """Get the script directory, sandbox directory and name from logfile"""
+    script_dir = split_once(split_once(logfile))
+    sandbox_dir = split_once(script_dir)
+    sandbox_name = os.path.split(sandbox_dir)[1]
+    return script_dir, sandbox_dir, sandbox_name
+
+def load_parameters(script_dir):
+    """Load the parameters json saved in script_dir"""
+    with file(os.path.join(script_dir, 'parameters.json')) as fp:
+        parameters = json.load(fp)
+    return parameters
+
+def load_results(script_dir):
+    """Load the results json saved in script_dir, or {} if there is none"""
+    try:
+        with file(os.path.join(script_dir, 'logfiles', 'results')) as fp:
+            results = json.load(fp)
+    except (IOError, ValueError):
+        # no results
+        print "warning: cannot load results json in %s" % script_dir
+        results = {}
+    return results
+
+## Counting rewards
+# See runner.reward_counts, which is given the ArduFSM functions here
+REWARD_TYPES = runner.reward_counts.REWARD_TYPES
+
+def count_rewards_streaming(logfile, chunk_size=10000):
+    """Count each type of reward in logfile, reading it in one pass"""
+    return runner.reward_counts.count_rewards_streaming(logfile,
+        ArduFSM.TrialSpeak.split_by_trial, ArduFSM.plot.count_rewards,
+        chunk_size)
+
+def count_rewards_in_memory(logfile):
+    """Count each type of reward in logfile, after reading all of it"""
+    return runner.reward_counts.count_rewards_in_memory(logfile,
+        ArduFSM.TrialSpeak.split_by_trial, ArduFSM.plot.count_rewards)
+
+def derive_results(session_name, logfile, results):
+    """Manually put in some stuff for perfdf if not stored in results
+
+    Returns: results, with left_perf, right_perf, bias_summary, and
+        l_valve_mean and r_valve_mean filled in if possible.
+        Returns None if the trial matrix is empty, which happens when
+        something went wrong, typically a corrupted logfile.
+    """
+    if 'left_perf' in results:
+        return results
+
+    # See if we can load a trial matrix
+    # I think we should probably continue if not, but not sure
+    # why this is here
+    data_available = True
+    try:
+        tm = MCwatch.behavior.db.get_trial_matrix(session_name)
+    except IOError:
+        data_available = False
+
+    # Give up if trial matrix is available, but empty
+    if data_available and len(tm) == 0:
+        return None
+
+    if data_available:
+        # Left and right perf
+        typ2perf = count_hits_by_type_from_trials_info(tm, 'rewside')
+        try:
+            results['left_perf'] = typ2perf['left'][0] / float(
+                typ2perf['left'][1])
+            results['right_perf'] = typ2perf['right'][0] / float(
+                typ2perf['right'][1])
+        except (KeyError, ZeroDivisionError):
+            results['left_perf'] = None
+            results['right_perf'] = None
+
+        # Put bias summary
+        ntm = ArduFSM.TrialMatrix.numericate_trial_matrix(tm)
+        anova_res = ArduFSM.TrialMatrix.run_anova(ntm)
+        results['bias_summary'] = anova_res
+
+        # Reward string
+        if 'l_valve_mean' not in results:
+            rewcounts = count_rewards_streaming(logfile)
+            nlrew = sum(rewcounts['left ' + typ] for typ in REWARD_TYPES)
+            nrrew = sum(rewcounts['right ' + typ] for typ in REWARD_TYPES)
+
+            if 'l_volume' in results and nlrew > 0:
+                results['l_valve_mean'] = float(results['l_volume']) / nlrew
+            if 'r_volume' in results and nrrew > 0:
+                results['r_valve_mean'] = float(results['r_volume']) / nrrew
+
+    return results
+
+def get_logfile_signature(logfile):
+    """Return [size, mtime] of logfile, or None if it cannot be read
+
+    This identifies the version of the logfile that results were derived
+    from.
+    """
+    try:
+        stat = os.stat(logfile)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+def load_results_cache(path):
+    """Load the cache of derived results, or {} if there is none
+
+    Returns: dict from logfile to a dict with keys
+        'signature' : see get_logfile_signature
+        'results' : the results returned by derive_results, including
+            None for a failure
+        'error' : the error from derive_session, or None. A logfile that
+            could not be read is not read again until it changes.
+    """
+    try:
+        with file(path) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return {}
+
+def save_json(path, data):
+    """Write data to path as json, replacing the old file at once"""
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    # numpy scalars can end up in the results
+    def default(obj):
+        if hasattr(obj, 'item'):
+            return obj.item()
+        raise TypeError(repr(obj))
+
+    temp_path = path + '.tmp'
+    with file(temp_path, 'w') as fi:
+        json.dump(data, fi, default=default)
+    os.rename(temp_path, path)
+
+def save_results_cache(path, results_cache):
+    """Write the cache of derived results, replacing the old one at once"""
+    save_json(path, results_cache)
+
+def derive_session(session_info):
+    """Load the parameters and derive the results of one session
+
+    This is what runs in the worker processes with --jobs, so it only
+    reads files and takes and returns picklable data.
+
+    session_info : tuple (session_name, logfile, cached)
+        cached is the entry for logfile from the results cache, or None.
+        If its signature matches the logfile, its results, or its error,
+        are used instead of deriving them again.
+
+    Returns: parameters, results, signature, error
+        results is None if the trial matrix is empty (see derive_results)
+        signature is the logfile signature the results correspond to
+        error is None, or a message if the session could not be read,
+            in which case parameters and results are None. Any error is
+            caught, because a missing parameters.json or a logfile that
+            ArduFSM or MCwatch cannot parse should only skip that session.
+    """
+    session_name, logfile, cached = session_info
+    signature = get_logfile_signature(logfile)
+    is_cached = (cached is not None and signature is not None and
+        cached['signature'] == signature)
+    if is_cached and cached.get('error') is not None:
+        return None, None, signature, cached['error']
+
+    try:
+        script_dir = get_sandbox_paths(logfile)[0]
+        parameters = load_parameters(script_dir)
+
+        if is_cached:
+            results = cached['results']
+        else:
+            results = derive_results(
+                session_name, logfile, load_results(script_dir))
+    except Exception as e:
+        return None, None, signature, '%s: %s' % (type(e).__name__, e)
+
+    return parameters, results, signature, None
+
+def get_sandbox_behavior_df(sandboxes):
+    """Return the behavior DataFrame of only the sessions in sandboxes
+
+    This has the same columns as MCwatch.behavior.db.get_behavior_df,
+    but only the logfiles in these sandbox directories are parsed. A
+    sandbox that cannot be parsed is left out, with a warning.
+    """
+    bdf_l = []
+    for sandbox in sorted(sandboxes):
+        try:
+            bdf_l.append(MCwatch.behavior.db.search_for_behavior_files(
+                behavior_dir=sandbox))
+        except Exception as e:
+            print "warning: cannot parse sandbox %s: %s: %s" % (
+                sandbox, type(e).__name__, e)
+
+    if len(bdf_l) == 0:
+        return pandas.DataFrame(
+            columns=['session', 'filename', 'sandbox', 'dt_start', 'dt_end'])
+    bdf = pandas.concat(bdf_l, ignore_index=True)
+
+    # Known from where the logfile is, in case it was not parsed
+    if 'sandbox' not in bdf.columns:
+        bdf['sandbox'] = [get_sandbox_paths(logfile)[2]
+            for logfile in bdf['filename']]
+    return bdf
+
+def make_session(session_row, parameters, results,
+    name2box, name2board, name2mouse):
+    """Create (but do not save) a Session from the behavior data
+
+    session_row : row of the behavior DataFrame
+    parameters, results : the parameters and (derived) results of the
+        session
+    name2box, name2board, name2mouse : dicts from name to every Box,
+        Board, and Mouse
+
+    Raises KeyError if the box, board, or mouse is not in the database.
+    """
+    logfile = session_row['filename']
+    script_dir, sandbox_dir, sandbox_name = get_sandbox_paths(logfile)
+    autosketch_path = os.path.join(sandbox_dir, 'Autosketch')
+
+    # Find the matching Box, Board, and Mouse
+    box_name = parameters.get('box', None)
+    box = None if box_name is None else name2box[box_name]
+    board_name = parameters.get('board', None)
+    board = None if board_name is None else name2board[board_name]
+    mouse_name = parameters.get('mouse')
+    mouse = None if mouse_name is None else name2mouse[mouse_name]
+
+    # Create the session
+    return runner.models.Session(
+        name=session_row['session'],
+        mouse=mouse,
+        logfile=logfile,
+        board=board,
+        box=box,
+        sandbox=sandbox_name,
+        autosketch_path=autosketch_path,
+        python_param_scheduler_name=parameters.get('scheduler'),
+        python_param_stimulus_set=parameters.get('stimulus_set'),
+        script_path=script_dir,
+        date_time_start=timezone.make_aware(
+            session_row['dt_start'], timezone.get_current_timezone()),
+        date_time_stop=timezone.make_aware(
+            session_row['dt_end'], timezone.get_current_timezone()),
+        user_data_water_pipe_position_stop=string2float(
+            results.get('final_pipe')),
+        user_data_left_water_consumption=string2float(
+            results.get('l_volume')),
+        user_data_right_water_consumption=string2float(
+            results.get('r_volume')),
+        user_data_weight=string2float(
+            results.get('mouse_mass')),
+        user_data_left_valve_mean=string2float(
+            results.get('l_valve_mean')),
+        user_data_right_valve_mean=string2float(
+            results.get('r_valve_mean')),
+        user_data_left_perf=string2float(
+            results.get('left_perf')),
+        user_data_right_perf=string2float(
+            results.get('right_perf')),
+        user_data_bias_summary=results.get('bias_summary'),
+    )
+
+
+## Incremental import
+# Each machine only sees the sandboxes that were saved on it, so each
+# keeps its own watermark, the start time before which every one of its
+# sessions is in the database. It is a naive local time, like the start
+# times in the behavior DataFrame.
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Sessions are saved when they end, so a session that started shortly
+# before the watermark may not have been saved when it was set. Sessions
+# that started within this many days before the watermark are checked
+# again on every run.
+WATERMARK_LOOKBACK_DAYS = 1
+
+def load_watermark(path):
+    """Load the watermark of this machine, or None if there is none
+
+    None means that no session can be assumed to be imported.
+    """
+    try:
+        with file(path) as fi:
+            return datetime.datetime.strptime(
+                json.load(fi)['watermark'], WATERMARK_FORMAT)
+    except (IOError, ValueError, KeyError):
+        return None
+
+def save_watermark(path, watermark):
+    """Write the watermark of this machine"""
+    save_json(path, {'watermark': watermark.strftime(WATERMARK_FORMAT)})
 
+def find_watermark(bdf, done_sessions):
+    """Return the new watermark after importing the sessions in bdf
+
+    bdf : behavior DataFrame of the sessions that were considered
+    done_sessions : set of the names of sessions that are now in the
+        database, or that can never be imported (empty trial matrix, or
+        a logfile or parameters that cannot be read)
+
+    This is the start of the oldest session in bdf that is not done, for
+    example because its mouse is not in the database yet, so that it is
+    tried again on every run. If all of them are, it is the start of the
+    newest one. Returns None if bdf is empty.
+    """
+    if len(bdf) == 0:
+        return None
+
+    not_done = ~bdf['session'].isin(done_sessions)
+    if not_done.any():
+        watermark = bdf.loc[not_done, 'dt_start'].min()
+    else:
+        watermark = bdf['dt_start'].max()
+    return watermark.to_pydatetime()
+
+
+## Watching for newly saved sandboxes
+# Sandboxes are stored in EYM format: experimenter/year/month/sandbox,
+# and get this suffix once the session is over
+SANDBOX_ROOT = os.path.expanduser('~/sandbox_root')
+SAVED_SANDBOX_SUFFIX = '-saved'
+
+# While watching, a saved sandbox is given up on after it fails to import
+# this many times. A later run without --watch picks it up again.
+MAX_IMPORT_ATTEMPTS = 3
+
+def find_saved_sandboxes(sandbox_root, since=None):
+    """Return the set of saved sandboxes from the month of since on
+
+    since : date or datetime. By default the last month, to handle
+        sessions that run over the end of a month.
+
+    Only the month directories from since to this month are listed, so
+    this stays cheap however long the history is.
+    """
+    this_month = datetime.date.today().replace(day=1)
+    if since is None:
+        since = this_month - datetime.timedelta(days=1)
+    month = datetime.date(since.year, since.month, 1)
+
+    saved_sandboxes = set()
+    while month <= this_month:
+        saved_sandboxes.update(glob.glob(os.path.join(sandbox_root,
+            '*', str(month.year), '%02d' % month.month, # EYM
+            '*' + SAVED_SANDBOX_SUFFIX)))
+        month = (month + datetime.timedelta(days=31)).replace(day=1)
+    return saved_sandboxes
+
+if pyinotify is not None:
+    class IgnoreEvents(pyinotify.ProcessEvent):
+        """Events only wake the watcher up, they are not handled"""
+        def process_default(self, event):
+            pass
+
+class SandboxWatcher(object):
+    """Report sandboxes saved under sandbox_root since the last check
+
+    The recent months are listed every poll_interval seconds. If pyinotify
+    is installed, the experimenter, year and month directories are also
+    watched, so that a newly saved sandbox is listed right away.
+    """
+    def __init__(self, sandbox_root, poll_interval):
+        self.sandbox_root = sandbox_root
+        self.poll_interval = poll_interval
+        self.seen = find_saved_sandboxes(sandbox_root)
+
+        self.notifier = None
+        if pyinotify is not None:
+            watch_manager = pyinotify.WatchManager()
+            watch_manager.add_watch(sandbox_root,
+                pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO,
+                rec=True, auto_add=True,
+                exclude_filter=self.is_inside_sandbox)
+            self.notifier = pyinotify.Notifier(watch_manager, IgnoreEvents())
+
+    def is_inside_sandbox(self, path):
+        """Whether path is a sandbox or below one, which need no watch"""
+        relpath = os.path.relpath(path, self.sandbox_root)
+        return len(relpath.split(os.sep)) > 3
+
+    def check(self):
+        """Return the set of sandboxes saved since the last check"""
+        saved_sandboxes = find_saved_sandboxes(self.sandbox_root)
+        new_sandboxes = saved_sandboxes - self.seen
+        self.seen = saved_sandboxes
+        return new_sandboxes
+
+    def sleep(self, timeout):
+        """Sleep for timeout seconds, or until something is created"""
+        if self.notifier is None:
+            time.sleep(timeout)
+        elif self.notifier.check_events(timeout * 1000):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def wait(self, timeout=None):
+        """Return newly saved sandboxes as soon as there are some
+
+        Returns an empty set if there are none within timeout seconds.
+        If timeout is None, waits forever.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            new_sandboxes = self.check()
+            if new_sandboxes:
+                return new_sandboxes
+
+            sleep_for = self.poll_interval
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return new_sandboxes
+                sleep_for = min(sleep_for, remaining)
+            self.sleep(sleep_for)
 
 
 class Command(NoArgsCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', '-j', type=int, default=1,
+            help='number of processes used to derive the results of new '
+            'sessions from their logfiles')
+        parser.add_argument('--results-cache', default=RESULTS_CACHE_PATH,
+            help='file where derived results are cached between runs, so '
+            'that only new or changed logfiles are parsed')
+        parser.add_argument('--no-results-cache', action='store_true',
+            help='derive the results of every new session from scratch')
+        parser.add_argument('--full', action='store_true',
+            help='compare every session ever run against the database, '
+            'instead of only those after the watermark of this machine')
+        parser.add_argument('--watermark', default=WATERMARK_PATH,
+            help='file where this machine stores the start time before '
+            'which all of its sessions are imported')
+        parser.add_argument('--lookback-days', type=float,
+            default=WATERMARK_LOOKBACK_DAYS,
+            help='also check sessions that started this many days before '
+            'the watermark')
+        parser.add_argument('--watch', action='store_true',
+            help='after importing, keep running and import each session '
+            'as soon as its sandbox is saved')
+        parser.add_argument('--sandbox-root', default=SANDBOX_ROOT,
+            help='directory of the saved sandboxes, listed from the month '
+            'of the watermark on, and watched with --watch')
+        parser.add_argument('--poll-interval', type=float, default=10,
+            help='seconds between listings of the sandbox directory')
+        parser.add_argument('--debounce', type=float, default=5,
+            help='seconds without another saved sandbox to wait for '
+            'before importing')
+
     def handle_noargs(self, **options):
-        # get new records
-        PATHS = MCwatch.behavior.db.get_paths()
-        bdf = MCwatch.behavior.db.get_behavior_df()
-        perfdf = MCwatch.behavior.db.get_perf_metrics()
+        if options['watch']:
+            # Start watching first, so nothing saved during the first
+            # import is missed
+            watcher = SandboxWatcher(
+                options['sandbox_root'], options['poll_interval'])
+
+        self.import_new_sessions(**options)
+
+        if options['watch']:
+            self.watch(watcher, **options)
+
+    def watch(self, watcher, **options):
+        """Import new sessions whenever sandboxes are saved, forever
+
+        Only the saved sandboxes are imported. If that fails they are
+        tried again with the next ones, up to MAX_IMPORT_ATTEMPTS times
+        each, and whatever goes wrong, the watcher keeps running.
+        """
+        print "watching %s for saved sandboxes%s" % (
+            watcher.sandbox_root,
+            '' if watcher.notifier is not None else ' (polling)')
+
+        # Sandboxes not imported yet, and how often they have failed
+        sandbox2attempts = {}
+        while True:
+            new_sandboxes = watcher.wait()
+
+            # Several boxes often finish together, import them in one go
+            while True:
+                more_sandboxes = watcher.wait(options['debounce'])
+                if not more_sandboxes:
+                    break
+                new_sandboxes.update(more_sandboxes)
+
+            for sandbox in sorted(new_sandboxes):
+                print "saved: %s" % sandbox
+                sandbox2attempts.setdefault(sandbox, 0)
+
+            # The connection may have timed out while waiting
+            close_old_connections()
+            try:
+                self.import_new_sessions(
+                    sandboxes=set(sandbox2attempts), **options)
+            except Exception:
+                print "cannot put_new, will retry on the next save:"
+                traceback.print_exc()
+                for sandbox in sorted(sandbox2attempts):
+                    sandbox2attempts[sandbox] += 1
+                    if sandbox2attempts[sandbox] >= MAX_IMPORT_ATTEMPTS:
+                        print "warning: giving up on %s after %d " \
+                            "attempts" % (sandbox, MAX_IMPORT_ATTEMPTS)
+                        del sandbox2attempts[sandbox]
+            else:
+                sandbox2attempts = {}
+
+    def import_new_sessions(self, sandboxes=None, **options):
+        """Import the sessions that are not in the database yet
+
+        sandboxes : if given, only the sessions in these sandbox
+            directories are considered, and the watermark is left alone
+        """
+        # Unless reconciling everything, only the sessions in the given
+        # sandboxes, or those that started after the watermark, are
+        # considered
+        threshold = None
+        if sandboxes is None and not options['full']:
+            watermark = load_watermark(options['watermark'])
+            if watermark is not None:
+                threshold = watermark - datetime.timedelta(
+                    days=options['lookback_days'])
+                print "only considering sessions started after %s" % (
+                    threshold)
+
+        # get new records, parsing only the sandboxes of recent months
+        # when there is a watermark
+        if sandboxes is not None:
+            bdf = get_sandbox_behavior_df(sandboxes)
+        elif threshold is not None:
+            bdf = get_sandbox_behavior_df(find_saved_sandboxes(
+                options['sandbox_root'], since=threshold))
+            bdf = bdf[bdf['dt_start'] >= threshold]
+        else:
+            bdf = MCwatch.behavior.db.get_behavior_df()
 
         # Drop those without a sandbox name (pre-sandbox)
         bdf = bdf[~bdf['sandbox'].isnull()]
-        
+
+        # Compare against only the same sessions in the database, by name,
+        # which is what bulk_create would collide on
+        sessions_in_db_qs = runner.models.Session.objects.all()
+        if sandboxes is not None or threshold is not None:
+            sessions_in_db_qs = sessions_in_db_qs.filter(
+                name__in=list(bdf['session']))
+
         # Find sessions that are not in mouse-cloud yet
-        sessions_in_db = list(runner.models.Session.objects.values_list(
+        sessions_in_db = set(sessions_in_db_qs.values_list(
             'name', flat=True))
         sessions_to_add = bdf.loc[~bdf['session'].isin(sessions_in_db), :]
 
-        for idx, logfile in sessions_to_add['filename'].iteritems():
-            session_name = bdf.loc[idx, 'session']
-            
-            # Get the sandbox directory from the logfile
-            script_dir = split_once(split_once(logfile))
-            sandbox_dir = split_once(script_dir)
-            autosketch_path = os.path.join(sandbox_dir, 'Autosketch')
-            
-            # Forgot to save board in parameters so have to extract from path
-            sandbox_name = os.path.split(sandbox_dir)[1]
-            path_board_name = sandbox_name.split('-')[-3]
-            path_mouse_name = sandbox_name.split('-')[-4]
-            
-            # Parse parameters
-            with file(os.path.join(script_dir, 'parameters.json')) as fp:
-                parameters = json.load(fp)
-            
-            # Parse results
-            try:
-                with file(os.path.join(script_dir, 'logfiles', 'results')) as fp:
-                    results = json.load(fp)   
-            except (IOError, ValueError):
-                # no results
-                print "warning: cannot load results json in %s" % script_dir
-                results = {}
-
-            # Manually put in some stuff for perfdf if not stored
-            if 'left_perf' not in results:
-                # See if we can load a trial matrix
-                # I think we should probably continue if not, but not sure
-                # why this is here
-                data_available = True
+        # Look up every Box, Board, and Mouse once, by name
+        name2box = dict(
+            (box.name, box) for box in runner.models.Box.objects.all())
+        name2board = dict(
+            (board.name, board) for board in runner.models.Board.objects.all())
+        name2mouse = dict(
+            (mouse.name, mouse) for mouse in runner.models.Mouse.objects.all())
+
+        # Results derived in previous runs
+        if options['no_results_cache']:
+            results_cache = {}
+        else:
+            results_cache = load_results_cache(options['results_cache'])
+
+        # Parse parameters and derive results for each session, in order
+        session_infos = [
+            (session_name, logfile, results_cache.get(logfile))
+            for session_name, logfile in zip(
+            sessions_to_add['session'], sessions_to_add['filename'])]
+        if options['jobs'] > 1:
+            # The workers don't need the database, and must not share
+            # this process's connection
+            connections.close_all()
+            pool = multiprocessing.Pool(options['jobs'])
+            derived = pool.imap(derive_session, session_infos)
+        else:
+            pool = None
+            derived = itertools.imap(derive_session, session_infos)
+
+        new_sessions = []
+        n_skipped = 0
+        new_results_cache = {}
+        done_sessions = set(sessions_in_db)
+        try:
+            for (idx, session_row), (parameters, results, signature,
+                error) in itertools.izip(sessions_to_add.iterrows(), derived):
+                session_name = session_row['session']
+
+                # Only sessions not yet in the database need to stay cached
+                if signature is not None:
+                    new_results_cache[session_row['filename']] = {
+                        'signature': signature, 'results': results,
+                        'error': error}
+
+                # It is not read again until its logfile changes, so it
+                # must not hold the watermark back either
+                if error is not None:
+                    print "cannot read session %s, cannot put_new: %s" % (
+                        session_name, error)
+                    done_sessions.add(session_name)
+                    n_skipped += 1
+                    continue
+
+                if results is None:
+                    print "empty trial matrix for session %s, " \
+                        "cannot put_new" % session_name
+                    done_sessions.add(session_name)
+                    n_skipped += 1
+                    continue
+
                 try:
-                    tm = MCwatch.behavior.db.get_trial_matrix(session_name)
-                except IOError:
-                    data_available = False
-                
-                # Continue if trial matrix is available, but empty
-                # This happens when something went wrong, typically a 
-                # corrupted logfile
-                if data_available and len(tm) == 0:
-                    print "empty trial matrix for session %s, cannot put_new" % (session_name)
+                    session = make_session(session_row, parameters, results,
+                        name2box, name2board, name2mouse)
+                except KeyError as e:
+                    print "no box, board, or mouse named %s for session %s, " \
+                        "cannot put_new" % (e.args[0], session_name)
+                    n_skipped += 1
                     continue
-                
-                if data_available:
-                    # Left and right perf
-                    typ2perf = count_hits_by_type_from_trials_info(tm, 'rewside')
-                    try:
-                        results['left_perf'] = typ2perf['left'][0] / float(
-                            typ2perf['left'][1])
-                        results['right_perf'] = typ2perf['right'][0] / float(
-                            typ2perf['right'][1])
-                    except (KeyError, ZeroDivisionError):
-                        results['left_perf'] = None
-                        results['right_perf'] = None
-                    
-                    # Put bias summary
-                    ntm = ArduFSM.TrialMatrix.numericate_trial_matrix(tm)
-                    anova_res = ArduFSM.TrialMatrix.run_anova(ntm)
-                    results['bias_summary'] = anova_res
-                    
-                    # Reward string
-                    if 'l_valve_mean' not in results:
-                        lines = ArduFSM.TrialSpeak.read_lines_from_file(logfile)
-                        splines = ArduFSM.TrialSpeak.split_by_trial(lines)
-                        rewdict = ArduFSM.plot.count_rewards(splines)
-                        nlrew = (rewdict['left auto'].sum() + 
-                            rewdict['left manual'].sum() + rewdict['left direct'].sum())
-                        nrrew = (rewdict['right auto'].sum() + 
-                            rewdict['right manual'].sum() + rewdict['right direct'].sum())
-                        
-                        if 'l_volume' in results:
-                            results['l_valve_mean'] = float(results['l_volume']) / nlrew
-                        if 'r_volume' in results:
-                            results['r_valve_mean'] = float(results['r_volume']) / nrrew
-
-            # Find the matching Box
-            box_name = parameters.get('box', None)
-            if box_name is None:
-                box = None
-            else:
-                box = runner.models.Box.objects.get(name=box_name)
 
-            # Find the matching Board
-            board_name = parameters.get('board', None)
-            if board_name is None:
-                board = None
-            else:
-                board = runner.models.Board.objects.get(name=board_name)
-            
-            # Find the matching Mouse
-            mouse_name = parameters.get('mouse')
-            if mouse_name is None:
-                mouse = None
-            else:
-                mouse = runner.models.Mouse.objects.get(name=mouse_name)
-            
-            # Create the session
-            print "adding session %s to the database" % bdf.loc[idx, 'session']
-            session = runner.models.Session(
-                name=bdf.loc[idx, 'session'],
-                mouse=mouse,
-                logfile=bdf.loc[idx, 'filename'],
-                board=board,
-                box=box,
-                sandbox=sandbox_name,
-                autosketch_path=autosketch_path,
-                python_param_scheduler_name=parameters.get('scheduler'),
-                python_param_stimulus_set=parameters.get('stimulus_set'),
-                script_path=script_dir,
-                date_time_start=timezone.make_aware(
-                    bdf.loc[idx, 'dt_start'], timezone.get_current_timezone()),
-                date_time_stop=timezone.make_aware(
-                    bdf.loc[idx, 'dt_end'], timezone.get_current_timezone()),
-                user_data_water_pipe_position_stop=string2float(
-                    results.get('final_pipe')),
-                user_data_left_water_consumption=string2float(
-                    results.get('l_volume')),
-                user_data_right_water_consumption=string2float(
-                    results.get('r_volume')),
-                user_data_weight=string2float(
-                    results.get('mouse_mass')),
-                user_data_left_valve_mean=string2float(
-                    results.get('l_valve_mean')),
-                user_data_right_valve_mean=string2float(
-                    results.get('r_valve_mean')),            
-                user_data_left_perf=string2float(
-                    results.get('left_perf')),
-                user_data_right_perf=string2float(
-                    results.get('right_perf')),              
-                user_data_bias_summary=results.get('bias_summary'),       
-            )
-            session.save()
\ No newline at end of file
+                print "adding session %s to the database" % session_name
+                new_sessions.append(session)
+                done_sessions.add(session_name)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Write them all at once
+        with transaction.atomic():
+            runner.models.Session.objects.bulk_create(new_sessions)
+
+        if not options['no_results_cache']:
+            if sandboxes is not None:
+                # Other sessions still to be imported stay cached too
+                results_cache.update(new_results_cache)
+                new_results_cache = results_cache
+            save_results_cache(options['results_cache'], new_results_cache)
+
+        # Advance past what is now in the database, but not past anything
+        # that may still be imported, like a session whose mouse is not in
+        # the database yet. Only a run over every sandbox can tell.
+        if sandboxes is None:
+            new_watermark = find_watermark(bdf, done_sessions)
+            if new_watermark is not None:
+                save_watermark(options['watermark'], new_watermark)
+
+        print "inserted %d sessions, skipped %d, %d already in database" % (
+            len(new_sessions), n_skipped, len(bdf) - len(sessions_to_add))
@@ -1,13 +1,44 @@
 # Command to start a behavioral session taking user input from 
 # board, box, and mouse.
+#
+# With no arguments, asks for one session at the keyboard. To start many
+# sessions at once, give a plan, like this:
+#   python manage.py start_runner_by_board_etc --plan plan.txt
+#   python manage.py start_runner_by_board_etc --today
+#
+# The plan file has one session per line, as mouse, board, and box
+# separated by spaces or commas. Lines starting with # are ignored.
+# --today uses the same plan as startgui, the latest board and box of
+# each mouse in training.
+#
+# Sandboxes of a plan are prepared in parallel processes, then compiled
+# and uploaded in parallel, one process per serial port, and finally the
+# Python scripts are started, see runner.session_plan. The time of each
+# stage is reported.
+#
+# Compiled sketches are cached, see runner.sketch_cache, so a sketch that
+# has not changed since it was last compiled is only uploaded. Use
+# --no-sketch-cache to always compile.
 
 import os
 import shutil
 import json
 import subprocess
-from django.core.management.base import BaseCommand
+import functools
+from django.core.management.base import BaseCommand, CommandError
 import ArduFSM.Runner
 import runner.models
+from runner.sketch_cache import compile_and_upload_cached
+from runner.session_plan import read_plan, run_plan, format_timings
+
+# Create a place to keep sandboxes
+SANDBOX_ROOT = os.path.expanduser('~/sandbox_root')
+
+# Where to look for protocols by name
+PROTOCOL_ROOT = os.path.expanduser('~/dev/ArduFSM')
+
+# The ArduFSM libraries that the protocols are compiled with
+LIBRARY_ROOT = os.path.join(PROTOCOL_ROOT, 'libraries')
 
 def get_user_input_from_keyboard():
     """Get user to type the board, box, and mouse"""
@@ -24,20 +55,15 @@ def get_user_input_from_keyboard():
         'mouse': mouse,
     }
 
-def run():
-    # Create a place to keep sandboxes
-    sandbox_root = os.path.expanduser('~/sandbox_root')
-
-    # Where to look for protocols by name
-    protocol_root = os.path.expanduser('~/dev/ArduFSM')
-        
-    # Get session parameters from user (board number, etc)
-    user_input = get_user_input_from_keyboard()
+## Stages of starting a session
+def prepare_session(user_input, sandbox_root=SANDBOX_ROOT,
+    protocol_root=PROTOCOL_ROOT):
+    """Create the sandbox and write the parameters, ready to compile
 
-    # Get experimenter from mouse name
-    user_input['experimenter'] = runner.models.Mouse.objects.filter(
-        name=user_input['mouse']).first().get_experimenter_display()
+    user_input : dict with keys board, box, mouse, and experimenter
 
+    Returns: sandbox_paths, specific_parameters
+    """
     # Look up the specific parameters
     specific_parameters = ArduFSM.Runner.ParamLookups.base.\
         get_specific_parameters_from_user_input(user_input)
@@ -49,7 +75,7 @@ def run():
     # Copy protocol to sandbox
     ArduFSM.Runner.Sandbox.copy_protocol_to_sandbox(
         sandbox_paths,
-        build_parameters=specific_parameters['build'], 
+        build_parameters=specific_parameters['build'],
         protocol_root=protocol_root)
 
     # Write the C parameters
@@ -59,14 +85,29 @@ def run():
 
     # Write the Python parameters
     ArduFSM.Runner.Sandbox.write_python_parameters(
-        sandbox_paths, 
-        python_parameters=specific_parameters['Python'], 
+        sandbox_paths,
+        python_parameters=specific_parameters['Python'],
         script_name=specific_parameters['build']['script_name'])
 
-    # Compile and upload
-    ArduFSM.Runner.Sandbox.compile_and_upload(sandbox_paths, specific_parameters)
+    return sandbox_paths, specific_parameters
 
-    # Call Python process
+def upload_session(sandbox_paths, specific_parameters, serial_port,
+    use_sketch_cache=True):
+    """Compile and upload the sketch, unless it was compiled before
+
+    Returns: 'cached' if the sketch was in the cache, or 'compiled'
+    """
+    if not use_sketch_cache:
+        ArduFSM.Runner.Sandbox.compile_and_upload(
+            sandbox_paths, specific_parameters)
+        return 'compiled'
+
+    return compile_and_upload_cached(sandbox_paths, specific_parameters,
+        serial_port, ArduFSM.Runner.Sandbox.compile_and_upload,
+        library_paths=[LIBRARY_ROOT])
+
+def start_script(sandbox_paths, specific_parameters):
+    """Call the Python process of a session that was uploaded"""
     # Extract some subprocess kwargs from the build dict
     subprocess_kwargs = {}
     for kwarg in ['nrows', 'ncols', 'xpos', 'ypos', 'zoom']:
@@ -76,15 +117,94 @@ def run():
         except KeyError:
             continue
     ArduFSM.Runner.Sandbox.call_python_script(
-        script_path=sandbox_paths['script'], 
+        script_path=sandbox_paths['script'],
         script_name=specific_parameters['build']['script_name'],
         **subprocess_kwargs
         )
 
+def run(use_sketch_cache=True):
+    # Get session parameters from user (board number, etc)
+    user_input = get_user_input_from_keyboard()
+
+    # Get experimenter from mouse name
+    user_input['experimenter'] = runner.models.Mouse.objects.filter(
+        name=user_input['mouse']).first().get_experimenter_display()
+
+    # The cached sketch is uploaded to this port
+    serial_port = runner.models.Box.objects.filter(
+        name=user_input['box']).first().serial_port
+
+    sandbox_paths, specific_parameters = prepare_session(user_input)
+
+    # Compile and upload
+    upload_session(sandbox_paths, specific_parameters, serial_port,
+        use_sketch_cache)
+
+    # Call Python process
+    start_script(sandbox_paths, specific_parameters)
+
+## Starting many sessions at once
+def get_todays_plan():
+    """Return the plan that startgui shows, in the same order
+
+    Returns: list of dicts with keys board, box, mouse
+    """
+    # startgui needs PyQt4, so only import it when needed
+    from runner.management.commands.startgui import get_latest_sessions, \
+        LOCALE_BOXES, RECENCY_DAYS, tz
+    import datetime
+
+    latest_session = runner.models.Session.objects.order_by(
+        '-date_time_start').first()
+    if latest_session is None:
+        raise CommandError("no sessions in the database to plan from")
+    target_date = latest_session.date_time_start.astimezone(tz).date()
+    recency_cutoff = target_date - datetime.timedelta(days=RECENCY_DAYS)
+
+    sessions = [session for session in get_latest_sessions(recency_cutoff)
+        if session.box.name in LOCALE_BOXES]
+    sessions.sort(key=lambda session: (
+        LOCALE_BOXES.index(session.box.name), session.date_time_start))
+
+    return [{'mouse': session.mouse.name, 'board': session.board.name,
+        'box': session.box.name} for session in sessions]
 
 class Command(BaseCommand):
+    help = 'Start behavioral sessions by mouse, board, and box'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plan',
+            help='file of sessions to start, see the top of this file')
+        parser.add_argument('--today', action='store_true',
+            help='start the sessions that startgui shows')
+        parser.add_argument('--processes', type=int,
+            help='number of sandboxes to prepare at once '
+            '(default: number of CPUs)')
+        parser.add_argument('--no-sketch-cache', action='store_true',
+            help='compile every sketch, even if compiled before')
+
     def handle(self, **options):
-        run()
+        if options['plan']:
+            plan = read_plan(options['plan'])
+        elif options['today']:
+            plan = get_todays_plan()
+        else:
+            run(use_sketch_cache=not options['no_sketch_cache'])
+            return
+
+        if len(plan) == 0:
+            raise CommandError("no sessions to start")
+
+        reports, stage_times = run_plan(plan, prepare_session,
+            functools.partial(upload_session,
+            use_sketch_cache=not options['no_sketch_cache']),
+            start_script, options['processes'])
+
+        for report in reports:
+            if report['error'] is not None:
+                self.stderr.write("%s in box %s failed:\n%s" % (
+                    report['mouse'], report['box'], report['error']))
+        self.stdout.write(format_timings(reports, stage_times))
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    run()
@@ -21,10 +21,12 @@ import functools
 import ArduFSM.Runner.start_runner_cli
 import pytz
 import glob
-import subprocess
+import threading
+import traceback
 import numpy as np
 
 from django.core.management.base import BaseCommand
+from django.db import connection
 
 def readlines_and_strip(filename):
     res = []
@@ -57,59 +59,124 @@ if len(LOCALE_COLORS) < len(LOCALE_BOXES):
     LOCALE_COLORS += ['white'] * (len(LOCALE_BOXES) - len(LOCALE_COLORS))
 LOCALE_BOX2COLOR = dict([(k, v) for k, v in zip(LOCALE_BOXES, LOCALE_COLORS)])
 
-def probe_arduino_user(arduino):
-    """Checks if any programs are using /dev/ttyACM*
+def probe_device_users(paths, check_users=True):
+    """Checks which programs are using each of paths, all at once
     
-    This can be very slow if there are broken network mounts, for some
-    reason.
+    Rather than running fuser once per device, the open files of every
+    process are read from /proc in a single pass. This only reads
+    symlinks, so it is not slowed down by broken network mounts. As with
+    fuser, processes of other users are only seen when running as root.
     
-    Returns: result, pid_string
+    check_users : if False, only check whether each path exists, and
+        report 'unk' for those that do
+    
+    Returns: dict from path to (result, pid_string)
         result: a string
-            'in use' : the arduino is in use
-            'not in use' : the arduino exists but is not in use
+            'in use' : the device is in use
+            'not in use' : the device exists but is not in use
             'does not exist' : no such file
-            'unknown error 1' : return code 1, some unhandled error
-            'unknown error' : any other unhandled error
+            'unk' : the device exists, and check_users is False
         pid_string: a string
             If result == 'in use', this is a space separated list of pids
             Otherwise this will be an empty string
     """
-    # Shortcut if the file doesn't exist
-    if not os.path.exists(arduino):
-        return 'does not exist', ''
-    
-    # Subprocess to probe arduino
-    proc = subprocess.Popen(['fuser', arduino],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = proc.communicate()
-    returncode = proc.returncode
-    
-    # Parse results
-    pid_string = ''
-    if returncode == 0:
-        # It exists and it is in use
-        # In this case stdout is a space-separated list of pids
-        result = 'in use'
-        pid_string = stdout
-    elif returncode == 1:
-        if stdout == '' and stderr == '':
-            # File exists and is not in use
-            result = 'not in use'
-        elif stdout == '' and stderr == (
-            'Specified filename %s does not exist.\n' % arduino):
-            result = 'does not exist'
+    # The open files are listed by their real path, which may differ from
+    # a symlink like /dev/arduino_B0
+    realpath2paths = {}
+    for path in set(paths):
+        if os.path.exists(path):
+            realpath2paths.setdefault(os.path.realpath(path), []).append(path)
+    
+    # Scan every file descriptor of every process
+    realpath2pids = dict((realpath, []) for realpath in realpath2paths)
+    if check_users:
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            fd_dir = os.path.join('/proc', pid, 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                # The process exited, or belongs to another user
+                continue
+            
+            for fd in fds:
+                try:
+                    target = os.readlink(os.path.join(fd_dir, fd))
+                except OSError:
+                    continue
+                if target in realpath2pids:
+                    realpath2pids[target].append(pid)
+    
+    res = dict((path, ('does not exist', '')) for path in paths)
+    for realpath, matching_paths in realpath2paths.items():
+        pids = sorted(set(realpath2pids[realpath]), key=int)
+        if not check_users:
+            result = 'unk', ''
+        elif len(pids) > 0:
+            result = 'in use', ' '.join(pids)
         else:
-            result = 'unknown error 1'
-    else:
-        result = 'unknown error'
+            result = 'not in use', ''
+        for path in matching_paths:
+            res[path] = result
+    return res
+
+class DeviceProbeWorker(QtCore.QObject):
+    """Probes the arduinos and cameras in a background thread
     
-    return result, pid_string
+    Connect a signal to probe, and the results come back through the
+    probed signal, so the GUI never waits on the probe.
+    """
+    probed = QtCore.pyqtSignal(object)
+    
+    @QtCore.pyqtSlot(object)
+    def probe(self, paths):
+        # Always answer, even if the probe fails, or the GUI would wait
+        # for this probe forever and never start another one
+        path2result = {}
+        try:
+            # Also every arduino and camera attached, known or not
+            all_paths = set(paths)
+            all_paths.update(glob.glob('/dev/ttyACM*'))
+            all_paths.update(glob.glob('/dev/video*'))
+            
+            path2result = probe_device_users(all_paths,
+                check_users=not MINIMIZE_NETWORKING)
+        finally:
+            self.probed.emit(path2result)
 
 # Hack, see below
 tz = pytz.timezone('US/Eastern')
 
+# Only include sessions from at least this recent
+# This should be longer than the max vacation time
+RECENCY_DAYS = 21
+
+def get_latest_sessions(recency_cutoff):
+    """Return the latest session of each mouse in training
+    
+    Only sessions on or after the date recency_cutoff are considered, so
+    mice that have not run since then are left out. The mouse, box, and
+    board of each session are fetched in the same query.
+    
+    Returns: list of Session, in no particular order
+    """
+    sessions_qs = runner.models.Session.objects.filter(
+        mouse__in_training=True,
+        date_time_start__date__gte=recency_cutoff,
+        ).select_related('mouse', 'box', 'board')
+    
+    if connection.features.can_distinct_on_fields:
+        # postgres can pick the latest of each mouse itself
+        return list(sessions_qs.order_by(
+            'mouse_id', '-date_time_start').distinct('mouse_id'))
+    
+    # Otherwise keep the last of each mouse in date order
+    mouse_id2session = {}
+    for session in sessions_qs.order_by('date_time_start'):
+        mouse_id2session[session.mouse_id] = session
+    return mouse_id2session.values()
+
 
 # Load the Qt Creator stuff and use it to generate class definitions
 qtCreatorFile = os.path.join(os.path.split(__file__)[0], 
@@ -119,6 +186,72 @@ Ui_MainWindow, QtBaseClass = uic.loadUiType(qtCreatorFile)
 # This is used for polling for sandboxes that have started
 sandbox_root = os.path.expanduser('~/sandbox_root')
 
+# Sandboxes are named like 2016-08-01-14-05-30-KF145-B1 and stored in
+# EYM format: experimenter/year/month/sandbox. When the session is
+# saved, "-saved" is appended.
+SAVED_SANDBOX_SUFFIX = '-saved'
+
+# Sandboxes started before this hour count as the previous day
+DAY_START_HOUR = 4
+
+class SandboxIndex(object):
+    """Which mice have started or saved a session today
+    
+    Each update lists the month directory of each experimenter once, and
+    only parses the sandboxes that are new since the last update. The
+    index starts over when the date changes.
+    """
+    def __init__(self, sandbox_root):
+        self.sandbox_root = sandbox_root
+        self.date = None
+    
+    def update(self):
+        """Add any sandboxes created or saved since the last update"""
+        now = datetime.datetime.now()
+        if now.date() != self.date:
+            self.date = now.date()
+            self.date_string = now.strftime('%Y-%m-%d')
+            self.seen = set()
+            self.mouse2state = {}
+        
+        month_dirs = glob.glob(os.path.join(self.sandbox_root,
+            '*', str(now.year), '%02d' % now.month))
+        for month_dir in month_dirs:
+            try:
+                sandbox_names = os.listdir(month_dir)
+            except OSError:
+                continue
+            
+            for sandbox_name in sandbox_names:
+                if sandbox_name not in self.seen:
+                    self.seen.add(sandbox_name)
+                    self.add(sandbox_name)
+    
+    def add(self, sandbox_name):
+        """Record the state of the mouse of sandbox_name, if from today"""
+        if not sandbox_name.startswith(self.date_string + '-'):
+            return
+        
+        split = sandbox_name.split('-')
+        try:
+            hour_int = int(split[3])
+            mouse_name = split[6]
+        except (IndexError, ValueError):
+            # Parse error
+            return
+        if hour_int < DAY_START_HOUR:
+            return
+        
+        # A saved sandbox outranks a started one
+        if sandbox_name.endswith(SAVED_SANDBOX_SUFFIX):
+            self.mouse2state[mouse_name] = 'saved'
+        else:
+            self.mouse2state.setdefault(mouse_name, 'started')
+    
+    def get_state(self, mouse_name):
+        """Returns 'saved', 'started', or None if not started today"""
+        return self.mouse2state.get(mouse_name)
+
 # Helper functions
 def create_combo_box(choice_l, index=None, choice=None):
     qcb = QComboBox()
@@ -130,6 +263,11 @@ def create_combo_box(choice_l, index=None, choice=None):
     return qcb
 
 def call_external(mouse, board, box, **other_python_parameters):
+    """Upload to the box and start the session
+    
+    Returns: True if the session was started, False if the box was not
+        available
+    """
     # Make sure the arduino is available
     box_obj = runner.models.Box.objects.filter(name=box).first()
     arduino = box_obj.serial_port
@@ -140,23 +278,90 @@ def call_external(mouse, board, box, **other_python_parameters):
     
     if not MINIMIZE_NETWORKING:
         # Check before uploading
-        result, pid_string = probe_arduino_user(arduino)
+        result, pid_string = probe_device_users([arduino])[arduino]
     
         if result == 'in use':
             print "cannot upload to box %s; in use by these PIDs: %s" % (
                 box, pid_string)
-            return
+            return False
 
         elif result != 'not in use':
             print "cannot upload to box %s: %s" % (box, result)
-            return
+            return False
     
     print mouse, board, box, experimenter
     ArduFSM.Runner.start_runner_cli.main(mouse=mouse, board=board, box=box,
         experimenter=experimenter,
         **other_python_parameters)
+    return True
+
+# Start at most this many sessions at once
+MAX_CONCURRENT_LAUNCHES = 4
+
+class SessionLauncher(QtCore.QObject):
+    """Starts sessions in background threads
+    
+    Sessions on different serial ports start concurrently, up to
+    MAX_CONCURRENT_LAUNCHES at once, whereas sessions on the same serial
+    port wait for each other. The progress of each session is sent
+    through state_changed as (mouse, state), where state is one of:
+        'queued' : waiting for the serial port or a free slot
+        'uploading' : compiling and uploading, see call_external
+        'running' : the session started
+        'failed' : the box was not available, or there was an error
+    """
+    state_changed = QtCore.pyqtSignal(object, object)
+    
+    def __init__(self, max_concurrent=MAX_CONCURRENT_LAUNCHES, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.lock = threading.Lock()
+        self.port2lock = {}
+        self.active_mice = set()
+    
+    def launch(self, mouse, serial_port, **call_external_kwargs):
+        """Start a session for mouse in the background
+        
+        serial_port : used to keep sessions on the same port apart
+        call_external_kwargs : passed to call_external
+        
+        Returns: False if this mouse is already being started, else True
+        """
+        with self.lock:
+            if mouse in self.active_mice:
+                return False
+            self.active_mice.add(mouse)
+            port_lock = self.port2lock.setdefault(
+                serial_port, threading.Lock())
+        
+        self.state_changed.emit(mouse, 'queued')
+        thread = threading.Thread(target=self.run,
+            args=(mouse, port_lock, call_external_kwargs))
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    def run(self, mouse, port_lock, call_external_kwargs):
+        state = 'failed'
+        try:
+            with port_lock:
+                with self.slots:
+                    self.state_changed.emit(mouse, 'uploading')
+                    if call_external(mouse=mouse, **call_external_kwargs):
+                        state = 'running'
+        except Exception:
+            traceback.print_exc()
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+            with self.lock:
+                self.active_mice.discard(mouse)
+            self.state_changed.emit(mouse, state)
 
 class MyApp(QtGui.QMainWindow, Ui_MainWindow):
+    # Sends the devices to probe to DeviceProbeWorker
+    probe_requested = QtCore.pyqtSignal(object)
+    
     def __init__(self):
         QtGui.QMainWindow.__init__(self)
         Ui_MainWindow.__init__(self)
@@ -183,6 +388,22 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
         self.toolbar.addAction(self.move_up_action)
         self.toolbar.addAction(self.move_down_action)
         
+        # Probe devices in a separate thread, because it may be slow
+        self.probe_pending = False
+        self.probe_thread = QtCore.QThread(self)
+        self.probe_worker = DeviceProbeWorker()
+        self.probe_worker.moveToThread(self.probe_thread)
+        self.probe_requested.connect(self.probe_worker.probe)
+        self.probe_worker.probed.connect(self.show_attached_devices)
+        self.probe_thread.start()
+        
+        # Start sessions in the background
+        self.launcher = SessionLauncher(parent=self)
+        self.launcher.state_changed.connect(self.show_launch_state)
+        
+        # Sandboxes started today
+        self.sandbox_index = SandboxIndex(sandbox_root)
+        
         # Timer to refresh data
         self.timer = QtCore.QTimer(self)
         self.timer.timeout.connect(self.poll_sessions)
@@ -194,93 +415,63 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
         We don't have a list of sandboxes that were created, so just look
         for anything with today's date.
         """
-        now = datetime.datetime.now()
-        date_string = now.strftime('%Y-%m-%d')
+        self.sandbox_index.update()
         
         for nrow in range(self.daily_plan_table.rowCount()):
             # Get the mouse in this row
             mouse_name_item = self.daily_plan_table.item(nrow, 0)
             if mouse_name_item is None:
                 continue
-            mouse_name = mouse_name_item.text()
-            
-            # Check if sandbox exists
-            # Use EYM format here
-            sandboxes = glob.glob(os.path.join(sandbox_root, 
-                '*', str(now.year), '%02d' % now.month, # EYM
-                '%s-*-%s-*' % (date_string, mouse_name)))
-            saved_sandboxes = glob.glob(os.path.join(sandbox_root, 
-                '*', str(now.year), '%02d' % now.month, # EYM
-                '%s-*-%s-*-saved' % (date_string, mouse_name)))  
-            
-            # Ignore if it was before 4AM
-            def is_after_4am(sandbox_name):
-                """Returns True if the sandbox was after 4am.
-                
-                Returns False if before 4am or if parse error.
-                """
-                dirname = os.path.split(sandbox_name)[1]
-                split = dirname.split('-')
-                try:
-                    hour_int = int(split[3])
-                except (IndexError, ValueError):
-                    # Parse error
-                    return False
-                
-                if hour_int >= 4:
-                    return True
-                else:
-                    return False
-            
-            sandboxes = filter(is_after_4am, sandboxes)
-            saved_sandboxes = filter(is_after_4am, saved_sandboxes)
+            mouse_name = str(mouse_name_item.text())
+            sandbox_state = self.sandbox_index.get_state(mouse_name)
         
             # Get the pushbutton
             qb = self.daily_plan_table.cellWidget(nrow, 6)
             if qb is not None:
                 # Set green if done, red if started
-                if len(saved_sandboxes) > 0:
+                if sandbox_state == 'saved':
                     # Saved
                     qb.setStyleSheet("background-color: green")
-                elif len(sandboxes) > 0:
+                elif sandbox_state == 'started':
                     # Started but not saved
                     qb.setStyleSheet("background-color: red")
                 else:
                     # Not started
                     pass
         
-        # Poll attached boxes
-        attached_arduinos = []
-        attached_cameras = []
-        zobj = zip(self.relevant_box_names, self.relevant_box_arduinos,
-            self.relevant_box_cameras)
-            
-        for box_name, arduino, camera in zobj:
-            if os.path.exists(arduino):
-                attached_arduinos.append(arduino)
-
-            if os.path.exists(camera):
-                attached_cameras.append(camera)
+        # Poll attached boxes in the background, unless still polling
+        if not self.probe_pending:
+            self.probe_pending = True
+            self.probe_requested.emit([path for path in
+                self.relevant_box_arduinos + self.relevant_box_cameras
+                if path])
+    
+    def show_attached_devices(self, path2result):
+        """Display the arduinos and cameras found by DeviceProbeWorker"""
+        self.probe_pending = False
         
-        # Format into something like "ACM0 (B0 or B1)"
+        # Format into something like "ACM0 (not in use; B0/B1)"
         attached_arduino_strings = []
-        for arduino in np.unique(attached_arduinos):
+        for arduino in np.unique(self.relevant_box_arduinos):
+            arduino_status, pid_string = path2result.get(
+                arduino, ('does not exist', ''))
+            if arduino_status == 'does not exist':
+                continue
+            
             matching_box_names = [self.relevant_box_names[n] 
                 for n in range(len(self.relevant_box_arduinos))
                 if self.relevant_box_arduinos[n] == arduino 
             ]
-            
-            if MINIMIZE_NETWORKING:
-                arduino_status = 'unk'                
-            else:
-                arduino_status, pid_string = probe_arduino_user(arduino)
-
             attached_arduino_strings.append('%s (%s; %s)' % (
                 arduino[-4:], arduino_status, '/'.join(matching_box_names)))
 
-        # Format into something like "video0 (B0 or B1)"
+        # Format into something like "video0 (B0/B1)"
         attached_camera_strings = []
-        for camera in np.unique(attached_cameras):
+        for camera in np.unique(self.relevant_box_cameras):
+            if path2result.get(camera, ('does not exist', ''))[0] == (
+                'does not exist'):
+                continue
+            
             matching_box_names = [self.relevant_box_names[n] 
                 for n in range(len(self.relevant_box_cameras))
                 if self.relevant_box_cameras[n] == camera 
@@ -288,18 +479,26 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
             attached_camera_strings.append('%s (%s)' % (
                 camera[-6:], '/'.join(matching_box_names)))
         
-        # Also poll any attached arduinos that do NOT correspond to known boxes
-        for ardunum in range(10):
-            ardupath = '/dev/ttyACM%d' % ardunum
-            if ardupath not in self.relevant_box_arduinos:
-                if os.path.exists(ardupath):
-                    attached_arduino_strings.append(ardupath)
+        # Also any attached arduinos that do NOT correspond to known boxes
+        for ardupath, (arduino_status, pid_string) in sorted(
+            path2result.items()):
+            if (ardupath.startswith('/dev/ttyACM') and 
+                ardupath not in self.relevant_box_arduinos and
+                arduino_status != 'does not exist'):
+                attached_arduino_strings.append('%s (%s)' % (
+                    ardupath, arduino_status))
         
         self.attached_boxes_display.setText(
             '\n'.join(attached_arduino_strings))
         self.attached_cameras_display.setText(
             '\n'.join(attached_camera_strings))
     
+    def closeEvent(self, event):
+        # Let the probe finish before the thread is destroyed
+        self.probe_thread.quit()
+        self.probe_thread.wait()
+        QtGui.QMainWindow.closeEvent(self, event)
+    
     def set_table_data(self):
         # Date of most recent session
         # Hack because the datetimes are coming back as aware but in UTC?
@@ -310,49 +509,30 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
         self.target_date_display.setText(target_date.strftime('%Y-%m-%d'))
         
         # Only include sessions from at least this recent
-        # This should be longer than the max vacation time
-        recency_cutoff = target_date - datetime.timedelta(days=21)
-        
-        # Get all mice that are in training
-        mice_qs = runner.models.Mouse.objects.filter(in_training=True)
+        recency_cutoff = target_date - datetime.timedelta(days=RECENCY_DAYS)
         
-        # Get previous session from each mouse
+        # Get previous session from each mouse in training, all at once
         previous_sessions = []
         previous_sessions_sort_keys = []
-        new_mice = []
-        for mouse in mice_qs.all():
-            # Find previous sessions from this mouse from all boxes,
-            # sorted by date and excluding ancient ones
-            mouse_prev_sess_qs = runner.models.Session.objects.filter(
-                mouse=mouse,
-                date_time_start__date__gte=recency_cutoff,).order_by(
-                'date_time_start')
+        for sess in get_latest_sessions(recency_cutoff):
+            # Skip if the last session was not in LOCALE_BOXES, that is, 
+            # if it was trained on some other setup
+            if sess.box.name not in LOCALE_BOXES:
+                continue
             
-            # Store the most recent, or if None, add to new_mice
-            if mouse_prev_sess_qs.count() > 0:
-                # The most recent
-                sess = mouse_prev_sess_qs.last()
-                
-                # Skip if the last session was not in LOCALE_BOXES, that is, 
-                # if it was trained on some other setup
-                if sess.box.name not in LOCALE_BOXES:
-                    continue
-                
-                # Store sess
-                previous_sessions.append(sess)
-                
-                # Store these sort keys to enable sorting
-                # Index into LOCALE_BOXES
-                previous_sessions_board_idx = LOCALE_BOXES.index(sess.box.name)
-                
-                # date time start
-                dtstart = sess.date_time_start
-                
-                # sort keys
-                previous_sessions_sort_keys.append(
-                    (previous_sessions_board_idx, dtstart))
-            else:
-                new_mice.append(mouse)
+            # Store sess
+            previous_sessions.append(sess)
+            
+            # Store these sort keys to enable sorting
+            # Index into LOCALE_BOXES
+            previous_sessions_board_idx = LOCALE_BOXES.index(sess.box.name)
+            
+            # date time start
+            dtstart = sess.date_time_start
+            
+            # sort keys
+            previous_sessions_sort_keys.append(
+                (previous_sessions_board_idx, dtstart))
         
         # Incantantion to sort previous_sessions by sort keys
         previous_sessions = [x for junk, x in sorted(zip(
@@ -364,11 +544,13 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
             runner.models.Board.objects.all().values_list('name', flat=True))
         
         # Get box arduinos and cameras for polling
+        name2box = dict((box.name, box) for box in 
+            runner.models.Box.objects.filter(name__in=box_l))
         self.relevant_box_names = []
         self.relevant_box_arduinos = []
         self.relevant_box_cameras = []
         for box_name in box_l:
-            box = runner.models.Box.objects.filter(name=box_name).first()
+            box = name2box[box_name]
             self.relevant_box_names.append(box_name)
             self.relevant_box_arduinos.append(box.serial_port)
             self.relevant_box_cameras.append(box.video_device)
@@ -443,7 +625,7 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
             self.daily_plan_table.setItem(nrow, 8, item)
 
     def start_session(self, row):
-        """Collect data from row and pass to start session"""
+        """Collect data from row and start the session in the background"""
         # Highlight clicked cell
         self.daily_plan_table.setCurrentCell(row, 6)
         
@@ -451,16 +633,32 @@ class MyApp(QtGui.QMainWindow, Ui_MainWindow):
         box_name = str(self.daily_plan_table.cellWidget(row, 2).currentText())
         fig_color = LOCALE_BOX2COLOR[box_name]
         
+        # Sessions on the same serial port are started one at a time
+        serial_port = self.relevant_box_arduinos[
+            self.relevant_box_names.index(box_name)]
+        
         # Call
-        call_external(
+        self.launcher.launch(
             mouse=str(self.daily_plan_table.item(row, 0).text()),
+            serial_port=serial_port,
             board=str(self.daily_plan_table.cellWidget(row, 3).currentText()),
-            box=str(self.daily_plan_table.cellWidget(row, 2).currentText()),
+            box=box_name,
             #~ recent_date=str(self.target_date_display.getText()),
             recent_weight=str(self.daily_plan_table.item(row, 1).text()),
             recent_pipe=str(self.daily_plan_table.item(row, 4).text()),
             background_color=fig_color,
         )
+    
+    def show_launch_state(self, mouse, state):
+        """Show the state from SessionLauncher on the mouse's button"""
+        for nrow in range(self.daily_plan_table.rowCount()):
+            mouse_name_item = self.daily_plan_table.item(nrow, 0)
+            if mouse_name_item is None or str(mouse_name_item.text()) != mouse:
+                continue
+            
+            qb = self.daily_plan_table.cellWidget(nrow, 6)
+            if qb is not None:
+                qb.setText(state.capitalize())
 
     def start_session2(self, row_qb):
         """Start the session associated with the push button for this row.
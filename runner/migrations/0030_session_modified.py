@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 13:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('runner', '0029_auto_20190312_1326'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
@@ -305,6 +305,10 @@ class Session(models.Model):
     # Link to GrandSession
     grand_session = models.OneToOneField(GrandSession, null=True, blank=True)
 
+    # When this row was last written, used to invalidate cached plots
+    # Null for sessions that have not been saved since this was added
+    modified = models.DateTimeField(auto_now=True, null=True)
+
     def __str__(self):
         if self.name:
             return str(self.name)
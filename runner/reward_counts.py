@@ -0,0 +1,76 @@
+"""Count the rewards in a behavior logfile
+
+Splitting the lines of a logfile into trials and counting the rewards
+in each trial need ArduFSM, so they are given to these functions, as
+ArduFSM.TrialSpeak.split_by_trial and ArduFSM.plot.count_rewards.
+
+split_by_trial : function taking a list of lines and returning a list of
+    trials, each a list of lines. The first trial is the lines before the
+    first trial start, and each of the rest begins with a trial start.
+count_rewards : function taking a list of trials and returning a
+    DataFrame with one row per trial and one column per reward type,
+    named side + ' ' + type (eg 'left auto')
+"""
+import itertools
+
+# The reward types counted by count_rewards
+REWARD_TYPES = ['auto', 'manual', 'direct']
+
+def iter_trial_chunks(logfile, split_by_trial, chunk_size=10000):
+    """Yield the trials in logfile a chunk at a time
+
+    Together the chunks are the same as split_by_trial of every line in
+    logfile, but only about chunk_size lines (plus the longest trial) are
+    held in memory at once. Each chunk of lines is split on its own. The
+    lines before its first trial start finish the trial carried over from
+    the last chunk, and its last trial, which may not be finished, is
+    carried over to the next chunk.
+
+    Yields: lists of trials, each of which is a list of lines
+    """
+    carried_trial = []
+    with file(logfile) as fi:
+        while True:
+            lines = list(itertools.islice(fi, chunk_size))
+            if len(lines) == 0:
+                break
+
+            splines = split_by_trial(lines)
+            carried_trial.extend(splines[0])
+            if len(splines) > 1:
+                yield [carried_trial] + splines[1:-1]
+                carried_trial = splines[-1]
+
+    # The last trial is finished by the end of the file
+    yield [carried_trial]
+
+def count_rewards_streaming(logfile, split_by_trial, count_rewards,
+    chunk_size=10000):
+    """Count each type of reward in logfile, reading it in one pass
+
+    Returns: dict from column of count_rewards (eg 'left auto')
+        to the total number of those rewards in the logfile
+    """
+    rewcounts = dict(
+        (side + ' ' + typ, 0)
+        for side in ['left', 'right'] for typ in REWARD_TYPES)
+
+    for trials in iter_trial_chunks(logfile, split_by_trial, chunk_size):
+        rewdict = count_rewards(trials)
+        for column in rewcounts.keys():
+            rewcounts[column] += rewdict[column].sum()
+
+    return rewcounts
+
+def count_rewards_in_memory(logfile, split_by_trial, count_rewards):
+    """Count each type of reward in logfile, after reading all of it
+
+    This is the original method, kept as a reference for
+    count_rewards_streaming, which returns the same thing.
+    """
+    with file(logfile) as fi:
+        lines = fi.readlines()
+    rewdict = count_rewards(split_by_trial(lines))
+    return dict(
+        (side + ' ' + typ, rewdict[side + ' ' + typ].sum())
+        for side in ['left', 'right'] for typ in REWARD_TYPES)
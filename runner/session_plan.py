@@ -0,0 +1,210 @@
+"""Start many behavioral sessions at once, as planned
+
+A plan is a list of sessions to start, each a dict with keys board, box,
+and mouse. It can be read from a file with one session per line, as
+mouse, board, and box separated by spaces or commas. Lines starting
+with # are ignored.
+
+Starting a session takes three stages, which need ArduFSM and so are
+given to run_plan as functions, like those in the
+start_runner_by_board_etc command. The first two run in worker
+processes, so they must be picklable, ie defined at module level.
+"""
+import re
+import time
+import traceback
+import multiprocessing
+from django.db import connection
+
+import runner.models
+
+def read_plan(plan_path):
+    """Read the sessions to start from a file, see the top of this file
+
+    Returns: list of dicts with keys board, box, mouse
+    """
+    plan = []
+    with file(plan_path) as fi:
+        for line in fi:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+
+            fields = re.split(r'[\s,]+', line)
+            if len(fields) != 3:
+                raise ValueError("cannot parse plan line: %s" % line)
+            mouse, board, box = [field.upper() for field in fields]
+            plan.append({'mouse': mouse, 'board': board, 'box': box})
+    return plan
+
+def run_timed(func, *args):
+    """Call func in a worker process, catching any error
+
+    Returns: result, elapsed time in seconds, error string or None
+    """
+    start_time = time.time()
+    try:
+        result = func(*args)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    return result, time.time() - start_time, error
+
+def prepare_session_timed(prepare_args):
+    """Prepare one session with run_timed
+
+    prepare_args : prepare, user_input
+    """
+    prepare, user_input = prepare_args
+    return run_timed(prepare, user_input)
+
+def upload_sessions_timed(port_sessions):
+    """Compile and upload each of sessions in turn, as they share a port
+
+    port_sessions : serial_port, sessions, upload
+        sessions is a list of (sandbox_paths, specific_parameters)
+
+    Returns: list of (result, elapsed time, error) as from run_timed,
+        where result is as from upload
+    """
+    serial_port, sessions, upload = port_sessions
+    return [run_timed(upload, sandbox_paths, specific_parameters,
+        serial_port)
+        for sandbox_paths, specific_parameters in sessions]
+
+def run_plan(plan, prepare, upload, start, processes=None):
+    """Start every session in plan, doing as much as possible in parallel
+
+    1. Sandboxes are prepared in up to `processes` processes at once.
+    2. Sessions are compiled and uploaded in one process per serial port,
+        so that no two uploads go to the same arduino.
+    3. The Python scripts are started in the order of plan.
+
+    A session that fails at one stage is skipped by the later ones.
+
+    plan : list of dicts with keys board, box, mouse
+    prepare : function taking a dict with the keys of plan and
+        experimenter, and returning sandbox_paths, specific_parameters
+    upload : function taking sandbox_paths, specific_parameters, and
+        serial_port, and returning how the sketch was built
+    start : function taking sandbox_paths and specific_parameters
+    processes : number of processes to prepare with, defaults to the
+        number of CPUs
+
+    Returns: reports, stage_times
+        reports : list of dicts, one per session in plan, with the keys
+            of plan, the time in seconds of each stage (None if not
+            reached), build, as returned by upload, and error, the
+            reason for failing or None
+        stage_times : dict from stage to its wall clock time in seconds
+    """
+    # Look everything up in the database at once
+    name2mouse = dict((mouse.name, mouse) for mouse in
+        runner.models.Mouse.objects.filter(
+        name__in=[user_input['mouse'] for user_input in plan]))
+    name2box = dict((box.name, box) for box in
+        runner.models.Box.objects.filter(
+        name__in=[user_input['box'] for user_input in plan]))
+
+    reports = []
+    for user_input in plan:
+        report = dict(user_input, prepare=None, upload=None, start=None,
+            build=None, error=None)
+        if user_input['mouse'] not in name2mouse:
+            report['error'] = "no mouse named %s" % user_input['mouse']
+        elif user_input['box'] not in name2box:
+            report['error'] = "no box named %s" % user_input['box']
+        else:
+            report['experimenter'] = (
+                name2mouse[user_input['mouse']].get_experimenter_display())
+        reports.append(report)
+
+    # Worker processes open their own connections
+    connection.close()
+
+    ## Prepare in parallel
+    to_prepare = [report for report in reports if report['error'] is None]
+    stage_times = {}
+    start_time = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(prepare_session_timed, [
+            (prepare, dict((key, report[key]) for key in
+            ['board', 'box', 'mouse', 'experimenter']))
+            for report in to_prepare])
+    finally:
+        pool.close()
+        pool.join()
+    stage_times['prepare'] = time.time() - start_time
+
+    # Group what was prepared by serial port
+    prepared_l = []
+    port2prepared = {}
+    for report, (prepared, elapsed, error) in zip(to_prepare, results):
+        report['prepare'] = elapsed
+        report['error'] = error
+        if error is None:
+            prepared_l.append((report, prepared))
+            port2prepared.setdefault(
+                name2box[report['box']].serial_port, []).append(
+                (report, prepared))
+
+    ## Compile and upload in parallel, one process per port
+    start_time = time.time()
+    if len(port2prepared) > 0:
+        port_prepared_l = port2prepared.items()
+        pool = multiprocessing.Pool(len(port_prepared_l))
+        try:
+            port_results = pool.map(upload_sessions_timed, [
+                (serial_port, [prepared for report, prepared in
+                prepared_on_port], upload)
+                for serial_port, prepared_on_port in port_prepared_l])
+        finally:
+            pool.close()
+            pool.join()
+
+        for (serial_port, prepared_on_port), results in zip(
+            port_prepared_l, port_results):
+            for (report, prepared), (build, elapsed, error) in zip(
+                prepared_on_port, results):
+                report['build'] = build
+                report['upload'] = elapsed
+                report['error'] = error
+    stage_times['upload'] = time.time() - start_time
+
+    ## Start the scripts
+    start_time = time.time()
+    for report, prepared in prepared_l:
+        if report['error'] is None:
+            junk, report['start'], report['error'] = run_timed(
+                start, *prepared)
+    stage_times['start'] = time.time() - start_time
+
+    return reports, stage_times
+
+def format_timings(reports, stage_times):
+    """Return a table of the time of each stage of each session"""
+    def format_time(elapsed):
+        if elapsed is None:
+            return '-'
+        return '%0.1f' % elapsed
+
+    lines = ['%-10s %-6s %-6s %8s %8s %8s  %s' % (
+        'mouse', 'board', 'box', 'prepare', 'upload', 'start', 'status')]
+    for report in reports:
+        if report['error'] is not None:
+            status = 'failed'
+        elif report['build'] == 'cached':
+            status = 'ok (cached)'
+        else:
+            status = 'ok'
+        lines.append('%-10s %-6s %-6s %8s %8s %8s  %s' % (
+            report['mouse'], report['board'], report['box'],
+            format_time(report['prepare']), format_time(report['upload']),
+            format_time(report['start']), status))
+    lines.append('%-24s %8s %8s %8s' % ('total (wall clock)',
+        format_time(stage_times['prepare']),
+        format_time(stage_times['upload']),
+        format_time(stage_times['start'])))
+    return '\n'.join(lines)
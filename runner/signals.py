@@ -0,0 +1,30 @@
+"""Signal receivers for the runner app
+
+These are connected in RunnerConfig.ready.
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from taggit.models import Tag, TaggedItem
+
+from .models import Board, Box, GrandSession, Mouse, Session
+from . import caches
+
+@receiver([post_save, post_delete], sender=Session)
+@receiver([post_save, post_delete], sender=Mouse)
+def invalidate_weight_plot(sender, **kwargs):
+    """Weights and cohorts both feed into the weight plot"""
+    caches.invalidate_weight_plot()
+
+@receiver([post_save, post_delete], sender=Mouse)
+@receiver([post_save, post_delete], sender=Board)
+@receiver([post_save, post_delete], sender=Box)
+def invalidate_filter_choices(sender, **kwargs):
+    """These are listed in the admin sidebar filters"""
+    caches.invalidate_filter_choices(sender)
+
+@receiver([post_save, post_delete], sender=TaggedItem)
+@receiver([post_save, post_delete], sender=Tag)
+@receiver(post_delete, sender=GrandSession)
+def invalidate_grand_session_tag_index(sender, **kwargs):
+    """Tagging, untagging, renaming a tag, or deleting a tagged object"""
+    caches.invalidate_grand_session_tag_index()
@@ -0,0 +1,173 @@
+"""Cache of compiled sketches, so unchanged sketches are not recompiled
+
+A sandbox's sketch is the protocol copied from ArduFSM plus the config
+header with the C parameters, so it is mostly the same from one day to
+the next. Compiled sketches are stored by a hash of every file in the
+sketch, of every file in the libraries it is compiled with, and of the
+build parameters, which include the board type. When a sandbox hashes to
+a sketch that was already compiled, the stored hex file is uploaded
+directly instead, with avrdude.
+
+Sketches for a board type that is not in AVRDUDE_SETTINGS, or compiled
+with a library that cannot be found, are always compiled.
+"""
+import os
+import glob
+import fnmatch
+import json
+import shutil
+import hashlib
+import subprocess
+
+# Where compiled sketches are stored, as <key>.hex
+SKETCH_CACHE_ROOT = os.path.expanduser('~/.mouse-cloud/sketch_cache')
+
+# Build products are written to directories like this in the sketch,
+# which are not part of the hash
+BUILD_DIR_PATTERN = 'build-*'
+
+# How avrdude uploads to each board type, which is the 'board' build
+# parameter, as the BOARD_TAG of the Arduino makefile
+AVRDUDE_SETTINGS = {
+    'uno': {'part': 'atmega328p', 'programmer': 'arduino', 'baud': 115200},
+    'mega2560': {
+        'part': 'atmega2560', 'programmer': 'wiring', 'baud': 115200},
+}
+
+def get_avrdude_command(build_parameters):
+    """Return the command that uploads a hex file for these parameters
+
+    The port and the file still need to be added. Returns None if the
+    board type is not in AVRDUDE_SETTINGS.
+    """
+    settings = AVRDUDE_SETTINGS.get(build_parameters.get('board'))
+    if settings is None:
+        return None
+    return ['avrdude', '-p', settings['part'], '-c', settings['programmer'],
+        '-b', str(settings['baud']), '-D']
+
+def hash_directory(dir_path):
+    """Return a hash of every file in dir_path, skipping build products"""
+    sha = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(dir_path):
+        # Walk in a fixed order, skipping build products
+        dirnames[:] = sorted(dirname for dirname in dirnames
+            if not fnmatch.fnmatch(dirname, BUILD_DIR_PATTERN))
+
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            with file(path, 'rb') as fi:
+                contents = fi.read()
+            sha.update('%s\0%d\0' % (
+                os.path.relpath(path, dir_path), len(contents)))
+            sha.update(contents)
+    return sha.hexdigest()
+
+def hash_sketch(sketch_path, build_parameters, library_paths=()):
+    """Return a key of everything that goes into compiling a sketch
+
+    sketch_path : directory of the sketch, hashed file by file
+    build_parameters : dict of build parameters, including the board
+    library_paths : directories of the libraries the sketch is compiled
+        with, also hashed file by file
+    """
+    sha = hashlib.sha1()
+    for dir_path in [sketch_path] + list(library_paths):
+        sha.update(hash_directory(dir_path))
+
+    sha.update(json.dumps(build_parameters, sort_keys=True, default=str))
+    return sha.hexdigest()
+
+def find_hex(sketch_path):
+    """Return the hex file compiled from the sketch, or None"""
+    hex_paths = [hex_path for hex_path in
+        glob.glob(os.path.join(sketch_path, BUILD_DIR_PATTERN, '*.hex')) +
+        glob.glob(os.path.join(sketch_path, '*.hex'))
+        if not hex_path.endswith('.with_bootloader.hex')]
+    if len(hex_paths) == 0:
+        return None
+    return max(hex_paths, key=os.path.getmtime)
+
+def get_cached_hex(key, cache_root=SKETCH_CACHE_ROOT):
+    """Return the path to the hex file stored under key, or None"""
+    hex_path = os.path.join(cache_root, key + '.hex')
+    if os.path.exists(hex_path):
+        return hex_path
+    return None
+
+def put_cached_hex(key, hex_path, cache_root=SKETCH_CACHE_ROOT):
+    """Store a copy of hex_path under key
+
+    The file is replaced at once, so readers never see half a file.
+    """
+    if not os.path.exists(cache_root):
+        try:
+            os.makedirs(cache_root)
+        except OSError:
+            # Another process uploading to another port may have made it
+            if not os.path.isdir(cache_root):
+                raise
+
+    cached_path = os.path.join(cache_root, key + '.hex')
+    temp_path = '%s.%d.tmp' % (cached_path, os.getpid())
+    shutil.copyfile(hex_path, temp_path)
+    os.rename(temp_path, cached_path)
+
+def upload_hex(hex_path, serial_port, avrdude_command):
+    """Upload a compiled sketch to the Arduino on serial_port
+
+    avrdude_command : as from get_avrdude_command
+    """
+    subprocess.check_call(avrdude_command + [
+        '-P', serial_port, '-U', 'flash:w:%s:i' % hex_path])
+
+def compile_and_upload_cached(sandbox_paths, specific_parameters,
+    serial_port, compile_and_upload, library_paths=(),
+    cache_root=SKETCH_CACHE_ROOT, upload=upload_hex):
+    """Upload the sandbox's sketch, compiling it only if not cached
+
+    compile_and_upload : function taking sandbox_paths and
+        specific_parameters, like ArduFSM.Runner.Sandbox.compile_and_upload
+    library_paths : directories of the libraries the sketch is compiled
+        with, see hash_sketch
+    upload : function taking a hex path, serial_port, and the avrdude
+        command, like upload_hex
+
+    Returns: 'cached' if a cached sketch was uploaded, or 'compiled'
+    """
+    build_parameters = specific_parameters['build']
+    avrdude_command = get_avrdude_command(build_parameters)
+    missing_paths = [library_path for library_path in library_paths
+        if not os.path.isdir(library_path)]
+
+    # A stored sketch can only be used if it can be uploaded, and if
+    # everything that went into it was hashed
+    if avrdude_command is None:
+        reason = "cannot upload to board %r with avrdude" % (
+            build_parameters.get('board'))
+    elif len(missing_paths) > 0:
+        reason = "no library directory %s" % ', '.join(missing_paths)
+    else:
+        reason = None
+    if reason is not None:
+        print "warning: %s, not caching the sketch" % reason
+        compile_and_upload(sandbox_paths, specific_parameters)
+        return 'compiled'
+
+    key = hash_sketch(
+        sandbox_paths['sketch'], build_parameters, library_paths)
+
+    cached_path = get_cached_hex(key, cache_root)
+    if cached_path is not None:
+        upload(cached_path, serial_port, avrdude_command)
+        return 'cached'
+
+    compile_and_upload(sandbox_paths, specific_parameters)
+
+    hex_path = find_hex(sandbox_paths['sketch'])
+    if hex_path is None:
+        print "warning: no hex file in %s, cannot cache it" % (
+            sandbox_paths['sketch'])
+    else:
+        put_cached_hex(key, hex_path, cache_root)
+    return 'compiled'
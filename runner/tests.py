@@ -1,3 +1,1043 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils import timezone
+import io
+import os
+import shutil
+import tempfile
+import datetime
+import sqlite3
+import random
+import json
+import pandas
+from unittest import skipIf
 
-# Create your tests here.
+import runner.models
+import runner.caches
+import runner.views
+import runner.colony
+import runner.sketch_cache
+import runner.reward_counts
+import runner.session_plan
+from runner.management.commands import copy_to_mouse_cloud, \
+    check_colony_drift
+import whisk_video.models
+import neural_sessions.models
+
+# put_new needs ArduFSM and MCwatch, which are only installed on the rigs
+try:
+    from runner.management.commands import put_new
+except ImportError:
+    put_new = None
+
+# make_labels needs pylabels and reportlab, which are only installed where
+# labels are printed
+try:
+    from runner.management.commands import make_labels
+except ImportError:
+    make_labels = None
+
+# The manifest storage needs collectstatic to have been run
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminTestCase(TestCase):
+    """Base class that logs in a superuser for the admin views"""
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+    
+    def count_changelist_queries(self, url):
+        """Return the number of queries used to render url"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+    
+    def count_warm_changelist_queries(self, url):
+        """Like count_changelist_queries, but after filling the caches"""
+        self.client.get(url)
+        return self.count_changelist_queries(url)
+
+class GrandSessionAdminTest(AdminTestCase):
+    url = '/admin/runner/grandsession/'
+    
+    def setUp(self):
+        super(GrandSessionAdminTest, self).setUp()
+        self.mouse = runner.models.Mouse.objects.create(
+            name='KF1', experimenter=0)
+    
+    def create_grand_sessions(self, n_grand_sessions):
+        """Create grand sessions with every type of linked session
+        
+        Every other one is left without links, to check that missing
+        links display as empty.
+        """
+        for n in range(n_grand_sessions):
+            name = 'gs%03d' % runner.models.GrandSession.objects.count()
+            grand_session = runner.models.GrandSession.objects.create(
+                name=name)
+            grand_session.tags.add('tag%d' % (n % 3))
+            if n % 2 == 1:
+                continue
+            
+            session = runner.models.Session.objects.create(name=name,
+                mouse=self.mouse, grand_session=grand_session)
+            runner.models.OptoSession.objects.create(
+                grand_session=grand_session, behavioral_session=session,
+                start_power=5, notes='opto')
+            whisk_video.models.VideoSession.objects.create(name=name,
+                bsession=session, grand_session=grand_session, notes='video')
+            neural_sessions.models.NeuralSession.objects.create(name=name,
+                bsession=session, grand_session=grand_session, notes='neural')
+    
+    def test_changelist_renders_missing_links(self):
+        self.create_grand_sessions(2)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '5mW')
+    
+    def test_changelist_queries_independent_of_rows(self):
+        self.create_grand_sessions(4)
+        n_queries_few = self.count_warm_changelist_queries(self.url)
+        
+        self.create_grand_sessions(20)
+        n_queries_many = self.count_warm_changelist_queries(self.url)
+        
+        self.assertEqual(n_queries_few, n_queries_many)
+
+class SessionAdminTest(AdminTestCase):
+    url = '/admin/runner/session/'
+    
+    def setUp(self):
+        super(SessionAdminTest, self).setUp()
+        self.mice = [runner.models.Mouse.objects.create(
+            name='KF%d' % n, experimenter=0) for n in range(3)]
+        self.boards = [runner.models.Board.objects.create(
+            name='CR%d' % n, has_side_HE_sensor=False) for n in range(3)]
+        self.boxes = [runner.models.Box.objects.create(
+            name='CR%d' % n, l_reward_duration=40, serial_port='/dev/ttyACM%d' % n)
+            for n in range(3)]
+    
+    def create_sessions(self, n_sessions):
+        for n in range(n_sessions):
+            runner.models.Session.objects.create(
+                name='session%03d' % runner.models.Session.objects.count(),
+                mouse=self.mice[n % 3], board=self.boards[n % 3],
+                box=self.boxes[n % 3])
+    
+    def test_changelist_queries_independent_of_rows(self):
+        self.create_sessions(3)
+        n_queries_few = self.count_warm_changelist_queries(self.url)
+        
+        self.create_sessions(30)
+        n_queries_many = self.count_warm_changelist_queries(self.url)
+        
+        self.assertEqual(n_queries_few, n_queries_many)
+    
+    def test_filter_choices_cached_until_written(self):
+        n_queries_uncached = self.count_changelist_queries(self.url)
+        n_queries_cached = self.count_changelist_queries(self.url)
+        self.assertEqual(n_queries_cached, n_queries_uncached - 3)
+        
+        # A new mouse should appear in the sidebar
+        runner.models.Mouse.objects.create(name='KF99', experimenter=0)
+        response = self.client.get(self.url)
+        self.assertContains(response, 'KF99')
+
+class WeightPlotTest(AdminTestCase):
+    url = '/weights'
+    
+    def setUp(self):
+        super(WeightPlotTest, self).setUp()
+        mouse = runner.models.Mouse.objects.create(
+            name='KF1', experimenter=0, in_training=True)
+        for n in range(3):
+            runner.models.Session.objects.create(name='session%d' % n,
+                mouse=mouse, user_data_weight=20 + n,
+                date_time_start=timezone.now() - datetime.timedelta(days=n))
+    
+    def get_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        return response['ETag']
+    
+    def test_not_modified(self):
+        etag = self.get_etag()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+    
+    def test_changed_weight_changes_etag(self):
+        etag = self.get_etag()
+        
+        session = runner.models.Session.objects.get(name='session0')
+        session.user_data_weight = 25
+        session.save()
+        etag_saved = self.get_etag()
+        self.assertNotEqual(etag_saved, etag)
+        
+        # update() does not bump Session.modified
+        runner.models.Session.objects.filter(name='session1').update(
+            user_data_weight=26)
+        etag_updated = self.get_etag()
+        self.assertNotEqual(etag_updated, etag_saved)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag_saved)
+        self.assertEqual(response.status_code, 200)
+
+class WeightDataTest(AdminTestCase):
+    def setUp(self):
+        super(WeightDataTest, self).setUp()
+        for n_mouse, cohort in enumerate([1, None]):
+            mouse = runner.models.Mouse.objects.create(name='KF%d' % n_mouse,
+                experimenter=0, in_training=True, training_cohort=cohort)
+            runner.models.Session.objects.create(name='session%d' % n_mouse,
+                mouse=mouse, user_data_weight=20 + n_mouse,
+                date_time_start=timezone.now())
+    
+    def test_json(self):
+        response = self.client.get('/weights.json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(''.join(response.streaming_content))
+        self.assertEqual(data['columns'], [
+            {'cohort': -1, 'mouse': 'KF1'}, {'cohort': 1, 'mouse': 'KF0'}])
+        for column in data['columns']:
+            self.assertIsInstance(column['cohort'], int)
+        self.assertEqual(len(data['rows']), 1)
+        self.assertEqual(data['rows'][0][1:], [21., 20.])
+    
+    def test_csv(self):
+        response = self.client.get('/weights.csv')
+        self.assertEqual(response.status_code, 200)
+        rows = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(rows[:2], ['cohort,-1,1', 'mouse,KF1,KF0'])
+        self.assertTrue(rows[2].endswith(',21.0,20.0'))
+        
+        response = self.client.get('/weights.csv?cohort=1')
+        rows = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(rows[:2], ['cohort,1', 'mouse,KF0'])
+
+class ValveVolumeTest(TestCase):
+    def setUp(self):
+        self.boxes = [runner.models.Box.objects.create(
+            name='CR%d' % n, l_reward_duration=40, serial_port='/dev/ttyACM%d' % n)
+            for n in range(2)]
+    
+    def create_session(self, box, utc_time, left, right):
+        runner.models.Session.objects.create(
+            name='session%03d' % runner.models.Session.objects.count(),
+            box=box, date_time_start=utc_time.replace(tzinfo=timezone.utc),
+            user_data_left_valve_mean=left, user_data_right_valve_mean=right)
+    
+    def test_volumes_of_every_box_in_one_query(self):
+        box0, box1 = self.boxes
+        self.create_session(box0, datetime.datetime(2016, 8, 1, 14),
+            .003, .006)
+        self.create_session(box0, datetime.datetime(2016, 8, 1, 18),
+            .005, .004)
+        
+        # Still August 1 in local time
+        self.create_session(box1, datetime.datetime(2016, 8, 2, 2),
+            .004, .004)
+        
+        # Ignored as a mistake, or as it has no box
+        self.create_session(box1, datetime.datetime(2016, 8, 1, 14),
+            .5, .004)
+        self.create_session(None, datetime.datetime(2016, 8, 1, 14),
+            .004, .004)
+        
+        with self.assertNumQueries(1):
+            volumes = runner.views.get_valve_volumes(
+                datetime.date(2016, 8, 1))
+        
+        self.assertEqual(list(volumes.index), [
+            (box0.id, datetime.date(2016, 8, 1)),
+            (box1.id, datetime.date(2016, 8, 1))])
+        self.assertEqual(list(volumes.columns), ['left', 'right'])
+        self.assertEqual(volumes.round(6).values.tolist(),
+            [[4., 5.], [4., 4.]])
+
+class GrandSessionTagIndexTest(AdminTestCase):
+    def setUp(self):
+        super(GrandSessionTagIndexTest, self).setUp()
+        self.grand_sessions = [
+            runner.models.GrandSession.objects.create(name='gs%d' % n)
+            for n in range(3)]
+        self.grand_sessions[0].tags.add('opto', 'good')
+        self.grand_sessions[1].tags.add('opto')
+        whisk_video.models.VideoSession.objects.create(
+            name='vs1', grand_session=self.grand_sessions[1])
+    
+    def test_index(self):
+        index = runner.caches.get_grand_session_tag_index()
+        self.assertEqual(index['tag2ids'], {
+            'good': [self.grand_sessions[0].pk],
+            'opto': [self.grand_sessions[0].pk, self.grand_sessions[1].pk],
+        })
+        self.assertEqual(
+            runner.caches.get_grand_session_tags(self.grand_sessions[0].pk),
+            ['good', 'opto'])
+        self.assertEqual(
+            runner.caches.get_grand_session_tags(self.grand_sessions[2].pk), 
+            [])
+    
+    def test_index_invalidated_on_tag_changes(self):
+        runner.caches.get_grand_session_tag_index()
+        
+        self.grand_sessions[2].tags.add('sham')
+        self.grand_sessions[0].tags.remove('good')
+        index = runner.caches.get_grand_session_tag_index()
+        self.assertEqual(sorted(index['tag2ids'].keys()), ['opto', 'sham'])
+        
+        self.grand_sessions[1].delete()
+        self.assertEqual(
+            runner.caches.get_grand_session_tag_index()['tag2ids']['opto'],
+            [self.grand_sessions[0].pk])
+    
+    def test_filter_by_tag(self):
+        response = self.client.get('/admin/runner/grandsession/?tag=good')
+        self.assertEqual(
+            [obj.pk for obj in response.context['cl'].result_list],
+            [self.grand_sessions[0].pk])
+        
+        response = self.client.get('/admin/whisk_video/videosession/?tag=opto')
+        self.assertEqual(
+            [obj.pk for obj in response.context['cl'].result_list], ['vs1'])
+    
+    def test_filter_by_tag_ignores_stale_index(self):
+        # As if another process had retagged everything since this one
+        # built its index
+        runner.caches.get_grand_session_tag_index()
+        stale_pk = self.grand_sessions[2].pk
+        runner.caches._tag_index_memo['index'] = {
+            'tag2ids': {'opto': [stale_pk]}, 'id2tags': {stale_pk: ['opto']}}
+        
+        response = self.client.get('/admin/runner/grandsession/?tag=opto')
+        self.assertEqual(
+            sorted(obj.pk for obj in response.context['cl'].result_list),
+            [self.grand_sessions[0].pk, self.grand_sessions[1].pk])
+        
+        response = self.client.get('/admin/whisk_video/videosession/?tag=opto')
+        self.assertEqual(
+            [obj.pk for obj in response.context['cl'].result_list], ['vs1'])
+
+## Colony database
+# A local stand-in for the colony database, with the columns that are read
+COLONY_SCHEMA = """
+CREATE TABLE colony_cage (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE colony_litter (breeding_cage_id INTEGER PRIMARY KEY, dob DATE);
+CREATE TABLE colony_gene (id INTEGER PRIMARY KEY, name TEXT, gene_type INTEGER);
+CREATE TABLE colony_mouse (id INTEGER PRIMARY KEY, name TEXT, sex INTEGER,
+    litter_id INTEGER, manual_dob DATE, cage_id INTEGER, wild_type BOOLEAN);
+CREATE TABLE colony_mousegene (id INTEGER PRIMARY KEY, mouse_name_id INTEGER,
+    gene_name_id INTEGER, zygosity TEXT);
+INSERT INTO colony_cage VALUES (100, 'C100'), (101, 'C101'), (102, 'C102');
+INSERT INTO colony_litter VALUES (10, '2016-04-01');
+INSERT INTO colony_gene VALUES (1, 'Emx1-Cre', 1), (2, 'Ai93', 0),
+    (3, 'PV-Cre', 2);
+INSERT INTO colony_mouse VALUES
+    (1, '3126-3', 0, 10, NULL, 100, 0),
+    (2, '3126-4', 1, NULL, '2016-05-01', 101, 1),
+    (3, '3126-5', 1, 10, NULL, 100, 0),
+    (4, '3126-6', 0, 10, NULL, 102, 0);
+INSERT INTO colony_mousegene VALUES
+    (1, 1, 1, '+/-'), (2, 1, 2, '+/+'), (3, 1, 3, '-/-'),
+    (4, 3, 1, '-/-'), (5, 4, 3, '+/-');
+"""
+
+def make_colony_database():
+    """Return a connection to a new in-memory colony database"""
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(COLONY_SCHEMA)
+    return conn
+
+class ColonyImportTest(TestCase):
+    def setUp(self):
+        self.colony_conn = make_colony_database()
+
+    def test_fetch_only_named_mice(self):
+        tables = runner.colony.fetch_colony_tables(
+            self.colony_conn, ['3126-3', '3126-4'])
+        self.assertEqual(sorted(tables['mouse']['name']), ['3126-3', '3126-4'])
+        self.assertEqual(sorted(tables['mousegene'].index), [1, 2, 3])
+        self.assertEqual(sorted(tables['cage']['name']), ['C100', 'C101'])
+
+        info = runner.colony.get_colony_mouse_info(tables, '3126-3')
+        self.assertEqual(info['dob'], datetime.date(2016, 4, 1))
+        self.assertEqual(info['cage_name'], 'C100')
+        self.assertEqual(info['genotype'], 'Ai93(+/+); Emx1-Cre(+/-)')
+        info = runner.colony.get_colony_mouse_info(tables, '3126-4')
+        self.assertEqual(info['dob'], datetime.date(2016, 5, 1))
+        self.assertEqual(info['genotype'], 'pure WT')
+
+    def test_import_mice(self):
+        runner.models.Mouse.objects.create(name='KF2', experimenter=0,
+            husbandry_name='3126-4', genotype='unknown')
+        specs = [
+            {'husbandry_name': '3126-3', 'headplate_color': 'RB',
+                'training_name': 'KF1', 'training_number': 1},
+            {'husbandry_name': '3126-4'},
+            {'husbandry_name': '3126-5'},
+            {'husbandry_name': 'missing'},
+        ]
+        tables = runner.colony.fetch_colony_tables(self.colony_conn,
+            [spec['husbandry_name'] for spec in specs])
+
+        res = copy_to_mouse_cloud.import_mice(tables, specs)
+        self.assertEqual(res, (1, 1, 2))
+
+        # Only the cages of mice that were written
+        self.assertEqual(sorted(runner.models.BehaviorCage.objects.values_list(
+            'name', flat=True)), ['C100', 'C101'])
+        res = copy_to_mouse_cloud.import_mice(
+            runner.colony.fetch_colony_tables(self.colony_conn, ['3126-6']),
+            [{'husbandry_name': '3126-6'}])
+        self.assertEqual(res, (0, 0, 1))
+        self.assertEqual(runner.models.BehaviorCage.objects.count(), 2)
+
+        new_mouse = runner.models.Mouse.objects.get(name='KF1')
+        self.assertEqual(new_mouse.cage.name, 'C100')
+        self.assertEqual(new_mouse.dob, datetime.date(2016, 4, 1))
+        self.assertEqual(new_mouse.scheduler, 'ForcedAlternationLickTrain')
+        updated_mouse = runner.models.Mouse.objects.get(name='KF2')
+        self.assertEqual(updated_mouse.genotype, 'pure WT')
+        self.assertEqual(updated_mouse.cage.name, 'C101')
+
+        # Nothing changes the second time
+        self.assertEqual(
+            copy_to_mouse_cloud.import_mice(tables, specs[1:2]), (0, 0, 0))
+
+class ColonySnapshotTest(TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.snapshot_dir, 'colony.sqlite')
+        self.n_connects = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def connect(self):
+        self.n_connects += 1
+        return make_colony_database()
+
+    def connect_offline(self):
+        raise IOError('network is down')
+
+    def open_snapshot(self, connect, **kwargs):
+        return runner.colony.open_colony_snapshot(
+            self.snapshot_path, connect=connect, **kwargs)
+
+    def test_lookups_from_snapshot(self):
+        conn = self.open_snapshot(self.connect)
+        tables = runner.colony.fetch_colony_tables(conn, ['3126-3', '3126-4'])
+        info = runner.colony.get_colony_mouse_info(tables, '3126-3')
+        self.assertEqual(info['dob'], datetime.date(2016, 4, 1))
+        self.assertEqual(info['genotype'], 'Ai93(+/+); Emx1-Cre(+/-)')
+        info = runner.colony.get_colony_mouse_info(tables, '3126-4')
+        self.assertEqual(info['dob'], datetime.date(2016, 5, 1))
+        self.assertEqual(info['genotype'], 'pure WT')
+
+    def test_refreshed_after_ttl_or_on_demand(self):
+        self.open_snapshot(self.connect)
+        self.open_snapshot(self.connect)
+        self.assertEqual(self.n_connects, 1)
+
+        self.open_snapshot(self.connect, refresh=True)
+        self.assertEqual(self.n_connects, 2)
+
+        os.utime(self.snapshot_path, (0, 0))
+        self.open_snapshot(self.connect)
+        self.assertEqual(self.n_connects, 3)
+
+    def test_offline(self):
+        with self.assertRaises(IOError):
+            self.open_snapshot(self.connect_offline)
+
+        # A stale snapshot is better than nothing
+        self.open_snapshot(self.connect)
+        os.utime(self.snapshot_path, (0, 0))
+        conn = self.open_snapshot(self.connect_offline, refresh=True)
+        tables = runner.colony.fetch_colony_tables(conn, ['3126-5'])
+        self.assertEqual(len(tables['mouse']), 1)
+
+def get_genotype_iterrows(mouse, mousegene_table, gene_table):
+    """The genotype of one mouse, as copy_to_mouse_cloud used to do it"""
+    mousegenes = mousegene_table[mousegene_table.mouse_name_id == mouse.id]
+    mousegenes = mousegenes.sort_values('gene_type')
+    if len(mousegenes) == 0 and mouse.wild_type:
+        return 'pure WT'
+
+    res_l = []
+    for idx, row in mousegenes.iterrows():
+        if row['zygosity'] == '-/-':
+            continue
+        res = '%s(%s)' % (
+            gene_table.loc[row['gene_name_id'], 'name'],
+            row['zygosity'])
+        res_l.append(res)
+
+    if len(res_l) == 0:
+        return 'negative'
+    else:
+        return '; '.join(res_l)
+
+class GenotypeTest(TestCase):
+    def make_colony_tables(self, n_mice, seed):
+        """Random mice with random genes, as read by fetch_colony_tables"""
+        rng = random.Random(seed)
+        gene_table = pandas.DataFrame({
+            'id': range(1, 9),
+            'name': ['gene%d' % n for n in range(1, 9)],
+            'gene_type': [rng.randint(0, 3) for n in range(8)],
+        }).set_index('id')
+        mouse_table = pandas.DataFrame({
+            'id': range(1, n_mice + 1),
+            'name': ['%d-1' % n for n in range(1, n_mice + 1)],
+            'wild_type': [rng.choice([True, False]) for n in range(n_mice)],
+        })
+        mousegene_rows = []
+        for mouse_id in mouse_table['id']:
+            for gene_id in rng.sample(gene_table.index, rng.randint(0, 4)):
+                mousegene_rows.append({
+                    'id': len(mousegene_rows) + 1,
+                    'mouse_name_id': mouse_id,
+                    'gene_name_id': gene_id,
+                    'zygosity': rng.choice(['+/+', '+/-', '-/-']),
+                })
+        mousegene_table = pandas.DataFrame(mousegene_rows,
+            columns=['id', 'mouse_name_id', 'gene_name_id', 'zygosity'])
+        mousegene_table = mousegene_table.set_index('id').join(
+            gene_table[['gene_type']], on='gene_name_id')
+        return mouse_table, mousegene_table, gene_table
+
+    def test_same_as_iterrows(self):
+        for seed in range(5):
+            mouse_table, mousegene_table, gene_table = \
+                self.make_colony_tables(200, seed)
+            genotypes = runner.colony.get_genotypes(
+                mouse_table, mousegene_table, gene_table)
+            expected = [
+                get_genotype_iterrows(mouse, mousegene_table, gene_table)
+                for idx, mouse in mouse_table.iterrows()]
+            self.assertEqual(list(genotypes), expected)
+            self.assertEqual(
+                set(['pure WT', 'negative']) - set(expected), set())
+
+    def test_colony_database(self):
+        tables = runner.colony.fetch_colony_tables(make_colony_database(),
+            ['3126-3', '3126-4', '3126-5', '3126-6'])
+        self.assertEqual(list(tables['mouse']['genotype']), [
+            'Ai93(+/+); Emx1-Cre(+/-)', 'pure WT', 'negative',
+            'PV-Cre(+/-)'])
+
+    def test_no_mice(self):
+        mouse_table, mousegene_table, gene_table = \
+            self.make_colony_tables(0, 0)
+        self.assertEqual(len(runner.colony.get_genotypes(
+            mouse_table, mousegene_table, gene_table)), 0)
+
+class ColonyDriftTest(TestCase):
+    def setUp(self):
+        self.colony_conn = make_colony_database()
+        tables = runner.colony.fetch_colony_tables(
+            self.colony_conn, ['3126-3', '3126-4', '3126-5'])
+        copy_to_mouse_cloud.import_mice(tables, [
+            {'husbandry_name': husbandry_name,
+                'training_name': 'KF%d' % n, 'training_number': n}
+            for n, husbandry_name in enumerate(['3126-3', '3126-4', '3126-5'])])
+        runner.models.Mouse.objects.create(name='KF9', experimenter=0,
+            husbandry_name='gone')
+
+    def test_no_drift(self):
+        drift, missing = check_colony_drift.find_colony_drift(
+            self.colony_conn)
+        self.assertEqual(len(drift), 0)
+        self.assertEqual(missing, ['gone'])
+
+    def test_drift_applied(self):
+        runner.models.Mouse.objects.filter(name__in=['KF0', 'KF2']).update(
+            genotype='wrong', dob=datetime.date(2000, 1, 1))
+        runner.models.Mouse.objects.filter(name='KF1').update(cage=None)
+
+        # Also read in several chunks
+        chunk_size = runner.colony.READ_ROWS_CHUNK_SIZE
+        runner.colony.READ_ROWS_CHUNK_SIZE = 2
+        try:
+            drift, missing = check_colony_drift.find_colony_drift(
+                self.colony_conn)
+        finally:
+            runner.colony.READ_ROWS_CHUNK_SIZE = chunk_size
+
+        self.assertEqual(
+            sorted(zip(drift['mouse'], drift['field'], drift['colony'])), [
+            ('KF0', 'dob', datetime.date(2016, 4, 1)),
+            ('KF0', 'genotype', 'Ai93(+/+); Emx1-Cre(+/-)'),
+            ('KF1', 'cage', 'C101'),
+            ('KF2', 'dob', datetime.date(2016, 4, 1)),
+            ('KF2', 'genotype', 'negative'),
+        ])
+
+        self.assertEqual(check_colony_drift.apply_colony_drift(drift), 3)
+        self.assertEqual(runner.models.Mouse.objects.get(name='KF2').genotype,
+            'negative')
+        self.assertEqual(runner.models.Mouse.objects.get(name='KF1').cage.name,
+            'C101')
+        drift, missing = check_colony_drift.find_colony_drift(
+            self.colony_conn)
+        self.assertEqual(len(drift), 0)
+
+@skipIf(make_labels is None, 'make_labels needs pylabels and reportlab')
+class MakeLabelsTest(TestCase):
+    def setUp(self):
+        for n_cage in range(5):
+            cage = runner.models.BehaviorCage.objects.create(
+                name='CR%d' % n_cage, label_color='Pink')
+            for n_mouse in range(3):
+                runner.models.Mouse.objects.create(
+                    name='KF%d%d' % (n_cage, n_mouse), experimenter=0,
+                    cage=cage, genotype='negative', headplate_color='red',
+                    husbandry_name='%d-%d' % (n_cage, n_mouse))
+
+    def test_colony_specs_query_count(self):
+        cage_name_l = ['CR%d' % n_cage for n_cage in range(5)] + ['CR99']
+        with self.assertNumQueries(2):
+            colony_specs = make_labels.get_colony_specs(cage_name_l)
+
+        self.assertEqual(sorted(colony_specs.keys()), cage_name_l[:5])
+        self.assertEqual(sorted(zip(colony_specs['CR3']['mice'],
+            colony_specs['CR3']['full_names'])),
+            [('KF30', '3-0'), ('KF31', '3-1'), ('KF32', '3-2')])
+        self.assertEqual(colony_specs['CR3']['fillColor'], 'magenta')
+
+    def test_label_sheet_counts(self):
+        cage_name_l = ['CR%d' % n_cage for n_cage in range(5)]
+        colony_specs = make_labels.get_colony_specs(cage_name_l)
+
+        # A water restriction label for every cage and a cage label for some
+        sheet = make_labels.make_label_sheet(
+            colony_specs, cage_name_l, cage_name_l[:3])
+        self.assertEqual(sheet.label_count, 8)
+        self.assertEqual(sheet.page_count, 1)
+
+        # Only the last two rows of the first page are left
+        sheet = make_labels.make_label_sheet(
+            colony_specs, cage_name_l, cage_name_l[:3], row_start=14)
+        self.assertEqual(sheet.label_count, 8)
+        self.assertEqual(sheet.page_count, 2)
+
+        pdf = io.BytesIO()
+        sheet.save(pdf)
+        self.assertTrue(pdf.getvalue().startswith('%PDF'))
+
+class SketchCacheTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_root = os.path.join(self.temp_dir, 'cache')
+        self.build_parameters = {'board': 'uno', 'protocol_name': 'LickTrain'}
+        self.compiled = []
+        self.uploaded = []
+
+        self.library_path = os.path.join(self.temp_dir, 'libraries')
+        os.makedirs(os.path.join(self.library_path, 'chat'))
+        self.write_library('chat.h', '#define CHAT 1\n')
+
+    def write_library(self, filename, contents):
+        with file(os.path.join(
+            self.library_path, 'chat', filename), 'w') as fi:
+            fi.write(contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_sandbox(self, name, config):
+        """A sandbox with a sketch, as copied from the protocol"""
+        sketch_path = os.path.join(self.temp_dir, name, 'Autosketch')
+        os.makedirs(sketch_path)
+        with file(os.path.join(sketch_path, 'Autosketch.ino'), 'w') as fi:
+            fi.write('void loop() {}\n')
+        with file(os.path.join(sketch_path, 'config.h'), 'w') as fi:
+            fi.write(config)
+        return {'sketch': sketch_path}
+
+    def compile_and_upload(self, sandbox_paths, specific_parameters):
+        self.compiled.append(sandbox_paths['sketch'])
+        build_dir = os.path.join(sandbox_paths['sketch'], 'build-uno')
+        os.mkdir(build_dir)
+        with file(os.path.join(build_dir, 'Autosketch.hex'), 'w') as fi:
+            fi.write(file(os.path.join(
+                sandbox_paths['sketch'], 'config.h')).read())
+
+    def upload(self, hex_path, serial_port, avrdude_command):
+        self.uploaded.append((file(hex_path).read(), serial_port))
+
+    def start(self, sandbox_paths, serial_port):
+        return runner.sketch_cache.compile_and_upload_cached(
+            sandbox_paths, {'build': self.build_parameters}, serial_port,
+            self.compile_and_upload, library_paths=[self.library_path],
+            cache_root=self.cache_root, upload=self.upload)
+
+    def test_hash_ignores_build_products(self):
+        sandbox_paths = self.make_sandbox('s1', '#define A 1\n')
+        key = runner.sketch_cache.hash_sketch(
+            sandbox_paths['sketch'], self.build_parameters)
+        self.compile_and_upload(sandbox_paths, None)
+        self.assertEqual(runner.sketch_cache.hash_sketch(
+            sandbox_paths['sketch'], self.build_parameters), key)
+
+        self.assertNotEqual(runner.sketch_cache.hash_sketch(
+            sandbox_paths['sketch'], {'board': 'mega'}), key)
+
+    def test_only_changed_sketches_are_compiled(self):
+        self.assertEqual(
+            self.start(self.make_sandbox('s1', '#define A 1\n'), 'ACM0'),
+            'compiled')
+        self.assertEqual(
+            self.start(self.make_sandbox('s2', '#define A 1\n'), 'ACM1'),
+            'cached')
+        self.assertEqual(
+            self.start(self.make_sandbox('s3', '#define A 2\n'), 'ACM1'),
+            'compiled')
+
+        self.assertEqual(len(self.compiled), 2)
+        self.assertEqual(self.uploaded, [('#define A 1\n', 'ACM1')])
+
+    def test_library_changes_are_compiled(self):
+        self.start(self.make_sandbox('s1', '#define A 1\n'), 'ACM0')
+        self.write_library('chat.cpp', '// changed\n')
+        self.assertEqual(
+            self.start(self.make_sandbox('s2', '#define A 1\n'), 'ACM0'),
+            'compiled')
+
+        self.library_path = os.path.join(self.temp_dir, 'missing')
+        self.assertEqual(
+            self.start(self.make_sandbox('s3', '#define A 1\n'), 'ACM0'),
+            'compiled')
+        self.assertEqual(self.uploaded, [])
+
+    def test_unknown_boards_are_not_cached(self):
+        self.assertEqual(runner.sketch_cache.get_avrdude_command(
+            {'board': 'mega2560'})[:7],
+            ['avrdude', '-p', 'atmega2560', '-c', 'wiring', '-b', '115200'])
+
+        self.build_parameters = {'board': 'due'}
+        for name in ['s1', 's2']:
+            self.assertEqual(
+                self.start(self.make_sandbox(name, '#define A 1\n'), 'ACM0'),
+                'compiled')
+        self.assertEqual(len(self.compiled), 2)
+        self.assertFalse(os.path.exists(self.cache_root))
+
+## Stand-ins for the ArduFSM functions that count rewards
+def split_by_trial_stub(lines):
+    splines = [[]]
+    for line in lines:
+        if 'TRL_START' in line:
+            splines.append([])
+        splines[-1].append(line)
+    return splines
+
+def count_rewards_stub(splines):
+    return pandas.DataFrame(dict(
+        (side + ' ' + typ, [
+            sum(line.split()[1:] == ['EV', 'R', '%s_%s' % (
+            side.upper(), typ.upper())] for line in trial)
+            for trial in splines])
+        for side in ['left', 'right']
+        for typ in runner.reward_counts.REWARD_TYPES))
+
+class RewardCountsTest(TestCase):
+    def setUp(self):
+        # A header before the first trial, then trials with rewards
+        lines = ['0 DBG header']
+        for trial in range(6):
+            lines.append('%d TRL_START' % (trial * 100))
+            lines += ['%d EV R %s' % (trial * 100 + n, reward)
+                for n, reward in enumerate(
+                ['LEFT_AUTO', 'RIGHT_MANUAL', 'LEFT_DIRECT'][:trial % 4])]
+            lines.append('%d TRL_RELEASED' % (trial * 100 + 99))
+        self.lines = [line + '\n' for line in lines]
+
+        fd, self.logfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fi:
+            fi.writelines(self.lines)
+
+    def tearDown(self):
+        os.remove(self.logfile)
+
+    def test_chunks_split_like_the_whole_file(self):
+        for chunk_size in [1, 2, 3, len(self.lines)]:
+            trials = []
+            for chunk in runner.reward_counts.iter_trial_chunks(
+                self.logfile, split_by_trial_stub, chunk_size):
+                trials += chunk
+            self.assertEqual(trials, split_by_trial_stub(self.lines))
+
+    def test_streaming_counts_match_in_memory(self):
+        expected = runner.reward_counts.count_rewards_in_memory(
+            self.logfile, split_by_trial_stub, count_rewards_stub)
+        self.assertEqual(expected['left auto'], 4)
+        self.assertEqual(expected['right manual'], 2)
+        for chunk_size in [1, 2, 3, len(self.lines)]:
+            self.assertEqual(runner.reward_counts.count_rewards_streaming(
+                self.logfile, split_by_trial_stub, count_rewards_stub,
+                chunk_size), expected)
+
+## Stand-ins for the ArduFSM stages of starting a session
+# The first two run in worker processes, so they are defined here
+def prepare_stub(user_input):
+    if user_input['mouse'] == 'KF2':
+        raise IOError('cannot create sandbox')
+    return {'sketch': user_input['mouse']}, {'build': {}}
+
+def upload_stub(sandbox_paths, specific_parameters, serial_port):
+    if sandbox_paths['sketch'] == 'KF3':
+        raise RuntimeError('cannot upload')
+    return serial_port, os.getpid()
+
+started_sketches = []
+
+def start_stub(sandbox_paths, specific_parameters):
+    started_sketches.append(sandbox_paths['sketch'])
+
+# The plan is run after closing the connection, which only works outside
+# of a transaction
+class SessionPlanTest(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        del started_sketches[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_plan(self, text):
+        plan_path = os.path.join(self.temp_dir, 'plan.txt')
+        with file(plan_path, 'w') as fi:
+            fi.write(text)
+        return plan_path
+
+    def test_read_plan(self):
+        plan_path = self.write_plan(
+            '# mouse board box\n\nkf0 cr0 b0\n  KF1, CR1,B1 \nKF2\tCR2 , B2\n')
+        self.assertEqual(runner.session_plan.read_plan(plan_path), [
+            {'mouse': 'KF0', 'board': 'CR0', 'box': 'B0'},
+            {'mouse': 'KF1', 'board': 'CR1', 'box': 'B1'},
+            {'mouse': 'KF2', 'board': 'CR2', 'box': 'B2'},
+        ])
+
+        plan_path = self.write_plan('KF0 CR0 B0\nKF1 CR1\n')
+        with self.assertRaises(ValueError):
+            runner.session_plan.read_plan(plan_path)
+
+    def test_run_plan_skips_failed_sessions(self):
+        for n, serial_port in enumerate(['ACM0', 'ACM0', 'ACM1', 'ACM1']):
+            runner.models.Mouse.objects.create(name='KF%d' % n, experimenter=0)
+            runner.models.Box.objects.create(name='B%d' % n,
+                l_reward_duration=1, serial_port=serial_port)
+        plan = [{'mouse': mouse, 'board': 'CR0', 'box': box}
+            for mouse, box in [('KF0', 'B0'), ('KF1', 'B1'), ('KF2', 'B2'),
+            ('KF3', 'B3'), ('KF9', 'B0'), ('KF0', 'B9')]]
+
+        reports, stage_times = runner.session_plan.run_plan(
+            plan, prepare_stub, upload_stub, start_stub, processes=2)
+
+        errors = [report['error'] for report in reports]
+        self.assertEqual(errors[:2], [None, None])
+        self.assertIn('IOError', errors[2])
+        self.assertIn('RuntimeError', errors[3])
+        self.assertEqual(errors[4:], ['no mouse named KF9', 'no box named B9'])
+
+        # Each stage after a failure was skipped
+        for stage, reached in [
+            ('prepare', [True, True, True, True, False, False]),
+            ('upload', [True, True, False, True, False, False]),
+            ('start', [True, True, False, False, False, False])]:
+            self.assertEqual(
+                [report[stage] is not None for report in reports], reached)
+        self.assertEqual(started_sketches, ['KF0', 'KF1'])
+
+        # Both sessions on ACM0 were uploaded in turn by the same process
+        self.assertEqual(reports[0]['build'][0], 'ACM0')
+        self.assertEqual(reports[0]['build'], reports[1]['build'])
+        self.assertEqual(
+            sorted(stage_times.keys()), ['prepare', 'start', 'upload'])
+
+    def test_format_timings(self):
+        reports = [
+            {'mouse': 'KF0', 'board': 'CR0', 'box': 'B0', 'prepare': 1.23,
+            'upload': 4.56, 'start': 0.04, 'build': 'cached', 'error': None},
+            {'mouse': 'KF1', 'board': 'CR1', 'box': 'B1', 'prepare': 2.0,
+            'upload': None, 'start': None, 'build': None, 'error': 'failed'},
+        ]
+        lines = runner.session_plan.format_timings(reports,
+            {'prepare': 2.0, 'upload': 4.56, 'start': 0.04}).split('\n')
+        self.assertEqual([line.split() for line in lines[1:]], [
+            ['KF0', 'CR0', 'B0', '1.2', '4.6', '0.0', 'ok', '(cached)'],
+            ['KF1', 'CR1', 'B1', '2.0', '-', '-', 'failed'],
+            ['total', '(wall', 'clock)', '2.0', '4.6', '0.0'],
+        ])
+
+@skipIf(put_new is None, 'put_new needs ArduFSM and MCwatch')
+class PutNewTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_logfile(self, sandbox_name, lines, parameters=None):
+        """A logfile in a saved sandbox, with parameters.json if given"""
+        script_dir = os.path.join(self.temp_dir, sandbox_name, 'Script')
+        os.makedirs(os.path.join(script_dir, 'logfiles'))
+        if parameters is not None:
+            with file(os.path.join(script_dir, 'parameters.json'), 'w') as fi:
+                json.dump(parameters, fi)
+
+        logfile = os.path.join(script_dir, 'logfiles', 'ardulines')
+        with file(logfile, 'w') as fi:
+            fi.write(''.join(line + '\n' for line in lines))
+        return logfile
+
+    def test_derive_session_returns_errors(self):
+        logfile = self.make_logfile('s1', [])
+        parameters, results, signature, error = put_new.derive_session(
+            ('s1', logfile, None))
+        self.assertIsNone(parameters)
+        self.assertTrue(error.startswith('IOError'))
+
+    def test_derive_session_uses_cached_results(self):
+        logfile = self.make_logfile('s1', [], {'mouse': 'KF0'})
+        cached = {'signature': put_new.get_logfile_signature(logfile),
+            'results': {'left_perf': 0.5}}
+        self.assertEqual(
+            put_new.derive_session(('s1', logfile, cached)),
+            ({'mouse': 'KF0'}, {'left_perf': 0.5}, cached['signature'], None))
+
+    def test_derive_session_caches_errors(self):
+        logfile = self.make_logfile('s1', ['0 TRL_START'])
+        parameters, results, signature, error = put_new.derive_session(
+            ('s1', logfile, None))
+        self.assertEqual(signature, put_new.get_logfile_signature(logfile))
+        cached = {'signature': signature, 'results': None, 'error': error}
+
+        # Not read again while the logfile is unchanged
+        script_dir = os.path.dirname(os.path.dirname(logfile))
+        with file(os.path.join(script_dir, 'parameters.json'), 'w') as fi:
+            json.dump({'mouse': 'KF0'}, fi)
+        with file(os.path.join(script_dir, 'logfiles', 'results'), 'w') as fi:
+            json.dump({'left_perf': 0.5}, fi)
+        self.assertEqual(put_new.derive_session(('s1', logfile, cached)),
+            (None, None, signature, error))
+
+        with file(logfile, 'a') as fi:
+            fi.write('1 TRL_RELEASED\n')
+        parameters, results, signature, error = put_new.derive_session(
+            ('s1', logfile, cached))
+        self.assertEqual(parameters, {'mouse': 'KF0'})
+        self.assertIsNone(error)
+
+    def test_streaming_reward_counts_match_in_memory(self):
+        # A header before the first trial, then trials with rewards
+        lines = ['0 DBG header']
+        for trial in range(5):
+            lines.append('%d TRL_START' % (trial * 100))
+            lines += ['%d EV %s' % (trial * 100 + n, event) for n, event in
+                enumerate(['AAR_L', 'R_L', 'AAR_R', 'R_R'][:trial])]
+            lines.append('%d TRL_RELEASED' % (trial * 100 + 99))
+        logfile = self.make_logfile('s1', lines)
+
+        expected = put_new.count_rewards_in_memory(logfile)
+        for chunk_size in [1, 2, len(lines)]:
+            self.assertEqual(
+                put_new.count_rewards_streaming(logfile, chunk_size), expected)
+
+    def test_watermark_stops_at_skipped_sessions(self):
+        bdf = pandas.DataFrame({
+            'session': ['s1', 's2', 's3'],
+            'dt_start': [datetime.datetime(2016, 5, 1, hour)
+                for hour in [10, 11, 12]],
+        })
+        self.assertEqual(put_new.find_watermark(bdf, {'s1', 's2', 's3'}),
+            datetime.datetime(2016, 5, 1, 12))
+        self.assertEqual(put_new.find_watermark(bdf, {'s1', 's3'}),
+            datetime.datetime(2016, 5, 1, 11))
+        self.assertIsNone(put_new.find_watermark(bdf.iloc[:0], set()))
+
+    def test_saved_sandboxes_are_listed_from_a_month_on(self):
+        this_month = datetime.date.today().replace(day=1)
+        old_month = this_month - datetime.timedelta(days=70)
+        for month, name in [(old_month, 'old-saved'),
+            (this_month, 'new-saved'), (this_month, 'running')]:
+            os.makedirs(os.path.join(self.temp_dir, 'KF',
+                str(month.year), '%02d' % month.month, name))
+
+        self.assertEqual(
+            [os.path.basename(sandbox) for sandbox in
+            put_new.find_saved_sandboxes(self.temp_dir)], ['new-saved'])
+        self.assertEqual(
+            sorted(os.path.basename(sandbox) for sandbox in
+            put_new.find_saved_sandboxes(self.temp_dir, since=old_month)),
+            ['new-saved', 'old-saved'])
+
+    def test_watermark_is_saved_locally(self):
+        path = os.path.join(self.temp_dir, 'mouse-cloud', 'watermark.json')
+        self.assertIsNone(put_new.load_watermark(path))
+
+        put_new.save_watermark(path, datetime.datetime(2016, 5, 1, 12, 30))
+        self.assertEqual(put_new.load_watermark(path),
+            datetime.datetime(2016, 5, 1, 12, 30))
+
+    def test_watch_retries_failed_sandboxes(self):
+        class StopWatching(Exception):
+            pass
+
+        class Watcher(object):
+            sandbox_root = self.temp_dir
+            notifier = None
+            batches = [{'s1'}, set(), {'s2'}, set(), {'s3'}, set(),
+                {'s4'}, set(), {'s5'}, set()]
+
+            def wait(self, timeout=None):
+                if len(self.batches) == 0:
+                    raise StopWatching
+                return self.batches.pop(0)
+
+        imported = []
+        class Command(put_new.Command):
+            def import_new_sessions(self, sandboxes, **options):
+                imported.append(sorted(sandboxes))
+                if 's2' in sandboxes:
+                    raise IOError('cannot parse logfile')
+
+        # s2 is given up on after MAX_IMPORT_ATTEMPTS
+        with self.assertRaises(StopWatching):
+            Command().watch(Watcher(), debounce=0)
+        self.assertEqual(imported, [['s1'], ['s2'], ['s2', 's3'],
+            ['s2', 's3', 's4'], ['s3', 's4', 's5']])
+
+    def test_bad_sandboxes_are_left_out(self):
+        logfile = self.make_logfile('s1', ['0 TRL_START'])
+        good_sandbox = os.path.join(self.temp_dir, 's1')
+        bad_sandbox = os.path.join(self.temp_dir, 's2')
+
+        search_for_behavior_files = (
+            put_new.MCwatch.behavior.db.search_for_behavior_files)
+        def search_or_fail(behavior_dir):
+            if behavior_dir == bad_sandbox:
+                raise ValueError('cannot parse date')
+            dt_start = datetime.datetime(2016, 5, 1, 10)
+            return pandas.DataFrame({'session': ['s1'],
+                'filename': [logfile], 'dt_start': [dt_start],
+                'dt_end': [dt_start + datetime.timedelta(hours=1)]})
+
+        put_new.MCwatch.behavior.db.search_for_behavior_files = search_or_fail
+        try:
+            bdf = put_new.get_sandbox_behavior_df([bad_sandbox, good_sandbox])
+        finally:
+            put_new.MCwatch.behavior.db.search_for_behavior_files = (
+                search_for_behavior_files)
+        self.assertEqual(list(bdf['sandbox']), ['s1'])
+        self.assertEqual(len(put_new.get_sandbox_behavior_df([])), 0)
@@ -3,10 +3,20 @@ from django.views.generic import CreateView, ListView
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
 from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseNotModified, HttpResponseBadRequest
+from django.http import StreamingHttpResponse
 from django.shortcuts import render_to_response
+from django.core.cache import cache
+from django.db.models import Count, Max, Q, Sum
+from django.utils.http import parse_etags, quote_etag
 from .models import Session
 from .models import Box, Mouse
+from . import caches
+import csv
 import datetime
+import hashlib
+import io
+import json
 import pandas
 from datetime import date, timedelta
 import numpy as np
@@ -23,40 +33,139 @@ import models
 # Interpret all times as Eastern
 tz = pytz.timezone('America/New_York')
 
+# How many days of weights to show
+WEIGHT_PLOT_DAYS = 45
+
+def get_weight_plot_fingerprint():
+    """Return a tuple that changes whenever the weight plot would change
+    
+    This is cheap compared to rendering: one query over in-training
+    mice and one aggregate over the sessions in the plotted window.
+    It captures the window itself (which moves daily), the cohort
+    assignments, sessions being added or deleted, and any session being
+    re-saved (through Session.modified).
+    
+    QuerySet.update() does not touch Session.modified, so the sum of the
+    weights is included too, which catches weights changed that way.
+    Moving a session to another date or mouse with update() is still
+    missed, until something else changes.
+    """
+    thresh_date = datetime.date.today() - datetime.timedelta(
+        days=WEIGHT_PLOT_DAYS)
+    
+    cohorts = tuple(Mouse.objects.filter(in_training=True).order_by(
+        'name').values_list('name', 'training_cohort'))
+    
+    session_stats = Session.objects.filter(
+        mouse__in_training=True, date_time_start__date__gte=thresh_date,
+        ).aggregate(n_sessions=Count('name'), last_modified=Max('modified'),
+        n_weights=Count('user_data_weight'),
+        total_weight=Sum('user_data_weight'))
+    
+    return (thresh_date, cohorts, 
+        session_stats['n_sessions'], session_stats['last_modified'],
+        session_stats['n_weights'], session_stats['total_weight'])
+
 def weight_plot(request):
-    ## Get cohorts (so we can detect missing data later)
-    qs = Mouse.objects.filter(in_training=True)
-    cohort_df = pandas.DataFrame.from_records(list(qs.values_list(
-        'name', 'training_cohort')), columns=['mouse', 'cohort'])
+    """Serve the weight plot, rendering it only if the data have changed
     
-    # Replace all missing cohorts with -1
-    cohort_df.loc[cohort_df.cohort.isnull(), 'cohort'] = -1
+    The PNG is cached under an ETag computed from the fingerprint of
+    the data, so a client that already has the current plot gets a 304
+    and a client that doesn't gets the cached bytes. Only a change in
+    the fingerprint triggers a new render.
+    """
+    etag = hashlib.md5(repr(get_weight_plot_fingerprint())).hexdigest()
     
-    # Group the mice
-    cohort2mouse_names = dict([(cohort, list(ser.values)) 
-        for cohort, ser in cohort_df.groupby('cohort')['mouse']])
+    # The client already has this version
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = quote_etag(etag)
+        return response
+    
+    # Use the cached rendering if it is of the same version, otherwise
+    # replace it
+    cached = cache.get(caches.WEIGHT_PLOT_CACHE_KEY)
+    if cached is not None and cached[0] == etag:
+        png = cached[1]
+    else:
+        png = render_weight_plot()
+        cache.set(caches.WEIGHT_PLOT_CACHE_KEY, (etag, png), 
+            caches.WEIGHT_PLOT_CACHE_TIMEOUT)
+    
+    response = HttpResponse(png, content_type='image/png')
+    response['ETag'] = quote_etag(etag)
+    return response
 
-    ## Extract weights
+def get_weights(start_date, stop_date=None, cohorts=None):
+    """Return the weight of each in-training mouse on each date
+    
+    start_date, stop_date : the range of dates to include (inclusive).
+        If stop_date is None, everything since start_date is included.
+    cohorts : list of training cohorts to include, or None to include
+        all of them. Mice without a cohort are in cohort -1.
+    
+    Returns: DataFrame
+        Indexed by date, with columns (cohort, mouse name).
+        In case there are multiple sessions on a date, the mean is taken.
+    """
     columns = ['date_time_start', 'mouse__name', 'user_data_weight', 
         'mouse__training_cohort']
-    thresh_date = datetime.date.today() - datetime.timedelta(days=45)
     qs = Session.objects.filter(
-        mouse__in_training=True, date_time_start__date__gte=thresh_date)
+        mouse__in_training=True, date_time_start__date__gte=start_date)
+    if stop_date is not None:
+        qs = qs.filter(date_time_start__date__lte=stop_date)
+    if cohorts is not None:
+        cohort_q = Q(mouse__training_cohort__in=cohorts)
+        if -1 in cohorts:
+            cohort_q |= Q(mouse__training_cohort__isnull=True)
+        qs = qs.filter(cohort_q)
+    
     weight_df = pandas.DataFrame.from_records(list(qs.values_list(*columns)),
         columns=columns)
     weight_df['date'] = weight_df['date_time_start'].apply(
         lambda dt: dt.astimezone(tz).date())
+    
+    # Otherwise this is an object when every weight is missing
+    weight_df['user_data_weight'] = weight_df['user_data_weight'].astype(
+        np.float)
 
     # Replace missing cohorts in the actual data
+    # They are floats while some are missing, but cohorts are numbered
     weight_df.loc[
         weight_df['mouse__training_cohort'].isnull(), 
         'mouse__training_cohort'] = -1
+    weight_df['mouse__training_cohort'] = weight_df[
+        'mouse__training_cohort'].astype(np.int)
 
     # Pivot
-    # In case there are multiple sessions, take the mean
     piv = weight_df.pivot_table(index='date', 
         columns=('mouse__training_cohort', 'mouse__name'),
         values='user_data_weight')
+    
+    return piv
+
+def render_weight_plot():
+    """Plot the weights of each in-training mouse by cohort
+    
+    Returns: the PNG as a string of bytes
+    """
+    ## Get cohorts (so we can detect missing data later)
+    qs = Mouse.objects.filter(in_training=True)
+    cohort_df = pandas.DataFrame.from_records(list(qs.values_list(
+        'name', 'training_cohort')), columns=['mouse', 'cohort'])
+    
+    # Replace all missing cohorts with -1
+    cohort_df.loc[cohort_df.cohort.isnull(), 'cohort'] = -1
+    cohort_df['cohort'] = cohort_df['cohort'].astype(np.int)
+    
+    # Group the mice
+    cohort2mouse_names = dict([(cohort, list(ser.values)) 
+        for cohort, ser in cohort_df.groupby('cohort')['mouse']])
+
+    ## Extract weights
+    thresh_date = datetime.date.today() - datetime.timedelta(
+        days=WEIGHT_PLOT_DAYS)
+    piv = get_weights(thresh_date)
 
     ## Make figure
     cohort_labels = sorted(cohort2mouse_names.keys())
@@ -103,14 +212,65 @@ def weight_plot(request):
             ax.set_title('missing mice: %r' % missing_mice)
 
     canvas = FigureCanvas(f)
-    response = HttpResponse(content_type='image/png')
-    canvas.print_png(response)
-    return response
+    buf = io.BytesIO()
+    canvas.print_png(buf)
+    return buf.getvalue()
+
+# Valve means outside this range (in mL) are ignored because they are 
+# usually mistakes
+VALVE_MEAN_IGNORE_LOWER_THRESH = .0005
+VALVE_MEAN_IGNORE_UPPER_THRESH = .1
+
+def get_valve_volumes(start_date, stop_date=None):
+    """Return the mean reward volume of each box on each date
+    
+    All sessions from start_date to stop_date (inclusive) are fetched in
+    a single query, with only the columns needed, and averaged by box and 
+    date in one groupby. If stop_date is None, everything since 
+    start_date is included.
+    
+    Returns: DataFrame
+        Indexed by (box_id, date_start)
+        Columns 'left' and 'right' are the mean valve volumes in uL
+    """
+    valve_columns = ['user_data_left_valve_mean', 'user_data_right_valve_mean']
+    columns = ['box_id', 'date_time_start'] + valve_columns
+    qs = Session.objects.filter(box__isnull=False, 
+        date_time_start__date__gte=start_date)
+    if stop_date is not None:
+        qs = qs.filter(date_time_start__date__lte=stop_date)
+    qs = qs.values_list(*columns)
+    sessions_df = pandas.DataFrame.from_records(list(qs), 
+        columns=columns).dropna()
+    
+    # Otherwise these are objects when there are no sessions
+    sessions_df[valve_columns] = sessions_df[valve_columns].astype(np.float)
+    
+    # Drop the ones outside the range
+    sessions_df = sessions_df[
+        (sessions_df[valve_columns].min(1) > VALVE_MEAN_IGNORE_LOWER_THRESH) &
+        (sessions_df[valve_columns].max(1) < VALVE_MEAN_IGNORE_UPPER_THRESH)
+    ]
+    
+    # Convert to date object, in local time like the date filters above
+    sessions_df['date_start'] = [
+        dt.astimezone(tz).date() for dt in sessions_df['date_time_start']]
+    
+    # Average the water consumption values by box and date, and 
+    # convert to uL
+    volumes = sessions_df.groupby(['box_id', 'date_start'])[
+        valve_columns].mean() * 1000
+    volumes.columns = ['left', 'right']
+    
+    return volumes
 
 def rewards_plot(request):
     """Plots the reward size for each box over days"""
-    # Get all the boxes
-    boxes = Box.objects.all()
+    # Get all the boxes, to lay out the axes
+    boxes = list(Box.objects.values_list('id', 'name'))
+    
+    # Get the volumes from all boxes at once
+    volumes = get_valve_volumes(date.today() - timedelta(days=30))
     
     # Create a matplotlib figure to plot into
     f = Figure(figsize=(12, 20), dpi=80)
@@ -121,68 +281,36 @@ def rewards_plot(request):
     min_water_limit = 4
     max_water_limit = 6
 
-    # Values outside this range are ignored because they are usually
-    # mistakes
-    ignore_lower_thresh = .0005
-    ignore_upper_thresh = .1
-    
-
     # Iterate over boxes
-    for i, box in enumerate(boxes):
-        # Get all sessions within the past 30 days that the box owns
-        box_sessions = Session.objects.filter(box=box, 
-            date_time_start__gte = date.today() - timedelta(days=30))
-        
+    for i, (box_id, box_name) in enumerate(boxes):
         # Only display it if there are any sessions
-        if len(box_sessions) > 0:
-            # Extract the calculated reward durations
-            sessions_by_date = pandas.DataFrame.from_records(
-                box_sessions.values())[[
-                "date_time_start", "user_data_left_valve_mean", 
-                "user_data_right_valve_mean"]].dropna()
-            
-            # Convert to date object
-            sessions_by_date.loc[:, "date_start"] = [
-                dt.date() for dt in sessions_by_date["date_time_start"]]
-            
-            # Drop the ones outside the range
-            colnames = [
-                'user_data_left_valve_mean', 
-                'user_data_right_valve_mean']
-            sessions_by_date = sessions_by_date[
-                (sessions_by_date[colnames].min(1) > ignore_lower_thresh) &
-                (sessions_by_date[colnames].max(1) < ignore_upper_thresh)
-            ]
-            
-            # Average the water consumption values by date
-            volumes = sessions_by_date.groupby('date_start').aggregate(np.mean)
-
-            # Convert to uL
-            left_volume = volumes["user_data_left_valve_mean"].values * 1000
-            right_volume = volumes["user_data_right_valve_mean"].values *1000
-
-            # Add axis and plot the volumes
-            ax = f.add_subplot(len(boxes), 1, i+1)
-            ax.plot(left_volume, '-o', color='b')
-            ax.plot(right_volume, '-s', color='g')
-            
-            # Ticklabels for the dates
-            ax.set_xticks(range(len(volumes)))
-            labels = volumes.index.format(
-                formatter = lambda x: x.strftime('%m-%d'))
-            ax.set_xticklabels(labels, rotation=45, size='medium')
-
-            # Show normal water range
-            ax.axhline(min_water_limit, color='r', linestyle='--')
-            ax.axhline(max_water_limit, color='r', linestyle='--')
-            
-            # Consistent ylims
-            ax.set_ylim((2, 8))
-
-            # Labels
-            ax.set_ylabel('Volume released (uL)')
-            title = "{} (Blue = Left Pipe, Green = Right Pipe)".format(box.name)
-            ax.set_title(title)
+        try:
+            box_volumes = volumes.xs(box_id, level='box_id')
+        except KeyError:
+            continue
+
+        # Add axis and plot the volumes
+        ax = f.add_subplot(len(boxes), 1, i+1)
+        ax.plot(box_volumes['left'].values, '-o', color='b')
+        ax.plot(box_volumes['right'].values, '-s', color='g')
+        
+        # Ticklabels for the dates
+        ax.set_xticks(range(len(box_volumes)))
+        labels = box_volumes.index.format(
+            formatter = lambda x: x.strftime('%m-%d'))
+        ax.set_xticklabels(labels, rotation=45, size='medium')
+
+        # Show normal water range
+        ax.axhline(min_water_limit, color='r', linestyle='--')
+        ax.axhline(max_water_limit, color='r', linestyle='--')
+        
+        # Consistent ylims
+        ax.set_ylim((2, 8))
+
+        # Labels
+        ax.set_ylabel('Volume released (uL)')
+        title = "{} (Blue = Left Pipe, Green = Right Pipe)".format(box_name)
+        ax.set_title(title)
 
     # Print to png
     canvas = FigureCanvas(f)
@@ -190,5 +318,152 @@ def rewards_plot(request):
     canvas.print_png(response)
     return response
 
+## Data behind the plots, for rendering on the client
+class Echo(object):
+    """Pseudo-buffer that returns what is written to it
+    
+    This lets csv.writer format one row at a time for streaming.
+    https://docs.djangoproject.com/en/1.9/howto/outputting-csv/
+    """
+    def write(self, value):
+        return value
 
+def _jsonable(value):
+    """Convert NaN to None and numpy scalars to python scalars"""
+    if pandas.isnull(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
 
+def _encode(value):
+    """Format a single value as a utf-8 csv cell, with NaN as empty"""
+    value = _jsonable(value)
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+def iter_pivot_json(piv, level_names):
+    """Yield a pivoted DataFrame as JSON, one row at a time
+    
+    piv : DataFrame indexed by date with a column MultiIndex
+    level_names : a name for each level of the column MultiIndex
+    
+    The result looks like:
+        {"columns": [{level_name: value, ...}, ...], 
+         "rows": [["YYYY-MM-DD", value, ...], ...]}
+    """
+    columns = [
+        dict(zip(level_names, [_jsonable(value) for value in column]))
+        for column in piv.columns]
+    yield '{"columns": %s, "rows": [' % json.dumps(columns)
+    for n_row, (row_date, row) in enumerate(piv.iterrows()):
+        if n_row > 0:
+            yield ', '
+        yield json.dumps(
+            [row_date.isoformat()] + [_jsonable(value) for value in row])
+    yield ']}'
+
+def iter_pivot_csv(piv, level_names):
+    """Yield a pivoted DataFrame as CSV, one row at a time
+    
+    piv : DataFrame indexed by date with a column MultiIndex
+    level_names : a name for each level of the column MultiIndex
+    
+    There is one header row per level, starting with the level name,
+    followed by one row per date.
+    """
+    writer = csv.writer(Echo())
+    for n_level, level_name in enumerate(level_names):
+        yield writer.writerow([level_name] + 
+            [_encode(column[n_level]) for column in piv.columns])
+    for row_date, row in piv.iterrows():
+        yield writer.writerow(
+            [row_date.isoformat()] + [_encode(value) for value in row])
+
+def stream_pivot(piv, level_names, fmt, filename):
+    """Return a streaming response with the pivot as JSON or CSV"""
+    if fmt == 'json':
+        return StreamingHttpResponse(iter_pivot_json(piv, level_names),
+            content_type='application/json')
+    
+    response = StreamingHttpResponse(iter_pivot_csv(piv, level_names),
+        content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % (
+        filename)
+    return response
+
+def get_date_range(request, default_days):
+    """Parse the 'start' and 'stop' dates (YYYY-MM-DD) from the query
+    
+    If 'start' is missing, it defaults to `default_days` before today.
+    If 'stop' is missing, it is None.
+    
+    Raises ValueError if either cannot be parsed.
+    """
+    start = request.GET.get('start')
+    if start is None:
+        start_date = datetime.date.today() - datetime.timedelta(
+            days=default_days)
+    else:
+        start_date = datetime.datetime.strptime(start, '%Y-%m-%d').date()
+    
+    stop = request.GET.get('stop')
+    if stop is None:
+        stop_date = None
+    else:
+        stop_date = datetime.datetime.strptime(stop, '%Y-%m-%d').date()
+    
+    return start_date, stop_date
+
+def weight_data(request, fmt):
+    """The weights behind weight_plot, as JSON or CSV
+    
+    Query parameters:
+        start, stop : date range, YYYY-MM-DD. Defaults to the same window
+            as weight_plot.
+        cohort : training cohort to include, may be repeated. Use -1 for
+            mice without a cohort. Defaults to all cohorts.
+    """
+    try:
+        start_date, stop_date = get_date_range(request, WEIGHT_PLOT_DAYS)
+        cohorts = [int(cohort) for cohort in request.GET.getlist('cohort')]
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    
+    piv = get_weights(start_date, stop_date, cohorts=(cohorts or None))
+    return stream_pivot(piv, ['cohort', 'mouse'], fmt, 'weights')
+
+def rewards_data(request, fmt):
+    """The valve volumes behind rewards_plot, as JSON or CSV
+    
+    Query parameters:
+        start, stop : date range, YYYY-MM-DD. Defaults to the same window
+            as rewards_plot.
+        box : box name to include, may be repeated. Defaults to all boxes.
+    """
+    try:
+        start_date, stop_date = get_date_range(request, 30)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    
+    # Convert box ids to names for display
+    box_qs = Box.objects.all()
+    box_names = request.GET.getlist('box')
+    if len(box_names) > 0:
+        box_qs = box_qs.filter(name__in=box_names)
+    box_id2name = dict(box_qs.values_list('id', 'name'))
+    
+    # Pivot into (box, side) columns, ordered like rewards_plot
+    volumes = get_valve_volumes(start_date, stop_date)
+    volumes = volumes[
+        volumes.index.get_level_values('box_id').isin(box_id2name.keys())]
+    if len(volumes) == 0:
+        piv = pandas.DataFrame()
+    else:
+        piv = volumes.unstack('box_id')
+        piv.columns = pandas.MultiIndex.from_tuples([
+            (box_id2name[box_id], side) for side, box_id in piv.columns])
+        piv = piv.sort_index(axis=1)
+    
+    return stream_pivot(piv, ['box', 'side'], fmt, 'rewards')
@@ -1,24 +1,24 @@
-import numpy as np
-import pandas
 from django.contrib import admin
 import whisk_video.models
 
 from django.forms import TextInput, Textarea
 from django.db import models
+from django.db.models import BooleanField, Case, Q, Value, When
 
 ## Filtering by tagging
 # https://djangosnippets.org/snippets/2807/
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.admin import SimpleListFilter
-from taggit.models import TaggedItem 
 
-from runner.models import GrandSession
+import runner.caches
 
 class TaggitListFilter(SimpleListFilter):
     """
     A custom filter class that can be used to filter by taggit tags in the admin.
     
-    Edited to work for the grand_session OneToOneField
+    Edited to work for the grand_session OneToOneField, listing the tags
+    from the cached GrandSession tag index. The filtering itself is done
+    by the database, because the index may be out of date.
     """
 
     # Human-readable title which will be displayed in the
@@ -37,9 +37,9 @@ class TaggitListFilter(SimpleListFilter):
         list = []
         
         # Instead of model_admin (VideoSession), always search for GrandSession
-        tags = TaggedItem.tags_for(GrandSession)
-        for tag in tags:
-            list.append( (tag.name, _(tag.name)) )
+        tag2ids = runner.caches.get_grand_session_tag_index()['tag2ids']
+        for tag_name in sorted(tag2ids.keys()):
+            list.append( (tag_name, _(tag_name)) )
         return list    
 
     def queryset(self, request, queryset):
@@ -51,6 +51,44 @@ class TaggitListFilter(SimpleListFilter):
             # Search on linked grand_session
             return queryset.filter(grand_session__tags__name__in=[self.value()])
 
+## Pipeline completeness flags
+# These are annotated onto the changelist queryset so that they are
+# computed by the database for the whole page, and can be sorted on.
+def filename_isnotnull(field_name):
+    """Annotation that is True if field_name is neither null nor ''"""
+    return Case(
+        When(Q(**{field_name + '__isnull': True}) | Q(**{field_name: ''}), 
+            then=Value(False)),
+        default=Value(True),
+        output_field=BooleanField(),
+    )
+
+def sync_isnotnull():
+    """Annotation that is True if all of the sync fit parameters are set"""
+    return Case(
+        When(fit_v2b0__isnull=False, fit_v2b1__isnull=False, 
+            fit_b2v0__isnull=False, fit_b2v1__isnull=False, 
+            then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    )
+
+def annotation_list_filter(annotation_name, filter_title):
+    """Return a list filter on one of the annotated flags"""
+    class AnnotationListFilter(SimpleListFilter):
+        title = filter_title
+        parameter_name = annotation_name
+        
+        def lookups(self, request, model_admin):
+            return [('1', _('Yes')), ('0', _('No'))]
+        
+        def queryset(self, request, queryset):
+            if self.value() in ('0', '1'):
+                return queryset.filter(
+                    **{annotation_name: self.value() == '1'})
+    
+    return AnnotationListFilter
+
 class VideoSessionInline(admin.StackedInline):
     """For a tab within GrandSession"""
     model = whisk_video.models.VideoSession
@@ -73,8 +111,18 @@ class VideoSessionAdmin(admin.ModelAdmin):
     
     list_filter = [
         TaggitListFilter,
+        annotation_list_filter('has_whiskers', 'whiskers'),
+        annotation_list_filter('has_sync', 'sync'),
+        annotation_list_filter('has_edges', 'edges'),
+        annotation_list_filter('has_tac', 'tac'),
+        annotation_list_filter('has_clustered_tac', 'clustered'),
+        annotation_list_filter('has_cs', 'cs'),
+        annotation_list_filter('has_colorized', 'colorized'),
+        annotation_list_filter('has_ccs', 'ccs'),
     ]
     
+    list_select_related = ['bsession']
+    
     # Make the "notes" field a wider editable box
     list_editable = ['notes',]
     formfield_overrides = {
@@ -82,57 +130,71 @@ class VideoSessionAdmin(admin.ModelAdmin):
             'rows':2, 'cols':80, 'style': 'width: 45em;resize: vertical;'})},
     }
     
+    def get_queryset(self, request):
+        return super(VideoSessionAdmin, self).get_queryset(request).annotate(
+            has_whiskers=filename_isnotnull('whiskers_table_filename'),
+            has_edges=filename_isnotnull('all_edges_filename'),
+            has_tac=filename_isnotnull('tac_filename'),
+            has_clustered_tac=filename_isnotnull('clustered_tac_filename'),
+            has_colorized=filename_isnotnull(
+                'colorized_whisker_ends_filename'),
+            has_cs=filename_isnotnull('contacts_summary_filename'),
+            has_ccs=filename_isnotnull('colorized_contacts_summary_filename'),
+            has_sync=sync_isnotnull(),
+        )
+    
     def whiskers_isnotnull(self, obj):
-        val = obj.whiskers_table_filename
-        return val is not None and val != ''
+        return obj.has_whiskers
     whiskers_isnotnull.short_description = 'whiskers'
     whiskers_isnotnull.boolean = True
+    whiskers_isnotnull.admin_order_field = 'has_whiskers'
 
     def edges_isnotnull(self, obj):
-        val = obj.all_edges_filename
-        return val is not None and val != ''
+        return obj.has_edges
     edges_isnotnull.short_description = 'edges'
     edges_isnotnull.boolean = True
+    edges_isnotnull.admin_order_field = 'has_edges'
 
     def tac_isnotnull(self, obj):
-        val = obj.tac_filename
-        return val is not None and val != ''
+        return obj.has_tac
     tac_isnotnull.short_description = 'tac'
     tac_isnotnull.boolean = True
+    tac_isnotnull.admin_order_field = 'has_tac'
 
     def clustered_tac_isnotnull(self, obj):
-        val = obj.clustered_tac_filename
-        return val is not None and val != ''
+        return obj.has_clustered_tac
     clustered_tac_isnotnull.short_description = 'clustered'
     clustered_tac_isnotnull.boolean = True
+    clustered_tac_isnotnull.admin_order_field = 'has_clustered_tac'
 
     def colorized_isnotnull(self, obj):
-        val = obj.colorized_whisker_ends_filename
-        return val is not None and val != ''
+        return obj.has_colorized
     colorized_isnotnull.short_description = 'colorized'
     colorized_isnotnull.boolean = True
+    colorized_isnotnull.admin_order_field = 'has_colorized'
 
     def cs_isnotnull(self, obj):
-        val = obj.contacts_summary_filename
-        return val is not None and val != ''
+        return obj.has_cs
     cs_isnotnull.short_description = 'cs'
     cs_isnotnull.boolean = True
+    cs_isnotnull.admin_order_field = 'has_cs'
     
     def ccs_isnotnull(self, obj):
-        val = obj.colorized_contacts_summary_filename
-        return val is not None and val != ''
+        return obj.has_ccs
     ccs_isnotnull.short_description = 'ccs'
     ccs_isnotnull.boolean = True
+    ccs_isnotnull.admin_order_field = 'has_ccs'
     
     def sync_isnotnull(self, obj):
-        return not np.any(pandas.isnull([
-            obj.fit_v2b0, obj.fit_v2b1, obj.fit_b2v0, obj.fit_b2v1]))
+        return obj.has_sync
     sync_isnotnull.short_description = 'sync'
-    sync_isnotnull.boolean = True        
+    sync_isnotnull.boolean = True
+    sync_isnotnull.admin_order_field = 'has_sync'
     
     def tags(self, obj):
-        if obj.grand_session:
-            return ", ".join([o.name for o in obj.grand_session.tags.all()])
+        if obj.grand_session_id:
+            return ", ".join(
+                runner.caches.get_grand_session_tags(obj.grand_session_id))
         else:
             return ""
 
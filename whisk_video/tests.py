@@ -1,3 +1,58 @@
-from django.test import TestCase
+from runner.tests import AdminTestCase
 
-# Create your tests here.
+import whisk_video.models
+
+class VideoSessionAdminTest(AdminTestCase):
+    url = '/admin/whisk_video/videosession/'
+    
+    def setUp(self):
+        super(VideoSessionAdminTest, self).setUp()
+        
+        # One with everything, one with nothing, and one with a partial 
+        # sync and an empty (rather than null) filename
+        whisk_video.models.VideoSession.objects.create(name='vs0',
+            whiskers_table_filename='whiskers', all_edges_filename='edges',
+            tac_filename='tac', clustered_tac_filename='clustered',
+            colorized_whisker_ends_filename='colorized',
+            contacts_summary_filename='cs',
+            colorized_contacts_summary_filename='ccs',
+            fit_v2b0=1, fit_v2b1=1, fit_b2v0=1, fit_b2v1=1,
+        )
+        whisk_video.models.VideoSession.objects.create(name='vs1')
+        whisk_video.models.VideoSession.objects.create(name='vs2',
+            tac_filename='', fit_v2b0=1)
+    
+    def get_result_names(self, query):
+        response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        return sorted(obj.pk for obj in response.context['cl'].result_list)
+    
+    def test_flags(self):
+        response = self.client.get(self.url)
+        rows = dict(
+            (obj.pk, obj) for obj in response.context['cl'].result_list)
+        self.assertTrue(rows['vs0'].has_sync)
+        self.assertTrue(rows['vs0'].has_ccs)
+        self.assertFalse(rows['vs1'].has_whiskers)
+        self.assertFalse(rows['vs2'].has_tac)
+        self.assertFalse(rows['vs2'].has_sync)
+    
+    def test_filter_and_sort_on_flags(self):
+        self.assertEqual(self.get_result_names('?has_sync=1'), ['vs0'])
+        self.assertEqual(
+            self.get_result_names('?has_tac=0'), ['vs1', 'vs2'])
+        
+        # Sort descending on the sync column
+        response = self.client.get(self.url + '?o=-4.1')
+        self.assertEqual(
+            response.context['cl'].result_list[0].pk, 'vs0')
+    
+    def test_changelist_queries_independent_of_rows(self):
+        n_queries_few = self.count_warm_changelist_queries(self.url)
+        
+        for n in range(20):
+            whisk_video.models.VideoSession.objects.create(
+                name='extra%02d' % n, tac_filename='tac')
+        n_queries_many = self.count_warm_changelist_queries(self.url)
+        
+        self.assertEqual(n_queries_few, n_queries_many)